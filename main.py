@@ -1,10 +1,12 @@
 from python_database.IndexDatabase import IndexDatabase as db
+from python_database.Instrumentation import INSTRUMENTATION
 from python_database.QBE import QBE
 import logging
 
 
 # Define the paths and file names
 DB_PATH: str = r'Base10000'
+DRAFT_SCALE: int = 1
 
 
 # Global variables for the query by example (QBE) system
@@ -12,6 +14,8 @@ DESCRIPTORS_PATH: str = r'Base10000_descriptors'
 IMAGE_NAME: str = '123033.jpg'
 DESCRIPTOR_FILE_NAME: str = 'Base10000.HistGREY_256'
 NB_RESULTS: int = 30
+METRIC: str = 'chebyshev'
+INSTRUMENT: bool = False
 
 
 # Set the logging level and format
@@ -21,8 +25,13 @@ logging.basicConfig(
     )
 
 
+# Record the stage timers and counters
+if INSTRUMENT:
+    INSTRUMENTATION.enable()
+
+
 # Instructions to index the database
-index_db = db(DB_PATH)
+index_db = db(DB_PATH, DRAFT_SCALE)
 
 # Uncomment this line to index the database
 # index_db.index()
@@ -30,4 +39,13 @@ index_db = db(DB_PATH)
 
 # Instructions to query the database
 qbe = QBE(DB_PATH, DESCRIPTORS_PATH)
-qbe.request(DESCRIPTOR_FILE_NAME, IMAGE_NAME, NB_RESULTS)
+qbe.request(DESCRIPTOR_FILE_NAME, IMAGE_NAME, NB_RESULTS, METRIC)
+
+
+# Stop the worker processes of the sharded searches
+qbe.close()
+
+
+# Print the stage timers and counters
+if INSTRUMENT:
+    print(INSTRUMENTATION.to_json())
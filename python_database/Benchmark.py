@@ -0,0 +1,397 @@
+import argparse
+from .DescriptorStore import DescriptorStore
+from .IndexDatabase import IndexDatabase
+import inspect
+from .JPicture import JPicture
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+from PIL import Image
+import platform
+from .QBE import QBE
+from .SearchEngine import SearchEngine
+import shutil
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the peak memory is not reported there
+    resource = None
+
+
+class Benchmark:
+    """
+    A class representing the benchmark suite: synthetic image sets and descriptor matrices of configurable size,
+    and the time of each stage of the indexing and query pipeline over them.
+
+    Image sets measure the decoding (PIL), the histograms (JPicture.histograms) and the whole indexing
+    (IndexDatabase.index) of synthetic JPEG images. Descriptor sets measure the writing of a descriptor store,
+    its loading (QBE._init_descriptors, memory-mapped, then read in memory), single queries (SearchEngine.search),
+    batched queries (SearchEngine.batch_search) and whole requests (QBE.request, HTML file included) over random
+    normalized histograms.
+
+    Each set is benchmarked in a fresh process, so that its peak resident memory (reported after each stage, as
+    the peak of the process so far) doesn't depend on the sets benchmarked before it.
+
+    Attributes:
+        work_path (str): The folder the synthetic sets are generated in.
+        queries (int): The number of queries of the query stages.
+        seed (int): The seed of the synthetic data.
+
+    Methods:
+        __init__(self, work_path: str, queries: int, seed: int): Initializes the Benchmark object.
+        _peak_rss_mb(): Returns the peak resident memory of the process.
+        _stage(seconds: float, items: int): Describes a timed stage.
+        _write_files_list(folder: str, files: list[str]): Writes the list of files of a synthetic set.
+        generate_images(folder: str, count: int, size: tuple[int, int], seed: int): Generates synthetic images.
+        generate_descriptors(count: int, dim: int, seed: int, chunk_rows: int): Generates synthetic descriptors.
+        run_images(self, count: int, size: tuple[int, int], workers: int): Benchmarks an image set.
+        run_descriptors(self, count: int, dim: int, k: int): Benchmarks a descriptor set.
+        run(self, image_counts, rows, dims, size, workers, k): Benchmarks every set, each in its own process.
+    """
+
+    work_path: str
+    queries: int
+    seed: int
+
+    def __init__(self, work_path: str = '', queries: int = 20, seed: int = 0):
+        """
+        Initializes the Benchmark object.
+
+        Args:
+            work_path (str): The folder the synthetic sets are generated in, empty for the temporary folder.
+            queries (int): The number of queries of the query stages.
+            seed (int): The seed of the synthetic data.
+        """
+
+        self.work_path = work_path or tempfile.gettempdir()
+        self.queries = queries
+        self.seed = seed
+
+    @staticmethod
+    def _peak_rss_mb() -> float | None:
+        """
+        Returns the peak resident memory of the process.
+
+        Returns:
+            float | None: The peak resident memory in MB, None where it is not available.
+        """
+
+        if resource is None:
+            return None
+
+        # Kilobytes on Linux, bytes on macOS
+        peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if platform.system() == 'Darwin' else peak / (1 << 10)
+
+    @staticmethod
+    def _stage(seconds: float, items: int) -> dict:
+        """
+        Describes a timed stage.
+
+        Args:
+            seconds (float): The time of the stage.
+            items (int): The number of items (images, rows or queries) processed by the stage.
+
+        Returns:
+            dict: The time, the throughput and the peak resident memory so far.
+        """
+
+        return {
+            'seconds': seconds,
+            'items_per_s': items / seconds if seconds > 0 else 0.0,
+            'peak_rss_mb': Benchmark._peak_rss_mb()
+        }
+
+    @staticmethod
+    def _write_files_list(folder: str, files: list[str]):
+        """
+        Writes the list of files of a synthetic set, where IndexDatabase and QBE look for it.
+
+        Args:
+            folder (str): The folder of the set.
+            files (list[str]): The filenames.
+        """
+
+        with open(os.path.join(folder, 'Base10000_files.txt'), 'w') as file:
+            file.write('\n'.join(files) + '\n')
+
+    @staticmethod
+    def generate_images(folder: str, count: int, size: tuple[int, int] = (384, 256), seed: int = 0) -> list[str]:
+        """
+        Generates synthetic JPEG images (smooth random colour fields, the size of the Base10000 images) in the images
+        subfolder of a folder, with the list of their filenames.
+
+        Args:
+            folder (str): The folder of the set.
+            count (int): The number of images.
+            size (tuple[int, int]): The width and height of the images.
+            seed (int): The seed of the random colours.
+
+        Returns:
+            list[str]: The filenames of the images.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        rng: np.random.Generator = np.random.default_rng(seed)
+        os.makedirs(os.path.join(folder, 'images'), exist_ok=True)
+
+        files: list[str] = [f'{number}.jpg' for number in range(count)]
+        for filename in files:
+            # Upscale a small random image, which compresses and decodes like a natural image
+            seeds: np.ndarray = rng.integers(0, 256, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+            image: Image.Image = Image.fromarray(seeds).resize(size, Image.BILINEAR)
+            image.save(os.path.join(folder, 'images', filename), quality=85)
+
+        Benchmark._write_files_list(folder, files)
+
+        return files
+
+    @staticmethod
+    def generate_descriptors(count: int, dim: int, seed: int = 0, chunk_rows: int = 65536):
+        """
+        Generates synthetic descriptors (random normalized histograms) by chunks of rows, so that the matrix never
+        needs to be held in memory as a whole.
+
+        Args:
+            count (int): The number of rows.
+            dim (int): The dimension of the descriptors.
+            seed (int): The seed of the random values.
+            chunk_rows (int): The number of rows per chunk.
+
+        Yields:
+            np.ndarray: The next chunk of rows, in float32.
+        """
+
+        rng: np.random.Generator = np.random.default_rng(seed)
+        for start in range(0, count, chunk_rows):
+            chunk: np.ndarray = rng.random((min(chunk_rows, count - start), dim), dtype=np.float32) ** 4
+            yield chunk / chunk.sum(axis=1, keepdims=True)
+
+    def run_images(self, count: int, size: tuple[int, int] = (384, 256), workers: int = 1) -> dict:
+        """
+        Benchmarks an image set: decoding, histograms and whole indexing.
+
+        Args:
+            count (int): The number of images.
+            size (tuple[int, int]): The width and height of the images.
+            workers (int): The number of worker processes of the indexing.
+
+        Returns:
+            dict: The description of the set and of each stage.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        folder: str = tempfile.mkdtemp(prefix='qbe_benchmark_', dir=self.work_path)
+        try:
+            files: list[str] = self.generate_images(folder, count, size, self.seed)
+            paths: list[str] = [os.path.join(folder, 'images', filename) for filename in files]
+            stages: dict[str, dict] = {}
+
+            # Decoding alone
+            start: float = time.perf_counter()
+            for path in paths:
+                with Image.open(path) as image:
+                    image.load()
+            stages['decode'] = self._stage(time.perf_counter() - start, count)
+
+            # Histograms of decoded images
+            images: list[Image.Image] = []
+            for path in paths:
+                image = Image.open(path)
+                image.load()
+                images.append(image)
+            jp: JPicture = JPicture()
+            start = time.perf_counter()
+            for image in images:
+                jp.histograms(image)
+            stages['histogram'] = self._stage(time.perf_counter() - start, count)
+            for image in images:
+                image.close()
+
+            # Whole indexing: decoding, histograms and writing of the stores
+            start = time.perf_counter()
+            IndexDatabase(folder).index(workers)
+            stages['index'] = self._stage(time.perf_counter() - start, count)
+
+            return {'images': count, 'size': list(size), 'workers': workers, 'stages': stages}
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def run_descriptors(self, count: int, dim: int, k: int = 30) -> dict:
+        """
+        Benchmarks a descriptor set: writing, loading and querying a descriptor store.
+
+        Args:
+            count (int): The number of rows.
+            dim (int): The dimension of the descriptors.
+            k (int): The number of results per query.
+
+        Returns:
+            dict: The description of the set and of each stage.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        folder: str = tempfile.mkdtemp(prefix='qbe_benchmark_', dir=self.work_path)
+        try:
+            files: list[str] = [f'{number}.jpg' for number in range(count)]
+            self._write_files_list(folder, files)
+            descriptor_file_name: str = f'Synthetic.Dim{dim}'
+            store_path: str = os.path.join(folder, descriptor_file_name + DescriptorStore.EXTENSION)
+            stages: dict[str, dict] = {}
+
+            # Writing, by chunks appended to the store like an incremental indexing
+            generation_time: float = 0.0
+            start: float = time.perf_counter()
+            store: DescriptorStore | None = None
+            written: int = 0
+            chunk_start: float = time.perf_counter()
+            for chunk in self.generate_descriptors(count, dim, self.seed):
+                generation_time += time.perf_counter() - chunk_start
+                chunk_files: list[str] = files[written:written + chunk.shape[0]]
+                if store is None:
+                    DescriptorStore.write(store_path, descriptor_file_name, chunk, chunk_files)
+                    store = DescriptorStore(store_path, 'r+')
+                else:
+                    store.append(chunk, chunk_files)
+                written += chunk.shape[0]
+                chunk_start = time.perf_counter()
+            del store
+            stages['write'] = self._stage(time.perf_counter() - start - generation_time, count)
+            stages['write']['mb_per_s'] = count * dim * 4 / (1 << 20) / max(stages['write']['seconds'], 1e-9)
+
+            # Loading: memory-mapping, then reading the whole matrix
+            qbe: QBE = QBE(folder, folder)
+            start = time.perf_counter()
+            descriptors: np.ndarray = qbe._init_descriptors(descriptor_file_name)
+            stages['load'] = self._stage(time.perf_counter() - start, count)
+            start = time.perf_counter()
+            descriptors = np.array(descriptors)
+            stages['load_resident'] = self._stage(time.perf_counter() - start, count)
+
+            # Single queries against the resident matrix
+            engine: SearchEngine = SearchEngine(descriptors, qbe.db_files)
+            query_rows: np.ndarray = np.random.default_rng(self.seed).choice(count, min(self.queries, count), replace=False)
+            latencies: list[float] = []
+            for row in query_rows:
+                start = time.perf_counter()
+                engine.search(files[row], k)
+                latencies.append(time.perf_counter() - start)
+            stages['query'] = self._stage(float(np.sum(latencies)), len(latencies))
+            stages['query'].update({
+                'p50_ms': float(np.percentile(latencies, 50)) * 1000,
+                'p95_ms': float(np.percentile(latencies, 95)) * 1000
+            })
+
+            # The same queries in one batch
+            start = time.perf_counter()
+            engine.batch_search(descriptors[query_rows], k, query_rows)
+            stages['batch_query'] = self._stage(time.perf_counter() - start, len(query_rows))
+
+            # Whole requests: loading, search and HTML file
+            del engine, descriptors
+            request_rows: np.ndarray = query_rows[:max(1, min(5, len(query_rows)))]
+            start = time.perf_counter()
+            for row in request_rows:
+                qbe.request(descriptor_file_name, files[row], k)
+            stages['request'] = self._stage(time.perf_counter() - start, len(request_rows))
+
+            return {'rows': count, 'dim': dim, 'k': k, 'stages': stages}
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def run(
+            self,
+            image_counts: tuple[int, ...] = (200,),
+            rows: tuple[int, ...] = (10000, 100000, 1000000),
+            dims: tuple[int, ...] = (8, 64, 216, 256, 512),
+            size: tuple[int, int] = (384, 256),
+            workers: int = 1,
+            k: int = 30
+            ) -> dict:
+        """
+        Benchmarks every image set and every (rows, dimension) descriptor set, each in its own process.
+
+        Args:
+            image_counts (tuple[int, ...]): The numbers of images of the image sets.
+            rows (tuple[int, ...]): The numbers of rows of the descriptor sets.
+            dims (tuple[int, ...]): The dimensions of the descriptor sets.
+            size (tuple[int, int]): The width and height of the synthetic images.
+            workers (int): The number of worker processes of the indexing.
+            k (int): The number of results per query.
+
+        Returns:
+            dict: The JSON-serializable report of every set.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        report: dict = {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpus': os.cpu_count(),
+            'queries': self.queries,
+            'image_sets': [],
+            'descriptor_sets': []
+        }
+
+        # A fresh process per set, started from scratch so that it inherits no memory
+        context = multiprocessing.get_context('spawn')
+
+        for count in image_counts:
+            # Logging information
+            logging.info(f'Benchmarking {count} images...')
+
+            with context.Pool(1) as pool:
+                report['image_sets'].append(pool.apply(self.run_images, (count, size, workers)))
+
+        for count in rows:
+            for dim in dims:
+                # Logging information
+                logging.info(f'Benchmarking {count} rows of {dim} dimensions...')
+
+                with context.Pool(1) as pool:
+                    report['descriptor_sets'].append(pool.apply(self.run_descriptors, (count, dim, k)))
+
+        return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the indexing and query pipeline on synthetic data')
+    parser.add_argument('--images', type=int, nargs='*', default=[200], help='Numbers of images of the image sets')
+    parser.add_argument('--rows', type=int, nargs='*', default=[10000, 100000, 1000000], help='Numbers of rows')
+    parser.add_argument('--dims', type=int, nargs='*', default=[8, 64, 216, 256, 512], help='Descriptor dimensions')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[384, 256], help='Width and height of the images')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes of the indexing')
+    parser.add_argument('--queries', type=int, default=20, help='Number of queries of the query stages')
+    parser.add_argument('--k', type=int, default=30, help='Number of results per query')
+    parser.add_argument('--work-path', default='', help='Folder of the synthetic data (needs ~2 GB for 1M x 512)')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file of the report')
+    arguments = parser.parse_args()
+
+    # Set the logging level and format
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    benchmark = Benchmark(arguments.work_path, arguments.queries)
+    benchmark_report: dict = benchmark.run(
+        tuple(arguments.images), tuple(arguments.rows), tuple(arguments.dims), tuple(arguments.image_size),
+        arguments.workers, arguments.k
+    )
+
+    with open(arguments.output, 'w') as file:
+        json.dump(benchmark_report, file, indent=2)
+
+    # Logging information
+    logging.info(f'Benchmark report written to {arguments.output}')
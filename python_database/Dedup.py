@@ -0,0 +1,313 @@
+import argparse
+import inspect
+import itertools
+import json
+import logging
+from .Metrics import get_metric, Metric
+import numpy as np
+import time
+
+
+class DuplicateFinder:
+    """
+    A class representing the detection of the near-duplicate images of a collection (re-encoded, resized or slightly
+    edited copies), from a perceptual hash of each image (see Descriptors.DHash and Descriptors.PHash) and a
+    histogram descriptor, in roughly linear time instead of a query per image.
+
+    The hashes are packed into 64-bit words. Candidate pairs come from multi-index hashing: the bits are split into
+    bands of about log2(rows) bits, and the images are put in buckets by the value of each band. Two hashes within
+    max_hamming bits over m bands are within max_hamming // m bits in at least one band, so probing the buckets of
+    the values within that radius finds every pair within the Hamming radius, while the buckets stay small. The
+    candidates are then verified with their Hamming distance and the distance between their histograms, and the
+    verified pairs are joined into clusters.
+
+    A bucket larger than max_bucket (e.g. the blank images) is not expanded into pairs, which would be quadratic:
+    only its images with exactly the same hash are joined.
+
+    Attributes:
+        files (list[str]): The filename of the image of each row.
+        bits (int): The number of bits of the hashes.
+        codes (np.ndarray): The (rows, words) uint64 packed hashes.
+        histograms (np.ndarray | None): The histogram descriptors verifying the candidates, aligned with the hashes.
+        metric (Metric): The distance between the histograms.
+        _hashes (np.ndarray): The (rows, bits) hash bits.
+        statistics (dict): The counts and durations of the last find().
+
+    Methods:
+        __init__(self, hashes, files, histograms, metric): Initializes the DuplicateFinder object.
+        hamming(self, first: np.ndarray, second: np.ndarray): Computes the Hamming distances of pairs of rows.
+        candidates(self, max_hamming: int, bands: int | None, max_bucket: int): Finds the candidate pairs.
+        find(self, max_hamming: int, max_histogram_distance: float, bands: int | None, max_bucket: int): Finds the
+            clusters of near-duplicates.
+        _clusters(count: int, first: np.ndarray, second: np.ndarray): Joins pairs of rows into clusters.
+    """
+
+    files: list[str]
+    bits: int
+    codes: np.ndarray
+    histograms: np.ndarray | None
+    metric: Metric
+    _hashes: np.ndarray
+    statistics: dict
+
+    def __init__(
+            self,
+            hashes: np.ndarray,
+            files: list[str],
+            histograms: np.ndarray | None = None,
+            metric: str = 'l1'
+            ):
+        """
+        Initializes the DuplicateFinder object.
+
+        Args:
+            hashes (np.ndarray): The (rows, bits) hash bits of the images, as 0 and 1 values.
+            files (list[str]): The filename of the image of each row.
+            histograms (np.ndarray | None): The histogram descriptors of the images, one row per image, None to only
+                verify the candidates with their Hamming distance.
+            metric (str): The name of the distance between the histograms (see Metrics.METRICS).
+        """
+
+        self._hashes = np.asarray(hashes) > 0.5
+        self.files = files
+        self.bits = self._hashes.shape[1]
+        self.histograms = histograms
+        self.metric = get_metric(metric)
+        self.statistics = {}
+
+        # Pack the bits into 64-bit words, padded with zero bits
+        words: int = max(1, -(-self.bits // 64))
+        padded: np.ndarray = np.zeros((self._hashes.shape[0], words * 64), dtype=bool)
+        padded[:, :self.bits] = self._hashes
+        self.codes = np.packbits(padded, axis=1).view('>u8').astype(np.uint64)
+
+    def hamming(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        """
+        Computes the Hamming distances between the hashes of pairs of rows.
+
+        Args:
+            first (np.ndarray): The first row of each pair.
+            second (np.ndarray): The second row of each pair.
+
+        Returns:
+            np.ndarray: The number of differing bits of each pair.
+        """
+
+        return np.bitwise_count(self.codes[first] ^ self.codes[second]).sum(axis=1, dtype=np.intp)
+
+    def candidates(
+            self,
+            max_hamming: int,
+            bands: int | None = None,
+            max_bucket: int = 1000
+            ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the candidate pairs of rows whose hashes are within max_hamming bits in at least one band: the bits are
+        split into bands, and two hashes within max_hamming bits are within max_hamming // bands bits in one of them.
+        Each band of each hash is probed for the bucket of its own value and of the values within that radius.
+
+        Args:
+            max_hamming (int): The largest Hamming distance between the hashes of two duplicates.
+            bands (int | None): The number of bands, None for bands of about log2(rows) bits, so that the buckets
+                hold a few rows each and the search is roughly linear.
+            max_bucket (int): The largest bucket expanded into all its pairs.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The first and second row of each distinct pair, the first one smaller.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        count: int = self._hashes.shape[0]
+        if bands is None:
+            band_bits: int = max(8, int(np.ceil(np.log2(max(count, 2)))))
+            bands = min(max_hamming + 1, self.bits // band_bits)
+        bands = max(1, min(bands, self.bits))
+        radius: int = max_hamming // bands
+        bounds: np.ndarray = np.linspace(0, self.bits, bands + 1).astype(np.intp)
+        first: list[np.ndarray] = [np.empty(0, dtype=np.intp)]
+        second: list[np.ndarray] = [np.empty(0, dtype=np.intp)]
+        oversized: int = 0
+
+        for band in range(bands):
+            # Value of the band of each hash (a band has at most 64 bits)
+            band_hashes: np.ndarray = self._hashes[:, bounds[band]:bounds[band + 1]]
+            width: int = band_hashes.shape[1]
+            keys: np.ndarray = band_hashes.astype(np.uint64) @ (np.uint64(1) << np.arange(width, dtype=np.uint64))
+
+            # Buckets of equal values, as runs of the sorted keys
+            order: np.ndarray = np.argsort(keys, kind='stable')
+            sorted_keys: np.ndarray = keys[order]
+
+            # The rows of the oversized buckets are left to the identical hashes
+            values: np.ndarray
+            sizes: np.ndarray
+            values, sizes = np.unique(sorted_keys, return_counts=True)
+            oversized += int(np.sum(sizes > max_bucket))
+            queries: np.ndarray = np.flatnonzero(~np.isin(keys, values[sizes > max_bucket]))
+
+            # Probe the buckets of the values within the radius of each query
+            for distance in range(radius + 1):
+                for flipped in itertools.combinations(range(width), distance):
+                    mask: np.uint64 = np.uint64(sum(1 << bit for bit in flipped))
+                    probes: np.ndarray = keys[queries] ^ mask
+                    left: np.ndarray = np.searchsorted(sorted_keys, probes, 'left')
+                    matches: np.ndarray = np.searchsorted(sorted_keys, probes, 'right') - left
+                    matches[matches > max_bucket] = 0
+
+                    # Expand each query into the rows of its bucket
+                    total: int = int(matches.sum())
+                    offsets: np.ndarray = np.arange(total) - np.repeat(np.cumsum(matches) - matches, matches)
+                    query_rows: np.ndarray = np.repeat(queries, matches)
+                    bucket_rows: np.ndarray = order[np.repeat(left, matches) + offsets]
+
+                    # Each pair is found from both of its rows: keep it once
+                    kept: np.ndarray = query_rows < bucket_rows
+                    first.append(query_rows[kept])
+                    second.append(bucket_rows[kept])
+
+        # Pairs of the oversized buckets: chain the images with the same full hash, in linear time
+        if oversized:
+            logging.warning(f'{oversized} buckets larger than {max_bucket} images only join their identical hashes')
+            order = np.lexsort(self.codes.T[::-1])
+            same: np.ndarray = np.flatnonzero(np.all(self.codes[order[1:]] == self.codes[order[:-1]], axis=1))
+            pairs: np.ndarray = np.sort(np.stack((order[same], order[same + 1]), axis=1), axis=1)
+            first.append(pairs[:, 0])
+            second.append(pairs[:, 1])
+
+        # Keep each pair once, whatever the number of bands it was found in
+        pairs = np.unique(np.stack((np.concatenate(first), np.concatenate(second)), axis=1), axis=0)
+
+        return pairs[:, 0], pairs[:, 1]
+
+    @staticmethod
+    def _clusters(count: int, first: np.ndarray, second: np.ndarray) -> list[list[int]]:
+        """
+        Joins pairs of rows into clusters (the connected components of the pairs), with a union-find.
+
+        Args:
+            count (int): The number of rows.
+            first (np.ndarray): The first row of each pair.
+            second (np.ndarray): The second row of each pair.
+
+        Returns:
+            list[list[int]]: The rows of each cluster of at least two rows, sorted, clusters ordered by first row.
+        """
+
+        parents: list[int] = list(range(count))
+
+        def root(row: int) -> int:
+            while parents[row] != row:
+                parents[row] = parents[parents[row]]
+                row = parents[row]
+            return row
+
+        for row, other in zip(first.tolist(), second.tolist()):
+            row, other = root(row), root(other)
+            if row != other:
+                parents[max(row, other)] = min(row, other)
+
+        clusters: dict[int, list[int]] = {}
+        for row in sorted(set(first.tolist()) | set(second.tolist())):
+            clusters.setdefault(root(row), []).append(row)
+
+        return [rows for _, rows in sorted(clusters.items())]
+
+    def find(
+            self,
+            max_hamming: int = 6,
+            max_histogram_distance: float = 0.3,
+            bands: int | None = None,
+            max_bucket: int = 1000
+            ) -> list[list[str]]:
+        """
+        Finds the clusters of near-duplicate images.
+
+        Args:
+            max_hamming (int): The largest Hamming distance between the hashes of two duplicates.
+            max_histogram_distance (float): The largest distance between the histograms of two duplicates.
+            bands (int | None): The number of bands of the candidate search, None to choose it from the number of
+                rows (see candidates()). Every pair within max_hamming bits is a candidate, whatever the bands.
+            max_bucket (int): The largest bucket expanded into all its pairs (see candidates()).
+
+        Returns:
+            list[list[str]]: The filenames of each cluster of near-duplicates.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        start: float = time.perf_counter()
+        first: np.ndarray
+        second: np.ndarray
+        first, second = self.candidates(max_hamming, bands, max_bucket)
+        candidates_time: float = time.perf_counter() - start
+
+        # Verify the candidates with their Hamming distance
+        close: np.ndarray = self.hamming(first, second) <= max_hamming
+        first, second = first[close], second[close]
+        hamming_pairs: int = int(first.size)
+
+        # Verify the remaining candidates with their histograms, grouped by first row
+        if self.histograms is not None and first.size:
+            verified: np.ndarray = np.zeros(first.size, dtype=bool)
+            starts: np.ndarray = np.flatnonzero(np.r_[True, first[1:] != first[:-1]])
+            for begin, end in zip(starts, np.r_[starts[1:], first.size]):
+                others: np.ndarray = self.histograms[second[begin:end]]
+                distances: np.ndarray = self.metric.distances(
+                    self.histograms[first[begin]], others, self.metric.prepare(others)
+                )
+                verified[begin:end] = distances <= max_histogram_distance
+            first, second = first[verified], second[verified]
+
+        clusters: list[list[int]] = self._clusters(self._hashes.shape[0], first, second)
+        self.statistics = {
+            'images': self._hashes.shape[0],
+            'bits': self.bits,
+            'candidates': int(close.size),
+            'hamming_pairs': hamming_pairs,
+            'verified_pairs': int(first.size),
+            'clusters': len(clusters),
+            'duplicates': sum(len(rows) - 1 for rows in clusters),
+            'candidates_s': candidates_time,
+            'elapsed_s': time.perf_counter() - start
+        }
+
+        # Logging information
+        logging.info(
+            f'{self.statistics["clusters"]} clusters of near-duplicates ({self.statistics["duplicates"]} duplicates) '
+            f'among {self.statistics["images"]} images, {self.statistics["candidates"]} candidate pairs verified '
+            f'in {self.statistics["elapsed_s"]:.2f}s'
+        )
+
+        return [[self.files[row] for row in rows] for rows in clusters]
+
+
+if __name__ == '__main__':
+    from .QBE import QBE
+
+    parser = argparse.ArgumentParser(description='Finds the clusters of near-duplicate images of a collection')
+    parser.add_argument('hashes', help='Name of the hash descriptor file (e.g. Base10000.DHash_8)')
+    parser.add_argument('--histograms', default='', help='Name of the histogram descriptor file verifying the pairs')
+    parser.add_argument('--metric', default='l1', help='Name of the distance between the histograms')
+    parser.add_argument('--db-path', default='Base10000', help='Path to the database')
+    parser.add_argument('--descriptors-path', default='Base10000_descriptors', help='Path to the descriptors')
+    parser.add_argument('--max-hamming', type=int, default=6, help='Largest Hamming distance between duplicates')
+    parser.add_argument('--max-distance', type=float, default=0.3, help='Largest histogram distance between duplicates')
+    parser.add_argument('--output', default='', help='JSON file of the clusters')
+    arguments = parser.parse_args()
+
+    # Set the logging level and format
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    qbe = QBE(arguments.db_path, arguments.descriptors_path)
+    duplicates: dict = qbe.find_duplicates(
+        arguments.hashes, arguments.histograms or None, arguments.metric, arguments.max_hamming, arguments.max_distance
+    )
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(duplicates, file, indent=2)
+    else:
+        print(json.dumps(duplicates, indent=2))
@@ -0,0 +1,498 @@
+import inspect
+import json
+import logging
+import numpy as np
+import os
+from .Quantization import Quantizer
+import struct
+
+
+class DescriptorStore:
+    """
+    A class representing a binary descriptor store: the descriptors of every image of a database,
+    stored as a contiguous matrix that can be memory-mapped.
+
+    File layout:
+        - 8 bytes: the magic string b'QBESTORE'.
+        - 8 bytes: the offset of the matrix in the file (little-endian unsigned integer), a multiple of 4096.
+        - The JSON header (descriptor type, dtype, dimension, count, generation, filenames, and the scale and offset
+          of each dimension of uint8 codes), padded with spaces.
+        - The matrix, count x dimension values, row-major. Row i is the descriptor of files[i].
+
+    A compact store holds float16 values or uint8 codes (see Quantization.Quantizer): rows are given and updated as
+    float values, and encoded with the quantizer of the store, fitted when the store is written.
+
+    Attributes:
+        path (str): The path to the store file.
+        descriptor (str): The descriptor type (e.g. 'HistRGB_2x2x2').
+        dtype (np.dtype): The type of the stored values.
+        dim (int): The dimension of the descriptors.
+        count (int): The number of descriptors.
+        generation (int): A counter incremented each time the store is written.
+        files (list[str]): The filename of the image described by each row.
+        quantizer (Quantizer | None): The quantizer of a compact store, None for a store of float values.
+        matrix (np.ndarray): The memory-mapped descriptors matrix (the codes of a compact store).
+        _mode (str): The mode of the memory map, 'r' or 'r+'.
+        _data_offset (int): The offset of the matrix in the file.
+
+    Methods:
+        __init__(self, path: str, mode: str): Opens an existing store.
+        _map(self): Memory-maps the matrix.
+        _header(self): Builds the header of the store.
+        _read_header(path: str): Reads the header of a store file.
+        _header_bytes(header: dict, data_offset: int): Serializes a header.
+        flush(self): Writes the matrix and the header of the store to disk.
+        set_rows(self, rows: np.ndarray, values: np.ndarray): Updates rows in place.
+        append(self, values: np.ndarray, files: list[str]): Appends rows.
+        remove(self, files: list[str]): Removes the rows of some files.
+        truncate(self, count: int): Keeps only the first rows.
+        write(path: str, descriptor: str, matrix: np.ndarray, files: list[str], dtype: str, quantizer: Quantizer | None):
+            Writes a store file.
+        from_text(text_path: str, files_path: str, store_path: str, dtype: str): Converts a text descriptor file to
+            a store.
+
+    Rows are updated in place. Appended rows are written after the matrix and only become part of the store once
+    the header, written last, records them: an interrupted append leaves the previous store untouched. Removing rows
+    rewrites the store next to it then moves it, keeping the order of the other rows.
+
+    The files list of the store is the source of truth for its row order: appended images follow the rows of the
+    previous runs, whatever their place in the list of database files.
+    """
+
+    MAGIC: bytes = b'QBESTORE'
+    EXTENSION: str = '.store'
+    ALIGNMENT: int = 4096
+    FORMAT_VERSION: int = 1
+
+    path: str
+    descriptor: str
+    dtype: np.dtype
+    dim: int
+    count: int
+    generation: int
+    files: list[str]
+    quantizer: Quantizer | None
+    matrix: np.ndarray
+    _mode: str
+    _data_offset: int
+
+    def __init__(self, path: str, mode: str = 'r'):
+        """
+        Opens an existing store and memory-maps its matrix.
+
+        Args:
+            path (str): The path to the store file.
+            mode (str): 'r' to open the matrix read-only, 'r+' to update its rows in place.
+        """
+
+        self.path = path
+        self._mode = mode
+
+        # Read the header
+        header: dict
+        header, self._data_offset = self._read_header(path)
+
+        self.descriptor = header['descriptor']
+        self.dtype = np.dtype(header['dtype'])
+        self.dim = header['dim']
+        self.count = header['count']
+        self.generation = header['generation']
+        self.files = header['files']
+        self.quantizer = Quantizer.from_header(header)
+
+        # Memory-map the matrix
+        self._map()
+
+    def _map(self):
+        """
+        Memory-maps the matrix of the store, according to its current count.
+        """
+
+        # A memory map cannot be empty
+        if self.count == 0:
+            self.matrix = np.empty((0, self.dim), dtype=self.dtype)
+        else:
+            self.matrix = np.memmap(
+                self.path,
+                dtype=self.dtype,
+                mode=self._mode,
+                offset=self._data_offset,
+                shape=(self.count, self.dim)
+            )
+
+    def _header(self) -> dict:
+        """
+        Builds the header of the store.
+
+        Returns:
+            dict: The header describing the current state of the store.
+        """
+
+        return {
+            'format': DescriptorStore.FORMAT_VERSION,
+            'descriptor': self.descriptor,
+            'dtype': self.dtype.name,
+            'dim': self.dim,
+            'count': self.count,
+            'generation': self.generation,
+            'files': self.files,
+            **(self.quantizer.to_header() if self.quantizer is not None else {})
+        }
+
+    @staticmethod
+    def _read_header(path: str) -> tuple[dict, int]:
+        """
+        Reads the header of a store file.
+
+        Args:
+            path (str): The path to the store file.
+
+        Returns:
+            tuple[dict, int]: The decoded JSON header and the offset of the matrix in the file.
+        """
+
+        with open(path, 'rb') as file:
+            # Check the magic string
+            if file.read(len(DescriptorStore.MAGIC)) != DescriptorStore.MAGIC:
+                raise ValueError(f'{path} is not a descriptor store')
+
+            # Read the offset of the matrix, then the JSON header that precedes it
+            data_offset: int = struct.unpack('<Q', file.read(8))[0]
+            header: dict = json.loads(file.read(data_offset - 16).decode('utf-8'))
+
+        return header, data_offset
+
+    @staticmethod
+    def _header_bytes(header: dict, data_offset: int = 0) -> bytes:
+        """
+        Serializes a header, padded up to the matrix offset.
+
+        Args:
+            header (dict): The header to serialize.
+            data_offset (int): The offset of the matrix. 0 computes an offset leaving room for the header to grow.
+
+        Returns:
+            bytes: The serialized header, data_offset bytes long.
+        """
+
+        # Encode the JSON header
+        encoded: bytes = json.dumps(header).encode('utf-8')
+
+        # Leave room for the header to double in size, rounded up to the alignment
+        if data_offset == 0:
+            data_offset = -(-(16 + 2 * len(encoded)) // DescriptorStore.ALIGNMENT) * DescriptorStore.ALIGNMENT
+
+        # Check that the header fits before the matrix
+        if 16 + len(encoded) > data_offset:
+            raise ValueError('The header does not fit before the matrix')
+
+        # Pad the header with spaces, ignored by the JSON decoder
+        return DescriptorStore.MAGIC + struct.pack('<Q', data_offset) + encoded.ljust(data_offset - 16, b' ')
+
+    def flush(self):
+        """
+        Writes the matrix and the header of the store to disk, incrementing its generation.
+        The header is rewritten in place, or the whole store is rewritten if the header outgrew its space.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Write the updated rows to disk before the header that references them
+        if isinstance(self.matrix, np.memmap):
+            self.matrix.flush()
+
+        self.generation += 1
+
+        try:
+            # Rewrite the header in place
+            header_bytes: bytes = self._header_bytes(self._header(), self._data_offset)
+            with open(self.path, 'r+b') as file:
+                file.write(header_bytes)
+                file.flush()
+                os.fsync(file.fileno())
+
+        except ValueError:
+            # The header does not fit before the matrix anymore: rewrite the whole store with more room
+            DescriptorStore.write(
+                self.path, self.descriptor, self._decode(self.matrix), self.files, self.dtype.name, self.quantizer
+            )
+            self._data_offset = self._read_header(self.path)[1]
+            self._map()
+
+    def _encode(self, values: np.ndarray) -> np.ndarray:
+        """
+        Converts descriptors to the stored type, encoding them with the quantizer of a compact store.
+
+        Args:
+            values (np.ndarray): The descriptors.
+
+        Returns:
+            np.ndarray: The stored values.
+        """
+
+        if self.quantizer is not None:
+            return self.quantizer.encode(values)
+
+        return np.asarray(values, dtype=self.dtype)
+
+    def _decode(self, values: np.ndarray) -> np.ndarray:
+        """
+        Reads stored values as descriptors, decoding the codes of a compact store.
+
+        Args:
+            values (np.ndarray): The stored values.
+
+        Returns:
+            np.ndarray: The descriptors, in memory.
+        """
+
+        if self.quantizer is not None:
+            return self.quantizer.decode(values)
+
+        return np.array(values)
+
+    def set_rows(self, rows: np.ndarray, values: np.ndarray):
+        """
+        Updates rows of the store in place. The store must be opened in 'r+' mode.
+
+        Args:
+            rows (np.ndarray): The indices of the rows to update.
+            values (np.ndarray): The new values, one row per index.
+        """
+
+        self.matrix[rows] = self._encode(np.asarray(values).reshape(len(rows), self.dim))
+
+    def append(self, values: np.ndarray, files: list[str]):
+        """
+        Appends rows to the store and flushes it.
+
+        Args:
+            values (np.ndarray): The new descriptors, one row per file.
+            files (list[str]): The filename of the image described by each new row.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        values = np.ascontiguousarray(self._encode(np.asarray(values).reshape(len(files), self.dim)))
+
+        # Write the new rows right after the current ones
+        with open(self.path, 'r+b') as file:
+            file.seek(self._data_offset + self.count * self.dim * self.dtype.itemsize)
+            file.write(values.tobytes())
+            file.truncate()
+            file.flush()
+            os.fsync(file.fileno())
+
+        # Record the new rows in the header
+        self.count += len(files)
+        self.files = self.files + list(files)
+        self._map()
+        self.flush()
+
+    def remove(self, files: list[str]):
+        """
+        Removes the rows of some files, keeping the order of the other rows, and increments the generation. The
+        kept rows are copied block by block to a file next to the store, which then replaces it: an interrupted
+        removal leaves the previous store untouched.
+
+        Args:
+            files (list[str]): The filenames whose rows are removed.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        removed: set[str] = set(files)
+        kept: np.ndarray = np.array(
+            [row for row, filename in enumerate(self.files) if filename not in removed], dtype=np.intp
+        )
+        if kept.size == self.count:
+            return
+
+        # Write the rows to disk before copying them
+        if isinstance(self.matrix, np.memmap):
+            self.matrix.flush()
+
+        header: dict = self._header()
+        header['count'] = int(kept.size)
+        header['generation'] = self.generation + 1
+        header['files'] = [self.files[row] for row in kept]
+
+        # Copy the kept rows, by blocks of about 64 MiB, to a temporary file, then replace the store with it
+        block_rows: int = max(1, (64 << 20) // max(1, self.dim * self.dtype.itemsize))
+        temporary_path: str = f'{self.path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(self._header_bytes(header))
+            for start in range(0, kept.size, block_rows):
+                file.write(np.ascontiguousarray(self.matrix[kept[start:start + block_rows]]).tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+        self.count = header['count']
+        self.generation = header['generation']
+        self.files = header['files']
+        self._data_offset = self._read_header(self.path)[1]
+        self._map()
+
+    def truncate(self, count: int, files: list[str] | None = None):
+        """
+        Keeps only the first rows of the store and flushes it.
+
+        Args:
+            count (int): The number of rows to keep.
+            files (list[str] | None): The filenames of the kept rows. Defaults to the first filenames of the store.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Write the kept rows to disk before shrinking the memory map
+        if isinstance(self.matrix, np.memmap):
+            self.matrix.flush()
+
+        self.count = count
+        self.files = list(files) if files is not None else self.files[:count]
+        self._map()
+        self.flush()
+
+        # Drop the rows past the end of the matrix
+        with open(self.path, 'r+b') as file:
+            file.truncate(self._data_offset + self.count * self.dim * self.dtype.itemsize)
+
+    @staticmethod
+    def write(
+            path: str,
+            descriptor: str,
+            matrix: np.ndarray,
+            files: list[str],
+            dtype: str = 'float32',
+            quantizer: Quantizer | None = None
+            ):
+        """
+        Writes a store file. The file is written next to its destination then moved, so that a reader never sees
+        a partially written store.
+
+        Args:
+            path (str): The path to the store file.
+            descriptor (str): The descriptor type.
+            matrix (np.ndarray): The descriptors, one row per file.
+            files (list[str]): The filename of the image described by each row.
+            dtype (str): The type of the stored values: float32, float64, or the compact float16 and uint8.
+            quantizer (Quantizer | None): The quantizer of a compact store, None to fit it on the matrix.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Convert the matrix to a 2D array
+        matrix = np.asarray(matrix)
+        if matrix.ndim != 2:
+            matrix = matrix.reshape(len(files), -1)
+
+        # Encode a compact matrix, or convert it to the stored type
+        extra: dict = {}
+        if dtype in Quantizer.DTYPES:
+            if quantizer is None:
+                quantizer = Quantizer.fit(matrix, dtype)
+            matrix = quantizer.encode(matrix)
+            extra = quantizer.to_header()
+        matrix = np.ascontiguousarray(matrix, dtype=dtype)
+
+        # Keep counting the generations of a store that is overwritten
+        generation: int = 0
+        if os.path.exists(path):
+            try:
+                generation = DescriptorStore._read_header(path)[0]['generation'] + 1
+            except (ValueError, KeyError):
+                pass
+
+        # Build the header
+        header: dict = {
+            'format': DescriptorStore.FORMAT_VERSION,
+            'descriptor': descriptor,
+            'dtype': matrix.dtype.name,
+            'dim': matrix.shape[1],
+            'count': matrix.shape[0],
+            'generation': generation,
+            'files': list(files),
+            **extra
+        }
+
+        # Write the header and the matrix to a temporary file, then replace the store with it
+        temporary_path: str = f'{path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(DescriptorStore._header_bytes(header))
+            file.write(matrix.tobytes())
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def from_text(text_path: str, files_path: str, store_path: str = '', dtype: str = 'float32'):
+        """
+        Converts a text descriptor file (one descriptor per line, values separated by spaces) to a store.
+
+        Args:
+            text_path (str): The path to the text descriptor file.
+            files_path (str): The path to the file listing the database files, in the order of the descriptors.
+            store_path (str): The path to the store file. Defaults to the text file path, without its '.txt'
+                extension, followed by the store extension.
+            dtype (str): The type of the stored values (see write()).
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Default store path
+        if store_path == '':
+            store_path = text_path.removesuffix('.txt') + DescriptorStore.EXTENSION
+
+        # The descriptor type is the last dotted part of the file name (e.g. Base10000.HistGREY_16)
+        descriptor: str = os.path.basename(text_path).removesuffix('.txt').split('.')[-1]
+
+        # Read the list of database files
+        with open(files_path, 'r') as file:
+            files: list[str] = [line.strip('\n') for line in file if line.strip('\n')]
+
+        # Parse every value at once
+        matrix: np.ndarray = np.loadtxt(text_path, dtype=np.float64, ndmin=2)
+
+        # Check that there is one descriptor per file
+        if matrix.shape[0] != len(files):
+            raise ValueError(f'{text_path} holds {matrix.shape[0]} descriptors for {len(files)} files')
+
+        # Write the store
+        DescriptorStore.write(store_path, descriptor, matrix, files, dtype)
+
+        # Logging information
+        logging.info(f'{text_path} converted to {store_path} ({matrix.shape[0]} x {matrix.shape[1]})')
+
+
+def convert_text_descriptors(folder: str, files_path: str):
+    """
+    Converts every text descriptor file of a folder to a store, e.g. Base10000_descriptors/* or
+    Base10000/histograms/*.txt. Stores, the list of files and the description file are skipped.
+
+    Args:
+        folder (str): The folder holding the text descriptor files.
+        files_path (str): The path to the file listing the database files, in the order of the descriptors.
+    """
+
+    # Debugging information
+    logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+    # Iterate over each descriptor file of the folder
+    for filename in sorted(os.listdir(folder)):
+        path: str = os.path.join(folder, filename)
+
+        # Skip the folders, the stores, the list of files and the description file
+        if (
+            not os.path.isfile(path)
+            or filename.endswith(DescriptorStore.EXTENSION)
+            or os.path.abspath(path) == os.path.abspath(files_path)
+            or filename in ('Base10000_files.txt', 'Description.txt')
+        ):
+            continue
+
+        DescriptorStore.from_text(path, files_path)
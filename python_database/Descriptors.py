@@ -0,0 +1,580 @@
+import numpy as np
+from PIL import Image
+import re
+
+
+class Features:
+    """
+    A class representing the pixels of a decoded image and the intermediates shared by the extractors: the integer
+    luma, the bin index of each pixel for a number of RGB bins, the HSV values, the Sobel gradients, the LBP codes
+    and the histogram of each channel. Each intermediate is computed on first use and kept, so that the extractors of
+    one image share them: its cost is measured with the first extractor that needs it.
+
+    The pixels stay uint8 and the intermediates are integers where possible, like the histograms of JPicture.
+
+    Attributes:
+        pixels (np.ndarray): The (height, width, 3) uint8 RGB values.
+        _cache (dict): The intermediates computed so far, by name.
+
+    Methods:
+        __init__(self, pixels: np.ndarray): Initializes the Features object.
+        luma_sums(self): Returns the scaled integer luma of every pixel.
+        luma(self): Returns the 8-bit luma of every pixel.
+        rgb_indices(self, nbins: int): Returns the flat RGB bin index of every pixel.
+        hsv(self): Returns the 8-bit HSV values of every pixel.
+        gradients(self): Returns the Sobel gradients of the luma.
+        lbp(self): Returns the local binary pattern code of every pixel.
+        channel_counts(self): Returns the histogram of the 256 values of each channel.
+        luma_thumbnail(self, width: int, height: int): Returns the luma reduced to a few pixels.
+    """
+
+    # Scale of the integer luma: 299 R + 587 G + 114 B is 1000 times the luma of 8-bit pixels
+    LUMA_WEIGHTS: tuple[int, int, int] = (299, 587, 114)
+    LUMA_SCALE: int = 1000 * 255
+
+    pixels: np.ndarray
+    _cache: dict
+
+    def __init__(self, pixels: np.ndarray):
+        """
+        Initializes the Features object.
+
+        Args:
+            pixels (np.ndarray): The (height, width, 3) uint8 RGB values.
+        """
+
+        self.pixels = pixels
+        self._cache = {}
+
+    def luma_sums(self) -> np.ndarray:
+        """
+        Returns the scaled integer luma of every pixel, 299 R + 587 G + 114 B.
+
+        Returns:
+            np.ndarray: The uint32 luma of each pixel, between 0 and LUMA_SCALE.
+        """
+
+        if 'luma_sums' not in self._cache:
+            # Widen the channels before the products: NumPy 1.x keeps the uint8 x scalar products in 16 bits
+            sums: np.ndarray = self.pixels[:, :, 0].astype(np.uint32) * np.uint32(self.LUMA_WEIGHTS[0])
+            sums += self.pixels[:, :, 1].astype(np.uint32) * np.uint32(self.LUMA_WEIGHTS[1])
+            sums += self.pixels[:, :, 2].astype(np.uint32) * np.uint32(self.LUMA_WEIGHTS[2])
+            self._cache['luma_sums'] = sums
+
+        return self._cache['luma_sums']
+
+    def luma(self) -> np.ndarray:
+        """
+        Returns the 8-bit luma of every pixel, rounded down.
+
+        Returns:
+            np.ndarray: The (height, width) uint8 luma.
+        """
+
+        if 'luma' not in self._cache:
+            self._cache['luma'] = (self.luma_sums() // np.uint32(1000)).astype(np.uint8)
+
+        return self._cache['luma']
+
+    def rgb_indices(self, nbins: int) -> np.ndarray:
+        """
+        Returns the flat RGB bin index of every pixel (row-major, like bins[red, green, blue]), each channel binned
+        like its normalized value.
+
+        Args:
+            nbins (int): The number of bins per channel.
+
+        Returns:
+            np.ndarray: The (height, width) bin indices.
+        """
+
+        key: tuple[str, int] = ('rgb_indices', nbins)
+        if key not in self._cache:
+            red, green, blue = rgb_tables(nbins)
+            indices: np.ndarray = red[self.pixels[:, :, 0]]
+            indices += green[self.pixels[:, :, 1]]
+            indices += blue[self.pixels[:, :, 2]]
+            self._cache[key] = indices
+
+        return self._cache[key]
+
+    def hsv(self) -> np.ndarray:
+        """
+        Returns the HSV values of every pixel, each component on 8 bits (hue 0 to 255 for 0 to 360 degrees).
+
+        Returns:
+            np.ndarray: The (height, width, 3) uint8 HSV values.
+        """
+
+        if 'hsv' not in self._cache:
+            self._cache['hsv'] = np.asarray(Image.fromarray(self.pixels, 'RGB').convert('HSV'))
+
+        return self._cache['hsv']
+
+    def gradients(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the Sobel gradients of the luma, on the pixels that have 8 neighbours.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (height - 2, width - 2) int32 horizontal and vertical gradients.
+        """
+
+        if 'gradients' not in self._cache:
+            luma: np.ndarray = self.luma().astype(np.int32)
+
+            # Column and row differences, smoothed across with the 1 2 1 weights
+            columns: np.ndarray = luma[:, 2:] - luma[:, :-2]
+            rows: np.ndarray = luma[2:, :] - luma[:-2, :]
+            horizontal: np.ndarray = columns[:-2] + 2 * columns[1:-1] + columns[2:]
+            vertical: np.ndarray = rows[:, :-2] + 2 * rows[:, 1:-1] + rows[:, 2:]
+            self._cache['gradients'] = (horizontal, vertical)
+
+        return self._cache['gradients']
+
+    def lbp(self) -> np.ndarray:
+        """
+        Returns the local binary pattern code of every pixel that has 8 neighbours: bit i is set if the i-th
+        neighbour (clockwise from the top left one) is at least as bright as the pixel.
+
+        Returns:
+            np.ndarray: The (height - 2, width - 2) uint8 codes.
+        """
+
+        if 'lbp' not in self._cache:
+            luma: np.ndarray = self.luma()
+            height, width = luma.shape
+            center: np.ndarray = luma[1:-1, 1:-1]
+            codes: np.ndarray = np.zeros(center.shape, dtype=np.uint8)
+            for bit, (row, column) in enumerate(((0, 0), (0, 1), (0, 2), (1, 2), (2, 2), (2, 1), (2, 0), (1, 0))):
+                neighbours: np.ndarray = luma[row:row + height - 2, column:column + width - 2]
+                codes |= (neighbours >= center).astype(np.uint8) << np.uint8(bit)
+            self._cache['lbp'] = codes
+
+        return self._cache['lbp']
+
+    def channel_counts(self) -> np.ndarray:
+        """
+        Returns the histogram of the 256 values of each channel.
+
+        Returns:
+            np.ndarray: The (3, 256) pixel counts.
+        """
+
+        if 'channel_counts' not in self._cache:
+            self._cache['channel_counts'] = np.stack([
+                np.bincount(self.pixels[:, :, channel].ravel(), minlength=256) for channel in range(3)
+            ])
+
+        return self._cache['channel_counts']
+
+    def luma_thumbnail(self, width: int, height: int) -> np.ndarray:
+        """
+        Returns the luma reduced to a few pixels, each the mean of the pixels it covers, as used by the perceptual
+        hashes.
+
+        Args:
+            width (int): The width of the thumbnail.
+            height (int): The height of the thumbnail.
+
+        Returns:
+            np.ndarray: The (height, width) float32 luma.
+        """
+
+        key: tuple[str, int, int] = ('luma_thumbnail', width, height)
+        if key not in self._cache:
+            thumbnail: Image.Image = Image.fromarray(self.luma(), 'L').convert('F').resize((width, height), Image.Resampling.BOX)
+            self._cache[key] = np.asarray(thumbnail)
+
+        return self._cache[key]
+
+
+# Lookup tables of the RGB bin indices, by number of bins per channel
+_RGB_TABLES: dict[int, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+
+def quantize(values: np.ndarray, nbins: int) -> np.ndarray:
+    """
+    Computes the bin index of every value of a normalized array.
+
+    Args:
+        values (np.ndarray): The normalized values, in [0, 1].
+        nbins (int): The number of bins.
+
+    Returns:
+        np.ndarray: The bin indices, with the same shape as the input array.
+    """
+
+    # Calculate the bin index of each value with the same floor division as a scalar `value // step`
+    indices: np.ndarray = np.floor_divide(values, 1 / nbins).astype(np.intp)
+
+    # If the value is the maximum possible value, put it in the last bin
+    np.minimum(indices, nbins - 1, out=indices)
+
+    return indices
+
+
+def rgb_tables(nbins: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the lookup tables of the red, green and blue parts of the flat RGB bin index: the bin of each 8-bit
+    value, as computed on the normalized value, premultiplied by the place of its channel.
+
+    Args:
+        nbins (int): The number of bins per channel.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The tables of the red, green and blue channels.
+    """
+
+    if nbins not in _RGB_TABLES:
+        table_type: type = np.uint16 if nbins ** 3 <= 1 << 16 else np.uint32
+        bins: np.ndarray = quantize(np.arange(256) / 255, nbins).astype(table_type)
+        _RGB_TABLES[nbins] = (bins * (nbins * nbins), bins * nbins, bins)
+
+    return _RGB_TABLES[nbins]
+
+
+def _normalized_counts(indices: np.ndarray, length: int, weights: np.ndarray | None = None) -> np.ndarray:
+    """
+    Counts the values falling in each bin, normalized by their total (zeros for an empty image).
+
+    Args:
+        indices (np.ndarray): The bin index of each value.
+        length (int): The number of bins.
+        weights (np.ndarray | None): The weight of each value, None for a count.
+
+    Returns:
+        np.ndarray: The normalized histogram.
+    """
+
+    counts: np.ndarray = np.bincount(indices.ravel(), None if weights is None else weights.ravel(), minlength=length)
+    total: float = float(counts.sum())
+
+    return counts / total if total > 0 else counts.astype(np.float64)
+
+
+class Extractor:
+    """
+    Base class of the descriptors computed from an image: each extractor computes its descriptor from the shared
+    intermediates of a decoded image (see Features), with vectorized operations over the pixels.
+
+    Extractors are named after their descriptor file type (e.g. HistRGB_6x6x6): the name pattern of each extractor
+    class gives its parameters.
+
+    Attributes:
+        PATTERN (re.Pattern): The pattern of the names of the extractor class, whose groups are its parameters.
+        version (int): The version of the computation, to increment when it changes (the indexing then describes
+            the images again).
+        name (str): The name of the descriptor.
+
+    Methods:
+        __init__(self, name: str): Initializes the extractor.
+        dimension(self): Returns the number of values of the descriptor.
+        extract(self, features: Features): Computes the descriptor of an image.
+    """
+
+    PATTERN: re.Pattern = re.compile('')
+    version: int = 1
+
+    name: str
+
+    def __init__(self, name: str):
+        """
+        Initializes the extractor.
+
+        Args:
+            name (str): The name of the descriptor, matching PATTERN.
+        """
+
+        self.name = name
+
+    def dimension(self) -> int:
+        """
+        Returns the number of values of the descriptor.
+
+        Returns:
+            int: The dimension.
+        """
+
+        raise NotImplementedError
+
+    def extract(self, features: Features) -> np.ndarray:
+        """
+        Computes the descriptor of an image.
+
+        Args:
+            features (Features): The pixels of the image and their shared intermediates.
+
+        Returns:
+            np.ndarray: The flat float64 descriptor.
+        """
+
+        raise NotImplementedError
+
+
+class GrayHistogram(Extractor):
+    """
+    Luma histogram (HistGRAY_256, HistGREY_16...), normalized by the number of pixels. The bin of a pixel is an
+    integer division of its integer luma: the few pixels whose luma falls exactly on a bin boundary are binned with
+    the float formula on the normalized pixels, whose rounding may put them in the lower bin.
+    """
+
+    PATTERN = re.compile(r'HistGR[AE]Y_(\d+)')
+    # Version 2: the luma of version 1 wrapped around under NumPy 1.x
+    version = 2
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.nbins = int(self.PATTERN.fullmatch(name).group(1))
+
+    def dimension(self):
+        return self.nbins
+
+    def extract(self, features):
+        # Bin of each pixel: floor(luma x nbins), the product being exact in integers
+        nbins: int = self.nbins
+        scaled: np.ndarray = features.luma_sums().ravel() * (np.uint32(nbins) if nbins * Features.LUMA_SCALE < 1 << 32 else np.uint64(nbins))
+        indices: np.ndarray
+        remainders: np.ndarray
+        indices, remainders = np.divmod(scaled, Features.LUMA_SCALE)
+        np.minimum(indices, nbins - 1, out=indices)
+
+        # A luma exactly on a bin boundary is binned like the float luma, rounded on either side of the boundary
+        boundary: np.ndarray = np.flatnonzero(remainders == 0)
+        if boundary.size:
+            pixels: np.ndarray = features.pixels.reshape(-1, 3)[boundary] / 255
+            indices[boundary] = quantize(np.array(0.299 * pixels[:, 0] + 0.587 * pixels[:, 1] + 0.114 * pixels[:, 2]), nbins)
+
+        # Count the pixels falling in each bin, and normalize by the number of pixels
+        return np.bincount(indices, minlength=nbins) / indices.size
+
+
+class RGBHistogram(Extractor):
+    """
+    Joint RGB histogram (HistRGB_6x6x6...), flattened row-major like bins[red, green, blue] and normalized by the
+    number of pixels.
+    """
+
+    PATTERN = re.compile(r'HistRGB_(\d+)x\1x\1')
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.nbins = int(self.PATTERN.fullmatch(name).group(1))
+
+    def dimension(self):
+        return self.nbins ** 3
+
+    def extract(self, features):
+        indices: np.ndarray = features.rgb_indices(self.nbins)
+        return np.bincount(indices.ravel(), minlength=self.nbins ** 3) / indices.size
+
+
+class HSVHistogram(Extractor):
+    """
+    Joint HSV histogram (HistHSV_8x3x3: 8 hue, 3 saturation and 3 value bins), flattened row-major and normalized by
+    the number of pixels.
+    """
+
+    PATTERN = re.compile(r'HistHSV_(\d+)x(\d+)x(\d+)')
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.nbins = tuple(int(group) for group in self.PATTERN.fullmatch(name).groups())
+
+    def dimension(self):
+        return self.nbins[0] * self.nbins[1] * self.nbins[2]
+
+    def extract(self, features):
+        hsv: np.ndarray = features.hsv()
+
+        # Bin of each component: floor(value x nbins / 256), in integers
+        indices: np.ndarray = (hsv[:, :, 0].astype(np.uint32) * self.nbins[0]) >> 8
+        for channel in (1, 2):
+            indices *= self.nbins[channel]
+            indices += (hsv[:, :, channel].astype(np.uint32) * self.nbins[channel]) >> 8
+
+        return np.bincount(indices.ravel(), minlength=self.dimension()) / indices.size
+
+
+class ColorMoments(Extractor):
+    """
+    Colour moments (ColorMoments): the mean, the standard deviation and the cube root of the third central moment of
+    each normalized RGB channel, computed from the histogram of the 256 values of the channel.
+    """
+
+    PATTERN = re.compile(r'ColorMoments')
+
+    def dimension(self):
+        return 9
+
+    def extract(self, features):
+        counts: np.ndarray = features.channel_counts().astype(np.float64)
+        total: np.ndarray = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+        values: np.ndarray = np.arange(256) / 255
+
+        mean: np.ndarray = (counts * values).sum(axis=1, keepdims=True) / total
+        deviations: np.ndarray = values - mean
+        variance: np.ndarray = (counts * deviations ** 2).sum(axis=1) / total[:, 0]
+        skewness: np.ndarray = np.cbrt((counts * deviations ** 3).sum(axis=1) / total[:, 0])
+
+        return np.concatenate((mean[:, 0], np.sqrt(variance), skewness))
+
+
+class LBPHistogram(Extractor):
+    """
+    Texture histogram of the 256 local binary pattern codes of the luma (LBP_256), normalized by the number of
+    pixels with 8 neighbours.
+    """
+
+    PATTERN = re.compile(r'LBP_256')
+    # Version 2: the luma of version 1 wrapped around under NumPy 1.x
+    version = 2
+
+    def dimension(self):
+        return 256
+
+    def extract(self, features):
+        return _normalized_counts(features.lbp(), 256)
+
+
+class EdgeOrientation(Extractor):
+    """
+    Edge orientation histogram (EdgeHist_8...): the Sobel gradient orientations of the luma, modulo 180 degrees,
+    weighted by the gradient magnitude and normalized by the total magnitude.
+    """
+
+    PATTERN = re.compile(r'EdgeHist_(\d+)')
+    # Version 2: the luma of version 1 wrapped around under NumPy 1.x
+    version = 2
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.nbins = int(self.PATTERN.fullmatch(name).group(1))
+
+    def dimension(self):
+        return self.nbins
+
+    def extract(self, features):
+        horizontal, vertical = features.gradients()
+        magnitudes: np.ndarray = np.hypot(horizontal, vertical)
+        orientations: np.ndarray = np.arctan2(vertical, horizontal) % np.pi
+        indices: np.ndarray = np.minimum((orientations * (self.nbins / np.pi)).astype(np.intp), self.nbins - 1)
+
+        return _normalized_counts(indices, self.nbins, magnitudes)
+
+
+class GridRGBHistogram(Extractor):
+    """
+    Spatial grid of RGB histograms (GridRGB_4x4_2: a 4 x 4 grid of RGB 2x2x2 histograms), each normalized by the
+    number of pixels of its cell, concatenated cell by cell in row-major order.
+    """
+
+    PATTERN = re.compile(r'GridRGB_(\d+)x(\d+)_(\d+)')
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.rows, self.columns, self.nbins = (int(group) for group in self.PATTERN.fullmatch(name).groups())
+
+    def dimension(self):
+        return self.rows * self.columns * self.nbins ** 3
+
+    def extract(self, features):
+        height, width = features.pixels.shape[:2]
+        bins: int = self.nbins ** 3
+
+        # Cell of each pixel, then bin of each pixel in the histograms of every cell
+        cells: np.ndarray = (
+            (np.arange(height) * self.rows // max(height, 1))[:, np.newaxis] * self.columns
+            + (np.arange(width) * self.columns // max(width, 1))[np.newaxis, :]
+        )
+        counts: np.ndarray = np.bincount(
+            (cells * bins + features.rgb_indices(self.nbins)).ravel(), minlength=self.dimension()
+        ).reshape(-1, bins).astype(np.float64)
+
+        totals: np.ndarray = counts.sum(axis=1, keepdims=True)
+        return (counts / np.maximum(totals, 1)).ravel()
+
+
+class DHash(Extractor):
+    """
+    Difference hash (DHash_8: 64 bits): the luma is reduced to (n + 1) x n pixels, and each bit tells whether a
+    pixel is brighter than its right neighbour. The bits are stored as 0 and 1 values, so that the L1 distance
+    between two hashes is their Hamming distance (see Dedup.DuplicateFinder).
+    """
+
+    PATTERN = re.compile(r'DHash_(\d+)')
+    # Version 2: the luma of version 1 wrapped around under NumPy 1.x
+    version = 2
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.size = int(self.PATTERN.fullmatch(name).group(1))
+
+    def dimension(self):
+        return self.size * self.size
+
+    def extract(self, features):
+        thumbnail: np.ndarray = features.luma_thumbnail(self.size + 1, self.size)
+        return (thumbnail[:, :-1] > thumbnail[:, 1:]).ravel().astype(np.float64)
+
+
+class PHash(Extractor):
+    """
+    DCT perceptual hash (PHash_8: 64 bits): the luma is reduced to 4n x 4n pixels, and each bit tells whether a low
+    frequency DCT coefficient of the n x n top left ones is above their median (the constant term left out of the
+    median). The bits are stored as 0 and 1 values, like DHash.
+    """
+
+    PATTERN = re.compile(r'PHash_(\d+)')
+    # Version 2: the luma of version 1 wrapped around under NumPy 1.x
+    version = 2
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.size = int(self.PATTERN.fullmatch(name).group(1))
+
+        # Rows of the DCT-II basis of the low frequencies, over 4n samples
+        samples: int = 4 * self.size
+        self._basis = np.cos(np.pi * np.outer(np.arange(self.size), 2 * np.arange(samples) + 1) / (2 * samples))
+
+    def dimension(self):
+        return self.size * self.size
+
+    def extract(self, features):
+        thumbnail: np.ndarray = features.luma_thumbnail(4 * self.size, 4 * self.size)
+        coefficients: np.ndarray = (self._basis @ thumbnail @ self._basis.T).ravel()
+        return (coefficients > np.median(coefficients[1:])).astype(np.float64)
+
+
+# Extractor classes of the registry, tried in order on a descriptor name
+EXTRACTORS: tuple[type, ...] = (
+    GrayHistogram, RGBHistogram, HSVHistogram, ColorMoments, LBPHistogram, EdgeOrientation, GridRGBHistogram, DHash,
+    PHash
+)
+
+# Extractors created so far, by name
+_extractors: dict[str, Extractor] = {}
+
+
+def get_extractor(name: str) -> Extractor:
+    """
+    Returns the extractor of a descriptor of the registry.
+
+    Args:
+        name (str): The name of the descriptor (e.g. HistRGB_6x6x6, HistHSV_8x3x3, LBP_256, GridRGB_4x4_2).
+
+    Returns:
+        Extractor: The extractor.
+    """
+
+    if name not in _extractors:
+        for extractor in EXTRACTORS:
+            if extractor.PATTERN.fullmatch(name):
+                _extractors[name] = extractor(name)
+                break
+        else:
+            raise ValueError(
+                f'Unknown descriptor {name}, available descriptors: '
+                f'{", ".join(extractor.PATTERN.pattern for extractor in EXTRACTORS)}'
+            )
+
+    return _extractors[name]
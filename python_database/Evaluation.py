@@ -0,0 +1,400 @@
+import argparse
+import inspect
+import json
+import logging
+import numpy as np
+import os
+from .QBE import QBE
+from .Quantization import Quantizer
+from .SearchEngine import SearchEngine
+import time
+
+
+class Evaluation:
+    """
+    A class representing the evaluation of the retrieval quality and latency of a descriptor and a metric, against
+    the ground truth of the database: the labelled categories of VT_files.txt (the images of one category per line)
+    named by the lines of VT_description.txt.
+
+    Every labelled image is used as a query against the whole database, the image itself excluded, and the other
+    images of its category are the relevant results. The rankings are computed with the batched distance kernels,
+    a tile of queries against every row at once, and give the mean average precision (over the full ranking),
+    precision@k and recall@k per category and overall. The per-query latency is measured separately with
+    single-query searches, as answered by request().
+
+    Attributes:
+        qbe (QBE): The QBE object loading the descriptors.
+        categories (list[str]): The names of the categories.
+        category_files (list[list[str]]): The filenames of the images of each category.
+
+    Methods:
+        __init__(self, qbe: QBE, ground_truth_path: str | None): Loads the ground truth.
+        _average_precisions(hits: np.ndarray, relevant: np.ndarray): Computes the average precision of rankings.
+        run(self, descriptor_file_name: str, metric: str, ks: tuple[int, ...], query_tile: int, engine: SearchEngine | None):
+            Runs an evaluation.
+        quantization(self, descriptor_file_name: str, metric: str, dtypes: tuple[str, ...], ks: tuple[int, ...]):
+            Measures the memory saved and the ranking change of compact descriptors.
+        category_report(self, descriptor_file_name: str, category: str, nresults: int, metric: str, workers: int | None):
+            Renders the results pages of every image of a category.
+        save(report: dict, path: str): Writes a report.
+        compare(baseline: dict, report: dict): Compares a report to a baseline report.
+    """
+
+    qbe: QBE
+    categories: list[str]
+    category_files: list[list[str]]
+
+    def __init__(self, qbe: QBE, ground_truth_path: str | None = None):
+        """
+        Loads the ground truth.
+
+        Args:
+            qbe (QBE): The QBE object loading the descriptors.
+            ground_truth_path (str | None): The folder of VT_files.txt and VT_description.txt, None for the database.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        self.qbe = qbe
+        ground_truth_path = ground_truth_path or qbe.db_path
+
+        # One category name per line
+        with open(os.path.join(ground_truth_path, 'VT_description.txt'), 'r') as file:
+            self.categories = [line.strip() for line in file if line.strip()]
+
+        # The filenames of one category per line, in the same order
+        with open(os.path.join(ground_truth_path, 'VT_files.txt'), 'r') as file:
+            self.category_files = [line.split() for line in file if line.strip()]
+
+        if len(self.categories) != len(self.category_files):
+            raise ValueError(f'{len(self.categories)} category names for {len(self.category_files)} categories')
+
+    @staticmethod
+    def _average_precisions(hits: np.ndarray, relevant: np.ndarray) -> np.ndarray:
+        """
+        Computes the average precision of rankings: the mean, over the relevant results, of the precision of the
+        ranking up to each of them.
+
+        Args:
+            hits (np.ndarray): The (queries, rows) relevance of each ranked row, in ranking order.
+            relevant (np.ndarray): The number of relevant rows of each query.
+
+        Returns:
+            np.ndarray: The average precision of each query.
+        """
+
+        precisions: np.ndarray = np.cumsum(hits, axis=1) / np.arange(1, hits.shape[1] + 1)
+        return np.sum(precisions * hits, axis=1) / np.maximum(relevant, 1)
+
+    def run(
+            self,
+            descriptor_file_name: str,
+            metric: str = 'chebyshev',
+            ks: tuple[int, ...] = (10, 30, 100),
+            query_tile: int = 32,
+            engine: SearchEngine | None = None
+            ) -> dict:
+        """
+        Runs every labelled image as a query against a descriptor file and a metric.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            ks (tuple[int, ...]): The cut-offs of the precision and recall.
+            query_tile (int): The number of queries ranked at once.
+            engine (SearchEngine | None): The search engine over the descriptors, None to load the descriptor file.
+
+        Returns:
+            dict: The JSON-serializable report: mAP, precision@k and recall@k overall and per category, and the
+                per-query latency percentiles.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Logging information
+        logging.info(f'Evaluating {descriptor_file_name} ({metric}) on {len(self.categories)} categories...')
+
+        start: float = time.perf_counter()
+        if engine is None:
+            engine = self.qbe.load_engine(descriptor_file_name, metric, resident=True)
+        count: int = engine.matrix.shape[0]
+
+        # Category of each row of the database, -1 for the unlabelled ones
+        labels: np.ndarray = np.full(count, -1, dtype=np.intp)
+        query_rows: list[int] = []
+        missing: int = 0
+        for category, files in enumerate(self.category_files):
+            for filename in files:
+                try:
+                    row: int = engine.row(filename)
+                except ValueError:
+                    missing += 1
+                    continue
+                labels[row] = category
+                query_rows.append(row)
+        if missing:
+            logging.warning(f'{missing} labelled images are not described in {descriptor_file_name}')
+
+        queries: np.ndarray = np.array(query_rows, dtype=np.intp)
+        relevant: np.ndarray = np.bincount(labels[labels >= 0], minlength=len(self.categories))[labels[queries]] - 1
+        ks = tuple(k for k in ks if k < count)
+
+        # Rank the whole database for each tile of queries, ties ordered by row, each query image left out
+        average_precisions: np.ndarray = np.empty(queries.shape[0])
+        hits_at: dict[int, np.ndarray] = {k: np.empty(queries.shape[0]) for k in ks}
+        ranking_start: float = time.perf_counter()
+        for tile_start in range(0, queries.shape[0], query_tile):
+            tile: np.ndarray = queries[tile_start:tile_start + query_tile]
+            block: np.ndarray = engine.block_distances(engine.vectors(tile), 0, count)
+            order: np.ndarray = np.argsort(block, axis=1, kind='stable')
+            order = order[order != tile[:, np.newaxis]].reshape(tile.shape[0], count - 1)
+
+            hits: np.ndarray = labels[order] == labels[tile][:, np.newaxis]
+            tile_stop: int = tile_start + tile.shape[0]
+            average_precisions[tile_start:tile_stop] = self._average_precisions(hits, relevant[tile_start:tile_stop])
+            for k in ks:
+                hits_at[k][tile_start:tile_stop] = hits[:, :k].sum(axis=1)
+        ranking_time: float = time.perf_counter() - ranking_start
+
+        # Latency of single-query searches, like request()
+        latencies: np.ndarray = np.empty(queries.shape[0])
+        for position, row in enumerate(queries):
+            query_start: float = time.perf_counter()
+            engine.search_vector(engine.vectors(row), max(ks, default=1), int(row))
+            latencies[position] = time.perf_counter() - query_start
+
+        def scores(selected: np.ndarray) -> dict[str, float]:
+            values: dict[str, float] = {'map': float(np.mean(average_precisions[selected]))}
+            for k in ks:
+                values[f'precision@{k}'] = float(np.mean(hits_at[k][selected] / k))
+                values[f'recall@{k}'] = float(np.mean(hits_at[k][selected] / np.maximum(relevant[selected], 1)))
+            return values
+
+        query_labels: np.ndarray = labels[queries]
+        report: dict = {
+            'descriptor': descriptor_file_name,
+            'metric': metric,
+            'rows': count,
+            'dim': engine.matrix.shape[1],
+            'queries': int(queries.shape[0]),
+            'overall': scores(np.ones(queries.shape[0], dtype=bool)),
+            'categories': {
+                name: scores(query_labels == category)
+                for category, name in enumerate(self.categories) if np.any(query_labels == category)
+            },
+            'latency_ms': {
+                'mean': float(np.mean(latencies)) * 1000,
+                **{f'p{percentile}': float(np.percentile(latencies, percentile)) * 1000 for percentile in (50, 90, 95, 99)},
+                'max': float(np.max(latencies)) * 1000
+            },
+            'batch_queries_per_s': queries.shape[0] / ranking_time if ranking_time > 0 else 0.0,
+            'elapsed_s': time.perf_counter() - start
+        }
+
+        # Logging information
+        logging.info(f'{descriptor_file_name} ({metric}): mAP {report["overall"]["map"]:.4f}, median latency {report["latency_ms"]["p50"]:.2f} ms')
+
+        return report
+
+    def quantization(
+            self,
+            descriptor_file_name: str,
+            metric: str = 'chebyshev',
+            dtypes: tuple[str, ...] = ('float32', 'float16', 'uint8'),
+            ks: tuple[int, ...] = (10, 30, 100)
+            ) -> dict:
+        """
+        Measures the memory saved by storing the descriptors of a file in more compact types, and the change of the
+        rankings, against the float64 descriptors: the evaluation of each type and its difference to float64, and
+        the mean overlap of the top-k results of each labelled image with its float64 ones.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file, read in float64 (or decoded from its store).
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            dtypes (tuple[str, ...]): The types compared to float64: float32, and the compact float16 and uint8.
+            ks (tuple[int, ...]): The cut-offs of the precision, recall and overlap.
+
+        Returns:
+            dict: The JSON-serializable report: for each type, the size of the matrix and its ratio to float64, the
+                overall scores and latency, their difference to float64, and the top-k overlaps.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        baseline: np.ndarray
+        files: list[str]
+        baseline, files = self.qbe._load_descriptors(descriptor_file_name)
+        baseline = np.array(baseline, dtype=np.float64)
+
+        # The labelled images are the queries of the overlaps
+        reference: SearchEngine = SearchEngine(baseline, files, metric)
+        described: set[str] = set(files)
+        queries: np.ndarray = np.array([
+            reference.row(filename) for category in self.category_files for filename in category if filename in described
+        ], dtype=np.intp)
+        ks = tuple(k for k in ks if k < baseline.shape[0])
+        reference_results: np.ndarray = reference.batch_search(baseline[queries], max(ks, default=1), queries)[0]
+
+        def measure(engine: SearchEngine) -> dict:
+            evaluation: dict = self.run(descriptor_file_name, metric, ks, engine=engine)
+            return {
+                'matrix_bytes': int(engine.matrix.nbytes),
+                'bytes_per_value': engine.matrix.dtype.itemsize,
+                'overall': evaluation['overall'],
+                'latency_ms': evaluation['latency_ms']
+            }
+
+        report: dict = {
+            'descriptor': descriptor_file_name,
+            'metric': metric,
+            'rows': baseline.shape[0],
+            'dim': baseline.shape[1],
+            'queries': int(queries.shape[0]),
+            'dtypes': {'float64': measure(reference)}
+        }
+        float64: dict = report['dtypes']['float64']
+
+        for dtype in dtypes:
+            # Search the codes of the compact types, the other types as they are
+            engine: SearchEngine
+            if dtype in Quantizer.DTYPES:
+                quantizer: Quantizer = Quantizer.fit(baseline, dtype)
+                engine = SearchEngine(quantizer.encode(baseline), files, metric, quantizer)
+            else:
+                engine = SearchEngine(baseline.astype(dtype), files, metric)
+
+            measures: dict = measure(engine)
+            measures['memory_ratio'] = measures['matrix_bytes'] / max(1, float64['matrix_bytes'])
+            measures['difference'] = {name: value - float64['overall'][name] for name, value in measures['overall'].items()}
+
+            # Fraction of the float64 top-k results found in the top-k results of the type
+            results: np.ndarray = engine.batch_search(engine.vectors(queries), max(ks, default=1), queries)[0]
+            measures['overlap'] = {
+                f'@{k}': float(np.mean([
+                    np.intersect1d(found[:k], expected[:k]).size / k for found, expected in zip(results, reference_results)
+                ]))
+                for k in ks
+            }
+            report['dtypes'][dtype] = measures
+
+            # Logging information
+            logging.info(f'{dtype}: {measures["memory_ratio"]:.3f} of the float64 memory, mAP {measures["difference"]["map"]:+.4f}')
+
+        return report
+
+    def category_report(
+            self,
+            descriptor_file_name: str,
+            category: str,
+            nresults: int = 30,
+            metric: str = 'chebyshev',
+            workers: int | None = None
+            ) -> str:
+        """
+        Renders the results pages of every image of a category of the ground truth (see QBE.batch_report()).
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            category (str): The name of the category.
+            nresults (int): Number of results of each page.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            workers (int | None): Number of worker processes, None for every core.
+
+        Returns:
+            str: The path to the index page of the category.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        if category not in self.categories:
+            raise ValueError(f'{category} is not a category of the ground truth')
+        files: list[str] = self.category_files[self.categories.index(category)]
+
+        metric_suffix: str = '' if metric == 'chebyshev' else f'_{metric}'
+        return self.qbe.batch_report(
+            descriptor_file_name, files, nresults, metric, workers,
+            report_name=f'report_{category}_{descriptor_file_name.split(".")[-1]}{metric_suffix}_{nresults}.html'
+        )
+
+    @staticmethod
+    def save(report: dict, path: str):
+        """
+        Writes a report as JSON.
+
+        Args:
+            report (dict): The report.
+            path (str): The path to the JSON file.
+        """
+
+        with open(path, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    @staticmethod
+    def compare(baseline: dict, report: dict) -> dict:
+        """
+        Compares a report to a baseline report, e.g. of the previous version of a descriptor.
+
+        Args:
+            baseline (dict): The baseline report.
+            report (dict): The new report.
+
+        Returns:
+            dict: The difference (new - baseline) of each overall score and latency percentile.
+        """
+
+        return {
+            'overall': {
+                name: value - baseline['overall'][name]
+                for name, value in report['overall'].items() if name in baseline['overall']
+            },
+            'latency_ms': {
+                name: value - baseline['latency_ms'][name]
+                for name, value in report['latency_ms'].items() if name in baseline['latency_ms']
+            }
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluates a descriptor and a metric on the VT ground truth')
+    parser.add_argument('descriptor', help='Name of the descriptor file')
+    parser.add_argument('--metric', default='chebyshev', help='Name of the distance metric')
+    parser.add_argument('--db-path', default='Base10000', help='Path to the database (and its VT files)')
+    parser.add_argument('--descriptors-path', default='Base10000_descriptors', help='Path to the descriptors')
+    parser.add_argument('--k', type=int, nargs='+', default=[10, 30, 100], help='Cut-offs of the precision and recall')
+    parser.add_argument('--output', default='', help='JSON file of the report')
+    parser.add_argument('--baseline', default='', help='JSON report of a previous run to compare with')
+    parser.add_argument('--report', default='', help='Render the results pages of this category instead')
+    parser.add_argument('--quantization', nargs='*', default=None,
+                        help='Compare these types (default float32 float16 uint8) to float64 instead')
+    arguments = parser.parse_args()
+
+    # Set the logging level and format
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    evaluation = Evaluation(QBE(arguments.db_path, arguments.descriptors_path))
+    # Render the results pages of a category, instead of evaluating
+    if arguments.report:
+        print(evaluation.category_report(arguments.descriptor, arguments.report, max(arguments.k), arguments.metric))
+        raise SystemExit
+
+    evaluation_report: dict
+    if arguments.quantization is not None:
+        evaluation_report = evaluation.quantization(
+            arguments.descriptor, arguments.metric, tuple(arguments.quantization or ('float32', 'float16', 'uint8')),
+            tuple(arguments.k)
+        )
+    else:
+        evaluation_report = evaluation.run(arguments.descriptor, arguments.metric, tuple(arguments.k))
+
+    if arguments.baseline and arguments.quantization is None:
+        with open(arguments.baseline, 'r') as baseline_file:
+            evaluation_report['comparison'] = Evaluation.compare(json.load(baseline_file), evaluation_report)
+
+    if arguments.output:
+        Evaluation.save(evaluation_report, arguments.output)
+    else:
+        print(json.dumps(evaluation_report, indent=2))
@@ -0,0 +1,291 @@
+from collections import OrderedDict
+import logging
+import numpy as np
+from .SearchEngine import SearchEngine
+
+
+class FusionEngine:
+    """
+    A class representing a nearest neighbours search ranking the images by a weighted mix of several descriptor
+    sets (e.g. grey 256, RGB 6x6x6 and resnet18), each with its own search engine and metric.
+
+    The rows of the sets are aligned by filename, on the images described in every set. For a query, the distances
+    of each set are computed in one vectorized pass over its matrix and cached, with their normalizations, for the
+    last queries: changing the weights, the normalization or the fusion mode of a cached query only recombines the
+    cached distances.
+
+    Late fusion normalizes the distance distribution of each set for the query (min-max, z-score or rank), then
+    ranks by the weighted sum of the normalized distances. Early fusion ranks by the distance between the
+    concatenations of the descriptors of every set, each scaled by its weight over the typical distance of its set:
+    for the L1, L2 and Chebyshev metrics (the same for every set), this distance is computed from the cached
+    distances of each set, without building the concatenated matrix.
+
+    Attributes:
+        engines (list[SearchEngine]): The search engine of each descriptor set.
+        names (list[str]): The name of each descriptor set.
+        files (list[str]): The filenames of the images described in every set, in the order of the first set.
+        max_cached_queries (int): The number of queries whose distances are kept.
+        _positions (dict[str, int]): The row of each image in the fused results.
+        _rows (list[np.ndarray]): The row of each image in each set.
+        _scales (list[float | None]): The typical distance of each set, computed on first use.
+        _cache (OrderedDict[str, dict]): The distances of the last queries, least recently used first.
+
+    Methods:
+        __init__(self, engines, names, max_cached_queries): Initializes the FusionEngine object.
+        row(self, image_name: str): Returns the row of an image.
+        _set_distances(self, image_name: str): Returns the cached distances of each set for a query.
+        normalize(distances: np.ndarray, normalization: str, exclude: int): Normalizes a distance distribution.
+        _normalized(self, image_name: str, normalization: str): Returns the normalized distances of each set.
+        _scale(self, index: int, sample_size: int): Estimates the typical distance of a set.
+        fuse(self, image_name: str, weights, normalization: str, fusion: str): Computes the fused distances.
+        search(self, image_name: str, k: int, weights, normalization: str, fusion: str): Finds the nearest images.
+    """
+
+    NORMALIZATIONS: tuple[str, ...] = ('none', 'minmax', 'zscore', 'rank')
+    FUSIONS: tuple[str, ...] = ('late', 'early')
+
+    # How the distances of the sets combine into the distance of the concatenated descriptors, by metric
+    EARLY_COMBINATIONS: dict[str, str] = {'l1': 'sum', 'l2': 'euclidean', 'chebyshev': 'max'}
+
+    engines: list[SearchEngine]
+    names: list[str]
+    files: list[str]
+    max_cached_queries: int
+    _positions: dict[str, int]
+    _rows: list[np.ndarray]
+    _scales: list[float | None]
+    _cache: OrderedDict
+
+    def __init__(self, engines: list[SearchEngine], names: list[str], max_cached_queries: int = 16):
+        """
+        Initializes the FusionEngine object, aligning the rows of the sets by filename.
+
+        Args:
+            engines (list[SearchEngine]): The search engine of each descriptor set.
+            names (list[str]): The name of each descriptor set.
+            max_cached_queries (int): The number of queries whose distances are kept.
+        """
+
+        if not engines or len(engines) != len(names):
+            raise ValueError('A fusion needs one name per descriptor set, and at least one set')
+
+        self.engines = engines
+        self.names = names
+        self.max_cached_queries = max_cached_queries
+
+        # Keep the images described in every set, in the order of the first one
+        described: set[str] = set(engines[0].files).intersection(*(engine.files for engine in engines[1:]))
+        self.files = [filename for filename in dict.fromkeys(engines[0].files) if filename in described]
+        if len(self.files) < len(engines[0].files):
+            logging.warning(f'{len(engines[0].files) - len(self.files)} images are not described in every set')
+
+        self._positions = {filename: position for position, filename in enumerate(self.files)}
+        self._rows = [np.array([engine.row(filename) for filename in self.files], dtype=np.intp) for engine in engines]
+        self._scales = [None] * len(engines)
+        self._cache = OrderedDict()
+
+    def row(self, image_name: str) -> int:
+        """
+        Returns the row of an image.
+
+        Args:
+            image_name (str): The filename of the image.
+
+        Returns:
+            int: The row of the image in the fused results.
+        """
+
+        try:
+            return self._positions[image_name]
+        except KeyError:
+            raise ValueError(f'{image_name} is not described in every descriptor set') from None
+
+    def _set_distances(self, image_name: str) -> dict:
+        """
+        Returns the cache entry of a query, computing the distances of each set (one vectorized pass per set) if the
+        query is not cached.
+
+        Args:
+            image_name (str): The filename of the query image.
+
+        Returns:
+            dict: The cache entry: the query row, the raw distances of each set and their normalizations.
+        """
+
+        entry: dict | None = self._cache.get(image_name)
+        if entry is not None:
+            self._cache.move_to_end(image_name)
+            return entry
+
+        # Distances of the query to every row of each set, in the order of the fused rows
+        raw: list[np.ndarray] = []
+        for engine, rows in zip(self.engines, self._rows):
+            raw.append(engine.distances(engine.vectors(engine.row(image_name)))[rows])
+
+        entry = {'row': self.row(image_name), 'raw': raw, 'normalized': {}}
+        self._cache[image_name] = entry
+
+        # Forget the least recently used queries
+        while len(self._cache) > self.max_cached_queries:
+            self._cache.popitem(last=False)
+
+        return entry
+
+    @staticmethod
+    def normalize(distances: np.ndarray, normalization: str = 'zscore', exclude: int = -1) -> np.ndarray:
+        """
+        Normalizes the distance distribution of a set for a query, so that the sets can be summed. The statistics
+        leave out the excluded row (the query image, at distance 0) and the infinite distances, which stay infinite.
+
+        Args:
+            distances (np.ndarray): The distance to each row.
+            normalization (str): 'none', 'minmax' (to [0, 1]), 'zscore' (zero mean, unit standard deviation) or
+                'rank' (the fraction of the rows strictly closer, equal distances sharing their rank).
+            exclude (int): A row left out of the statistics, -1 for none.
+
+        Returns:
+            np.ndarray: The normalized distances, in float64.
+        """
+
+        distances = np.asarray(distances, dtype=np.float64)
+
+        # Values the statistics are computed on
+        included: np.ndarray = np.isfinite(distances)
+        if exclude >= 0:
+            included[exclude] = False
+        values: np.ndarray = distances[included]
+
+        if normalization == 'none' or values.size == 0:
+            return distances
+        if normalization == 'minmax':
+            spread: float = float(values.max() - values.min())
+            return (distances - values.min()) / (spread if spread > 0 else 1.0)
+        if normalization == 'zscore':
+            deviation: float = float(values.std())
+            return (distances - values.mean()) / (deviation if deviation > 0 else 1.0)
+        if normalization == 'rank':
+            return np.searchsorted(np.sort(values), distances, side='left') / values.size
+
+        raise ValueError(f'Unknown normalization {normalization}, available normalizations: {", ".join(FusionEngine.NORMALIZATIONS)}')
+
+    def _normalized(self, image_name: str, normalization: str) -> list[np.ndarray]:
+        """
+        Returns the normalized distances of each set for a query, cached with its raw distances.
+
+        Args:
+            image_name (str): The filename of the query image.
+            normalization (str): The normalization (see normalize()).
+
+        Returns:
+            list[np.ndarray]: The normalized distances of each set.
+        """
+
+        entry: dict = self._set_distances(image_name)
+        if normalization not in entry['normalized']:
+            entry['normalized'][normalization] = [
+                self.normalize(distances, normalization, entry['row']) for distances in entry['raw']
+            ]
+
+        return entry['normalized'][normalization]
+
+    def _scale(self, index: int, sample_size: int = 256) -> float:
+        """
+        Estimates the typical distance of a set, the mean distance between the rows of a fixed random sample.
+
+        Args:
+            index (int): The index of the set.
+            sample_size (int): The number of rows of the sample.
+
+        Returns:
+            float: The typical distance, 1 if the sample distances are all null.
+        """
+
+        if self._scales[index] is None:
+            engine: SearchEngine = self.engines[index]
+            rows: np.ndarray = self._rows[index]
+            sample: np.ndarray = np.sort(np.random.default_rng(0).choice(rows, min(sample_size, rows.size), replace=False))
+            vectors: np.ndarray = engine.vectors(sample)
+            block: np.ndarray = engine.metric.block_distances(vectors, vectors, engine.metric.prepare(vectors))
+            finite: np.ndarray = block[np.isfinite(block) & ~np.eye(sample.size, dtype=bool)]
+            scale: float = float(finite.mean()) if finite.size else 0.0
+            self._scales[index] = scale if scale > 0 else 1.0
+
+        return self._scales[index]
+
+    def fuse(
+            self,
+            image_name: str,
+            weights: list[float] | None = None,
+            normalization: str = 'zscore',
+            fusion: str = 'late'
+            ) -> np.ndarray:
+        """
+        Computes the fused distance between a query image and every image.
+
+        Args:
+            image_name (str): The filename of the query image.
+            weights (list[float] | None): The weight of each set, None for equal weights.
+            normalization (str): The normalization of the late fusion (see normalize()).
+            fusion (str): 'late' (weighted sum of the normalized distances) or 'early' (distance between the
+                concatenated descriptors, each set scaled by its weight over its typical distance).
+
+        Returns:
+            np.ndarray: The fused distance to each row.
+        """
+
+        if weights is None:
+            weights = [1.0 / len(self.engines)] * len(self.engines)
+        if len(weights) != len(self.engines):
+            raise ValueError(f'{len(weights)} weights for {len(self.engines)} descriptor sets')
+
+        if fusion == 'late':
+            normalized: list[np.ndarray] = self._normalized(image_name, normalization)
+            return sum(weight * distances for weight, distances in zip(weights, normalized) if weight != 0)
+
+        if fusion == 'early':
+            # The concatenated descriptors are compared with the metric shared by every set
+            metric_names: set[str] = {engine.metric.name for engine in self.engines}
+            combination: str | None = self.EARLY_COMBINATIONS.get(metric_names.pop()) if len(metric_names) == 1 else None
+            if combination is None:
+                raise ValueError(f'Early fusion needs the same metric for every set, among {", ".join(self.EARLY_COMBINATIONS)}')
+
+            # Scaling the features of a set scales its distances by the same factor
+            raw: list[np.ndarray] = self._set_distances(image_name)['raw']
+            scaled: list[np.ndarray] = [
+                abs(weight) / self._scale(index) * raw[index].astype(np.float64) for index, weight in enumerate(weights)
+            ]
+            if combination == 'sum':
+                return sum(scaled)
+            if combination == 'euclidean':
+                return np.sqrt(sum(distances * distances for distances in scaled))
+            return np.maximum.reduce(scaled)
+
+        raise ValueError(f'Unknown fusion {fusion}, available fusions: {", ".join(self.FUSIONS)}')
+
+    def search(
+            self,
+            image_name: str,
+            k: int,
+            weights: list[float] | None = None,
+            normalization: str = 'zscore',
+            fusion: str = 'late'
+            ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest images of an image by fused distance, the image itself excluded.
+
+        Args:
+            image_name (str): The filename of the query image.
+            k (int): The number of neighbours to find.
+            weights (list[float] | None): The weight of each set, None for equal weights.
+            normalization (str): The normalization of the late fusion (see normalize()).
+            fusion (str): 'late' or 'early' (see fuse()).
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The rows of the neighbours (in files) and their fused distances,
+                by increasing distance.
+        """
+
+        fused: np.ndarray = self.fuse(image_name, weights, normalization, fusion)
+        rows: np.ndarray = SearchEngine.top_k(fused, k, self._set_distances(image_name)['row'])
+
+        return rows, fused[rows]
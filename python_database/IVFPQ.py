@@ -0,0 +1,501 @@
+import argparse
+import inspect
+import json
+import logging
+from .Metrics import get_metric, Metric
+import numpy as np
+import os
+from .SearchEngine import SearchEngine
+import time
+
+
+class IVFPQ:
+    """
+    A class representing an inverted file with product quantization: an approximate nearest neighbours index for
+    high-dimensional descriptors (e.g. 512-dimensional CNN features) under the L2 distance.
+
+    A coarse quantizer (k-means) splits the rows into nlist inverted lists. Within each list, the residual of a row
+    (its difference to the list centroid) is cut into m sub-vectors, each encoded by the index (one byte) of its
+    nearest centroid in a per-sub-vector codebook. A query only scans the nprobe lists of its nearest centroids, and
+    the distance to each row of these lists is estimated from the codes with a lookup table of the distances between
+    the query residual and the codebook centroids.
+
+    The estimated distances select a shortlist of the rerank nearest rows, whose exact distances are then computed
+    from the descriptor matrix. Without re-ranking (rerank = 0), the estimated distances are returned.
+
+    The index is saved with the generation of the descriptor store (or the checksum of the text file) it was built
+    over, so that an index outdated by an indexing run is not searched.
+
+    Attributes:
+        matrix (np.ndarray): The descriptors, one per row.
+        metric (Metric): The distance metric (L2).
+        centroids (np.ndarray): The (nlist, dim) centroids of the coarse quantizer.
+        codebooks (np.ndarray): The (m, ksub, dim / m) centroids of each sub-vector quantizer.
+        codes (np.ndarray): The (rows, m) codes of the rows, grouped by inverted list.
+        list_rows (np.ndarray): The rows, grouped by inverted list like the codes.
+        list_offsets (np.ndarray): The position of the first row of each inverted list, and the number of rows.
+        nprobe (int): The number of inverted lists scanned per query.
+        rerank (int): The size of the shortlist re-ranked with the exact distances, 0 to return estimated distances.
+        generation (int): The generation of the descriptor store the index was built over, -1 for a text file.
+        checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+        _centroid_norms (np.ndarray): The squared norm of each coarse centroid.
+        _codebook_norms (np.ndarray): The (m, ksub) squared norms of the codebook centroids.
+        _codebooks_t (np.ndarray): The (m, dim / m, ksub) transposed codebooks.
+        _state (dict[str, np.ndarray]): The values precomputed by the metric for the rows of the matrix.
+
+    Methods:
+        __init__(self, matrix, arrays, nprobe, rerank, generation, checksum): Initializes the IVFPQ object from its
+            arrays.
+        _assign(data: np.ndarray, centroids: np.ndarray): Finds the nearest centroid of each row.
+        _kmeans(data: np.ndarray, k: int, iterations: int, rng: np.random.Generator): Clusters rows.
+        _default_subquantizers(dim: int): Chooses the number of sub-vectors of a dimension.
+        build(matrix: np.ndarray, nlist, m, train_size, iterations, nprobe, rerank, seed, generation, checksum):
+            Builds an index.
+        save(self, path: str): Saves the index.
+        load(path: str, matrix: np.ndarray): Loads an index.
+        search(self, query: np.ndarray, k: int, exclude: int): Finds the approximate k nearest rows of a query.
+        recall_report(self, query_rows: np.ndarray, k: int, nprobes, reranks): Measures recall@k against latency.
+    """
+
+    EXTENSION: str = '.ivfpq.npz'
+
+    matrix: np.ndarray
+    metric: Metric
+    centroids: np.ndarray
+    codebooks: np.ndarray
+    codes: np.ndarray
+    list_rows: np.ndarray
+    list_offsets: np.ndarray
+    nprobe: int
+    rerank: int
+    generation: int
+    checksum: str
+    _centroid_norms: np.ndarray
+    _codebook_norms: np.ndarray
+    _codebooks_t: np.ndarray
+    _state: dict[str, np.ndarray]
+
+    def __init__(
+            self,
+            matrix: np.ndarray,
+            arrays: dict[str, np.ndarray],
+            nprobe: int = 8,
+            rerank: int = 0,
+            generation: int = -1,
+            checksum: str = ''
+            ):
+        """
+        Initializes the IVFPQ object from its arrays.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one per row.
+            arrays (dict[str, np.ndarray]): The index arrays (centroids, codebooks, codes, list_rows, list_offsets).
+            nprobe (int): The number of inverted lists scanned per query.
+            rerank (int): The size of the shortlist re-ranked with the exact distances, 0 for none.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+            checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+        """
+
+        self.matrix = matrix
+        self.metric = get_metric('l2')
+        self.centroids = arrays['centroids']
+        self.codebooks = arrays['codebooks']
+        self.codes = arrays['codes']
+        self.list_rows = arrays['list_rows']
+        self.list_offsets = arrays['list_offsets']
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.generation = generation
+        self.checksum = checksum
+        self._centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self._codebook_norms = np.einsum('mkd,mkd->mk', self.codebooks, self.codebooks)
+        self._codebooks_t = np.ascontiguousarray(self.codebooks.transpose(0, 2, 1))
+        self._state = self.metric.prepare(matrix)
+
+    @staticmethod
+    def _assign(data: np.ndarray, centroids: np.ndarray, block_rows: int = 4096) -> np.ndarray:
+        """
+        Finds the nearest centroid (L2) of each row, by blocks of rows to bound the memory of the distance block.
+
+        Args:
+            data (np.ndarray): The rows.
+            centroids (np.ndarray): The centroids.
+            block_rows (int): The number of rows per block.
+
+        Returns:
+            np.ndarray: The index of the nearest centroid of each row.
+        """
+
+        norms: np.ndarray = np.einsum('ij,ij->i', centroids, centroids)
+        labels: np.ndarray = np.empty(data.shape[0], dtype=np.intp)
+
+        # |x - c|^2 = |x|^2 + |c|^2 - 2 x.c, the first term not changing the nearest centroid
+        for start in range(0, data.shape[0], block_rows):
+            block: np.ndarray = norms[np.newaxis, :] - 2 * (data[start:start + block_rows] @ centroids.T)
+            labels[start:start + block_rows] = np.argmin(block, axis=1)
+
+        return labels
+
+    @staticmethod
+    def _kmeans(data: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+        """
+        Clusters rows with Lloyd's k-means, starting from random distinct rows.
+
+        Args:
+            data (np.ndarray): The rows.
+            k (int): The number of clusters.
+            iterations (int): The number of iterations.
+            rng (np.random.Generator): The random generator of the initial centroids.
+
+        Returns:
+            np.ndarray: The (k, dim) centroids.
+        """
+
+        centroids: np.ndarray = data[rng.choice(data.shape[0], k, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels: np.ndarray = IVFPQ._assign(data, centroids)
+
+            # Sum the rows of each cluster at once, the rows being sorted by cluster
+            order: np.ndarray = np.argsort(labels, kind='stable')
+            counts: np.ndarray = np.bincount(labels, minlength=k)
+            filled: np.ndarray = np.flatnonzero(counts)
+            sums: np.ndarray = np.add.reduceat(data[order], np.concatenate(([0], np.cumsum(counts)[:-1]))[filled], axis=0)
+            centroids[filled] = sums / counts[filled, np.newaxis]
+
+            # Restart the empty clusters from random rows
+            empty: np.ndarray = np.flatnonzero(counts == 0)
+            if empty.size:
+                centroids[empty] = data[rng.choice(data.shape[0], empty.size, replace=False)]
+
+        return centroids
+
+    @staticmethod
+    def _default_subquantizers(dim: int) -> int:
+        """
+        Chooses the number of sub-vectors of a dimension: the largest divisor of the dimension up to 64 leaving at
+        least 4 dimensions per sub-vector (e.g. 64 sub-vectors of 8 dimensions for 512-dimensional descriptors).
+
+        Args:
+            dim (int): The dimension of the descriptors.
+
+        Returns:
+            int: The number of sub-vectors.
+        """
+
+        return max((m for m in range(1, min(64, dim) + 1) if dim % m == 0 and dim // m >= 4), default=1)
+
+    @staticmethod
+    def build(
+            matrix: np.ndarray,
+            nlist: int | None = None,
+            m: int | None = None,
+            train_size: int | None = None,
+            iterations: int = 20,
+            nprobe: int = 8,
+            rerank: int = 0,
+            seed: int = 0,
+            generation: int = -1,
+            checksum: str = ''
+            ) -> 'IVFPQ':
+        """
+        Builds an index over a descriptor matrix, the quantizers being trained on a random sample of the rows.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one per row.
+            nlist (int | None): The number of inverted lists, None for 4 sqrt(rows).
+            m (int | None): The number of sub-vectors, which must divide the dimension, None to choose it.
+            train_size (int | None): The number of rows the quantizers are trained on, None for max(40 nlist, 10000).
+            iterations (int): The number of k-means iterations.
+            nprobe (int): The default number of inverted lists scanned per query.
+            rerank (int): The default size of the shortlist re-ranked with the exact distances, 0 for none.
+            seed (int): The seed of the sampling and of the k-means initializations.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+            checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+
+        Returns:
+            IVFPQ: The index.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        rows: int = matrix.shape[0]
+        dim: int = matrix.shape[1]
+        nlist = min(rows, nlist or int(4 * np.sqrt(rows)))
+        m = m or IVFPQ._default_subquantizers(dim)
+        if dim % m != 0:
+            raise ValueError(f'The number of sub-vectors ({m}) must divide the dimension ({dim})')
+
+        rng: np.random.Generator = np.random.default_rng(seed)
+
+        # Train on a sample, in float32 like the stores
+        train_size = min(rows, train_size or max(40 * nlist, 10000))
+        train: np.ndarray = np.asarray(matrix[rng.choice(rows, train_size, replace=False)], dtype=np.float32)
+
+        # Coarse quantizer
+        centroids: np.ndarray = IVFPQ._kmeans(train, nlist, iterations, rng)
+
+        # One codebook of at most 256 centroids (a byte per code) per sub-vector of the residuals, trained on at
+        # most 64 rows per centroid of the sample
+        ksub: int = min(256, train_size)
+        codebook_train: np.ndarray = train[:64 * ksub]
+        residuals: np.ndarray = (codebook_train - centroids[IVFPQ._assign(codebook_train, centroids)]).reshape(-1, m, dim // m)
+        codebooks: np.ndarray = np.stack([
+            IVFPQ._kmeans(np.ascontiguousarray(residuals[:, sub]), ksub, iterations, rng) for sub in range(m)
+        ])
+
+        # Encode every row, by blocks of rows
+        labels: np.ndarray = np.empty(rows, dtype=np.intp)
+        codes: np.ndarray = np.empty((rows, m), dtype=np.uint8)
+        for start in range(0, rows, 65536):
+            block: np.ndarray = np.asarray(matrix[start:start + 65536], dtype=np.float32)
+            labels[start:start + block.shape[0]] = IVFPQ._assign(block, centroids)
+            block_residuals: np.ndarray = (block - centroids[labels[start:start + block.shape[0]]]).reshape(-1, m, dim // m)
+            for sub in range(m):
+                codes[start:start + block.shape[0], sub] = IVFPQ._assign(block_residuals[:, sub], codebooks[sub])
+
+        # Group the rows by inverted list
+        list_rows: np.ndarray = np.argsort(labels, kind='stable')
+        arrays: dict[str, np.ndarray] = {
+            'centroids': centroids,
+            'codebooks': codebooks,
+            'codes': codes[list_rows],
+            'list_rows': list_rows,
+            'list_offsets': np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=nlist))))
+        }
+
+        # Logging information
+        logging.info(f'IVF-PQ index built over {rows} rows ({nlist} lists, {m} sub-vectors of {dim // m} dimensions, {ksub} centroids each)')
+
+        return IVFPQ(matrix, arrays, nprobe, rerank, generation, checksum)
+
+    def save(self, path: str):
+        """
+        Saves the index, e.g. next to its descriptor file.
+
+        Args:
+            path (str): The path to the .npz file.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Write next to the destination then move, so that a reader never sees a partially written index
+        temporary_path: str = f'{path}.tmp.npz'
+        np.savez(
+            temporary_path,
+            centroids=self.centroids, codebooks=self.codebooks, codes=self.codes,
+            list_rows=self.list_rows, list_offsets=self.list_offsets,
+            nprobe=np.array(self.nprobe), rerank=np.array(self.rerank), shape=np.array(self.matrix.shape),
+            generation=np.array(self.generation), checksum=np.array(self.checksum)
+        )
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path: str, matrix: np.ndarray) -> 'IVFPQ':
+        """
+        Loads an index saved by save(). The caller checks its generation or checksum against the descriptors (an
+        index saved without them has none, and is outdated).
+
+        Args:
+            path (str): The path to the .npz file.
+            matrix (np.ndarray): The descriptors the index was built over.
+
+        Returns:
+            IVFPQ: The index.
+        """
+
+        with np.load(path) as data:
+            # The index is only valid for the matrix it was built over
+            if tuple(data['shape']) != matrix.shape:
+                raise ValueError(f'{path} was built over a {tuple(data["shape"])} matrix, not {matrix.shape}')
+
+            arrays: dict[str, np.ndarray] = {
+                name: data[name] for name in ('centroids', 'codebooks', 'codes', 'list_rows', 'list_offsets')
+            }
+            return IVFPQ(
+                matrix, arrays, int(data['nprobe']), int(data['rerank']),
+                int(data['generation']) if 'generation' in data else -1,
+                str(data['checksum']) if 'checksum' in data else ''
+            )
+
+    def search(self, query: np.ndarray, k: int, exclude: int = -1) -> tuple[np.ndarray, np.ndarray, int]:
+        """
+        Finds the approximate k nearest rows of a query, scanning the nprobe nearest inverted lists and re-ranking
+        a shortlist of rerank rows with the exact distances if rerank is set.
+
+        Args:
+            query (np.ndarray): The query descriptor.
+            k (int): The number of rows to find.
+            exclude (int): A row to leave out of the results (e.g. the query image), -1 for none.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, int]: The rows and their distances by increasing distance (then by row),
+                and the number of (estimated or exact) distance evaluations the search needed.
+        """
+
+        query = np.asarray(query, dtype=np.float32)
+        m: int = self.codebooks.shape[0]
+
+        # Nearest inverted lists
+        coarse: np.ndarray = self._centroid_norms - 2 * (self.centroids @ query)
+        nprobe: int = min(self.nprobe, coarse.shape[0])
+        probes: np.ndarray = np.argpartition(coarse, nprobe - 1)[:nprobe]
+
+        # Lookup tables of the squared distances between the residual of the query in each list and the codebook
+        # centroids, |r - y|^2 = |r|^2 + |y|^2 - 2 r.y, computed for every sub-vector and list in one batched product
+        residuals: np.ndarray = (query - self.centroids[probes]).reshape(nprobe, m, -1).transpose(1, 0, 2)
+        tables: np.ndarray = np.matmul(residuals, self._codebooks_t)
+        tables *= -2
+        tables += self._codebook_norms[:, np.newaxis, :]
+        tables += np.einsum('mpd,mpd->mp', residuals, residuals)[:, :, np.newaxis]
+
+        # Gather the codes of the scanned lists, with the position of its list for each row
+        starts: np.ndarray = self.list_offsets[probes]
+        sizes: np.ndarray = self.list_offsets[probes + 1] - starts
+        positions: np.ndarray = np.concatenate([np.arange(start, start + size) for start, size in zip(starts, sizes)])
+        rows: np.ndarray = self.list_rows[positions]
+        list_entries: np.ndarray = np.repeat(np.arange(nprobe) * tables.shape[2], sizes)
+
+        # Estimate the squared distances by summing the table entries of the codes, in one gather
+        sub_vector_entries: np.ndarray = np.arange(m) * (nprobe * tables.shape[2])
+        entries: np.ndarray = self.codes[positions] + sub_vector_entries[np.newaxis, :] + list_entries[:, np.newaxis]
+        estimates: np.ndarray = np.take(tables, entries).sum(axis=1)
+        distances: np.ndarray = np.sqrt(np.maximum(estimates, 0))
+        evaluations: int = rows.shape[0]
+
+        # Leave the excluded row out, and order the candidates by row so that ties are ordered by row
+        keep: np.ndarray = rows != exclude
+        rows, distances = rows[keep], distances[keep]
+        order: np.ndarray = np.argsort(rows)
+        rows, distances = rows[order], distances[order]
+
+        # Re-rank a shortlist with the exact distances
+        if self.rerank > 0:
+            shortlist: np.ndarray = rows[SearchEngine.top_k(distances, max(k, self.rerank))]
+            shortlist.sort()
+            distances = self.metric.distances(
+                query, self.matrix[shortlist], {name: values[shortlist] for name, values in self._state.items()}
+            )
+            rows = shortlist
+            evaluations += shortlist.shape[0]
+
+        selected: np.ndarray = SearchEngine.top_k(distances, k)
+
+        return rows[selected], distances[selected], evaluations
+
+    def recall_report(
+            self,
+            query_rows: np.ndarray,
+            k: int = 30,
+            nprobes: tuple[int, ...] = (1, 2, 4, 8, 16, 32),
+            reranks: tuple[int, ...] = (0, 100)
+            ) -> dict:
+        """
+        Measures the recall@k and the latency of the index for several settings, against a brute-force search of
+        the same matrix. Each query row is excluded from its own results.
+
+        Args:
+            query_rows (np.ndarray): The rows used as queries.
+            k (int): The number of neighbours searched.
+            nprobes (tuple[int, ...]): The numbers of inverted lists scanned to measure.
+            reranks (tuple[int, ...]): The shortlist sizes to measure, 0 for no re-ranking.
+
+        Returns:
+            dict: The JSON-serializable report: the brute-force latency and, for each setting, the mean recall@k,
+                the mean and 95th percentile latencies, the speedup and the mean number of distance evaluations.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        def milliseconds(latencies: list[float]) -> dict[str, float]:
+            return {'mean_ms': float(np.mean(latencies)) * 1000, 'p95_ms': float(np.percentile(latencies, 95)) * 1000}
+
+        # Exact neighbours and brute-force latency
+        exact: list[set[int]] = []
+        latencies: list[float] = []
+        for row in query_rows:
+            start: float = time.perf_counter()
+            distances: np.ndarray = self.metric.distances(self.matrix[row], self.matrix, self._state)
+            neighbours: np.ndarray = SearchEngine.top_k(distances, k, int(row))
+            latencies.append(time.perf_counter() - start)
+            exact.append(set(neighbours.tolist()))
+        brute_force: dict[str, float] = milliseconds(latencies)
+
+        # Restore the settings of the index afterwards
+        settings: tuple[int, int] = (self.nprobe, self.rerank)
+        results: list[dict] = []
+        try:
+            for rerank in reranks:
+                for nprobe in nprobes:
+                    self.nprobe, self.rerank = nprobe, rerank
+                    recalls: list[float] = []
+                    evaluations: list[int] = []
+                    latencies = []
+                    for row, neighbours in zip(query_rows, exact):
+                        start = time.perf_counter()
+                        found, _, count = self.search(self.matrix[row], k, int(row))
+                        latencies.append(time.perf_counter() - start)
+                        recalls.append(len(neighbours.intersection(found.tolist())) / max(1, len(neighbours)))
+                        evaluations.append(count)
+
+                    result: dict = {'nprobe': nprobe, 'rerank': rerank, 'recall': float(np.mean(recalls))}
+                    result.update(milliseconds(latencies))
+                    result['speedup'] = brute_force['mean_ms'] / result['mean_ms']
+                    result['evaluations'] = float(np.mean(evaluations))
+                    results.append(result)
+
+                    # Logging information
+                    logging.info(f'nprobe={nprobe} rerank={rerank}: recall@{k} {result["recall"]:.3f}, {result["mean_ms"]:.2f} ms ({result["speedup"]:.1f}x)')
+        finally:
+            self.nprobe, self.rerank = settings
+
+        return {
+            'rows': self.matrix.shape[0],
+            'dim': self.matrix.shape[1],
+            'lists': self.centroids.shape[0],
+            'sub_vectors': self.codebooks.shape[0],
+            'queries': len(query_rows),
+            'k': k,
+            'brute_force': brute_force,
+            'results': results
+        }
+
+
+if __name__ == '__main__':
+    from .QBE import QBE
+
+    parser = argparse.ArgumentParser(description='Builds an IVF-PQ index and reports its recall@k vs latency trade-off')
+    parser.add_argument('descriptor', help='Name of the descriptor file')
+    parser.add_argument('--db-path', default='Base10000', help='Path to the database')
+    parser.add_argument('--descriptors-path', default='Base10000_descriptors', help='Path to the descriptors')
+    parser.add_argument('--build', action='store_true', help='Build (or rebuild) the index before the report')
+    parser.add_argument('--nlist', type=int, default=None, help='Number of inverted lists')
+    parser.add_argument('--m', type=int, default=None, help='Number of sub-vectors')
+    parser.add_argument('--nprobe', type=int, default=8, help='Default number of inverted lists scanned per query')
+    parser.add_argument('--rerank', type=int, default=0, help='Default shortlist size re-ranked exactly, 0 for none')
+    parser.add_argument('--queries', type=int, default=200, help='Number of random query rows of the report')
+    parser.add_argument('--k', type=int, default=30, help='Number of neighbours of the report')
+    parser.add_argument('--nprobes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='nprobe values to report')
+    parser.add_argument('--reranks', type=int, nargs='+', default=[0, 100], help='Shortlist sizes to report')
+    parser.add_argument('--output', default='', help='JSON file of the report')
+    arguments = parser.parse_args()
+
+    # Set the logging level and format
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    qbe = QBE(arguments.db_path, arguments.descriptors_path)
+    if arguments.build:
+        qbe.build_ivfpq(arguments.descriptor, arguments.nlist, arguments.m, arguments.nprobe, arguments.rerank)
+
+    report: dict = qbe.ivfpq_report(
+        arguments.descriptor, arguments.k, tuple(arguments.nprobes), tuple(arguments.reranks), arguments.queries
+    )
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
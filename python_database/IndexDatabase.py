@@ -1,9 +1,49 @@
+from .DescriptorStore import DescriptorStore
+from .Descriptors import get_extractor
 import inspect
+from .Instrumentation import INSTRUMENTATION
 from .JPicture import JPicture
+from .KNNGraph import KNNGraph
 import logging
+from .Manifest import Manifest
+import multiprocessing
 import numpy as np
 import os
 from PIL import Image
+import time
+
+
+# JPicture instance used by the worker processes of the parallel indexing mode
+_worker_jp: JPicture
+
+
+def _init_worker(jp: JPicture):
+    """
+    Initializes a worker process of the parallel indexing mode.
+
+    Args:
+        jp (JPicture): The JPicture instance to use in the worker process.
+    """
+
+    global _worker_jp
+    _worker_jp = jp
+
+
+def _compute_image_histograms(image_path: str) -> tuple[tuple[np.ndarray, ...], tuple[float, ...]]:
+    """
+    Computes the descriptors of an image in a worker process.
+
+    Args:
+        image_path (str): The path to the image.
+
+    Returns:
+        tuple[tuple[np.ndarray, ...], tuple[float, ...]]: The descriptors computed by the worker JPicture instance,
+            and the seconds spent on each.
+    """
+
+    # Open the image using PIL, compute its descriptors and close it
+    with Image.open(image_path) as image:
+        return _worker_jp.describe(image)
 
 
 class IndexDatabase:
@@ -13,38 +53,53 @@ class IndexDatabase:
     Attributes:
         _db_path (str): The path to folder containing the images constituting the database.
         _db_files (list[str]): The list of files in the database.
-        _histograms_type (list[str]): The list of histogram types.
+        _histograms_type (list[str]): The list of descriptor types (see Descriptors), each with its own store.
         _jp (JPicture): An instance of the JPicture class.
+        _draft_scale (int): The reduction of the JPEG decoding resolution, 1 for full resolution.
+        descriptor_costs (dict[str, float]): The mean seconds spent on each descriptor per image by the last run.
 
     Methods:
-        __init__(self, db_path: str): Initializes the IndexDatabase object.
+        __init__(self, db_path: str, draft_scale: int, descriptors: tuple[str, ...]): Initializes the IndexDatabase
+            object.
         _get_db_files(self): Retrieves the list of files in the database.
-        _write_file(self, histograms: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]): Writes histograms to a file.
-        index(self): Indexes the database.
+        _file_path(self, suffix: str): Constructs the path of a file of the histograms folder.
+        _descriptor_versions(self): Returns the version of each histogram type.
+        _open_stores(self, manifest: Manifest): Opens the descriptor stores and checks them against the manifest.
+        _write_file(self, histogram_type: str, store: DescriptorStore, files: list[str], histograms: np.ndarray):
+            Writes histograms to a descriptor store.
+        _iter_histograms(self, filenames: list[str], workers: int, chunk_size: int): Computes the histograms of images.
+        _checkpoint(self, stores, manifest, batch, batch_histograms): Writes a batch of histograms and the manifest.
+        _open_graphs(self, stores): Loads the k-NN graphs that are up to date with the stores.
+        _patch_graphs(self, graphs, stores, changed, workers): Patches the k-NN graphs after an indexing.
+        index(self, workers: int, chunk_size: int, checkpoint_every: int): Indexes the database incrementally.
     """
 
     _db_path: str
     _db_files: list[str]
     _histograms_type: list[str]
     _jp: JPicture
+    _draft_scale: int
+    descriptor_costs: dict[str, float]
 
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, draft_scale: int = 1, descriptors: tuple[str, ...] = JPicture.DEFAULT_DESCRIPTORS):
         """
         Initializes the IndexDatabase object.
 
         Args:
             db_path (str): The path to the database.
+            draft_scale (int): The reduction of the JPEG decoding resolution of the fast mode (2, 4 or 8, see
+                JPicture), 1 to index the images at full resolution.
+            descriptors (tuple[str, ...]): The descriptors computed from each decoded image (see
+                Descriptors.get_extractor()), e.g. HistRGB_6x6x6, HistHSV_8x3x3, ColorMoments, LBP_256, EdgeHist_8 or
+                GridRGB_4x4_2.
         """
 
         self._db_path = db_path
         self._db_files = []
-        self._histograms_type = [
-            "HistGRAY_256",
-            "HistRGB_2x2x2",
-            "HistRGB_4x4x4",
-            "HistRGB_6x6x6"
-        ]
-        self._jp = JPicture()
+        self._histograms_type = list(descriptors)
+        self._jp = JPicture(self._histograms_type, draft_scale)
+        self.descriptor_costs = {}
+        self._draft_scale = draft_scale
         self._get_db_files()
 
     def _get_db_files(self):
@@ -72,76 +127,382 @@ class IndexDatabase:
         # Close the file
         file.close()
 
-    def _write_file(self, histograms: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]):
+    def _file_path(self, suffix: str) -> str:
         """
-        Writes histograms to a file.
+        Constructs the path of a file of the histograms folder, named after the database folder.
 
         Args:
-            histograms (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]): The histograms to write.
-        """
+            suffix (str): The end of the file name (e.g. '.HistRGB_2x2x2.store').
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+        Returns:
+            str: The path to the file.
+        """
 
         # Create the folder to store the histograms if it doesn't exist
         folder: str = os.path.join(self._db_path, 'histograms')
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        # Iterate over each histogram in the tuple
-        for index, histo in enumerate(histograms):
-            file_path: str
+        return os.path.join(folder, f'{os.path.basename(os.path.normpath(self._db_path))}{suffix}')
+
+    def _descriptor_versions(self) -> dict[str, int | str]:
+        """
+        Returns the version of each descriptor type computed by the indexing (see Descriptors.Extractor.version).
+        The histograms of the draft mode have their own version, so that switching modes indexes the images again.
 
-            # Construct the file path for the histogram
-            file_path = os.path.join(
-                folder,
-                f'{self._db_path}.{self._histograms_type[index]}.txt'
-            )
+        Returns:
+            dict[str, int | str]: The version of each descriptor type.
+        """
 
-            # Check if the file already exists, if not create it
-            if not os.path.exists(file_path):
-                open(file_path, 'w').close()
+        versions: dict[str, int | str] = {}
+        for histogram_type in self._histograms_type:
+            version: int = get_extractor(histogram_type).version
+            versions[histogram_type] = version if self._draft_scale == 1 else f'{version}-draft{self._draft_scale}'
 
-            # Open the file in append mode
-            with open(file_path, 'a') as file:
+        return versions
 
-                # Flatten the numpy array and write each value to the file
-                for value in histo.flatten():
-                    file.write(f'{value} ')
+    def _open_stores(self, manifest: Manifest) -> list[DescriptorStore | None]:
+        """
+        Opens the descriptor store of each histogram type and checks it against the manifest.
 
-                # Write a newline character to separate each histogram
-                file.write('\n')
+        Rows appended after the last checkpoint of an interrupted run are dropped. If the stores and the manifest
+        still disagree, the manifest is emptied and the stores are rebuilt from scratch.
 
-            # Close the file
-            file.close()
+        Args:
+            manifest (Manifest): The manifest of the database.
 
-    def index(self):
+        Returns:
+            list[DescriptorStore | None]: The store of each histogram type, None if it doesn't exist yet.
         """
-        Indexes the database.
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Open the existing stores in update mode
+        stores: list[DescriptorStore | None] = []
+        for histogram_type in self._histograms_type:
+            file_path: str = self._file_path(f'.{histogram_type}{DescriptorStore.EXTENSION}')
+            stores.append(DescriptorStore(file_path, 'r+') if os.path.exists(file_path) else None)
+
+        # Drop the trailing rows of the images that were not checkpointed in the manifest
+        indexed: set[str] = set(manifest.entries)
+        for store in stores:
+            if store is not None:
+                kept: int = store.count
+                while kept > 0 and store.files[kept - 1] not in indexed:
+                    kept -= 1
+                if kept < store.count:
+                    logging.info(f'Dropping {store.count - kept} uncheckpointed rows from {store.path}')
+                    store.truncate(kept)
+
+        # Every store must hold the rows of the indexed images, in the same order
+        consistent: bool = all(
+            store is not None and store.files == stores[0].files and set(store.files) == indexed
+            for store in stores
+        ) or (not indexed and all(store is None or store.count == 0 for store in stores))
+
+        if not consistent:
+            logging.warning('Descriptor stores and manifest disagree, indexing the database from scratch')
+            manifest.entries = {}
+            stores = [None for _ in self._histograms_type]
+
+        return stores
+
+    def _write_file(
+            self,
+            histogram_type: str,
+            store: DescriptorStore | None,
+            files: list[str],
+            histograms: np.ndarray
+            ) -> DescriptorStore:
+        """
+        Writes histograms of one type to its descriptor store: rows of already indexed images are updated in place,
+        rows of new images are appended.
+
+        Args:
+            histogram_type (str): The histogram type.
+            store (DescriptorStore | None): The store of the histogram type, None to create it.
+            files (list[str]): The filenames of the images.
+            histograms (np.ndarray): The flattened histograms, one row per file.
+
+        Returns:
+            DescriptorStore: The updated store.
         """
 
         # Debugging information
         logging.debug(f'{inspect.currentframe().f_code.co_name}()')
 
-        # Logging information
-        logging.info(f'Indexing database in {self._db_path}...')
+        # Create the store with these histograms as its first rows
+        if store is None:
+            file_path: str = self._file_path(f'.{histogram_type}{DescriptorStore.EXTENSION}')
+            DescriptorStore.write(file_path, histogram_type, histograms, files)
+            return DescriptorStore(file_path, 'r+')
+
+        # Split the images between the ones already in the store and the new ones
+        rows: dict[str, int] = {filename: row for row, filename in enumerate(store.files)}
+        updated: list[int] = [index for index, filename in enumerate(files) if filename in rows]
+        added: list[int] = [index for index, filename in enumerate(files) if filename not in rows]
+
+        # Update the rows of the images already in the store in place
+        if updated:
+            store.set_rows(np.array([rows[files[index]] for index in updated]), histograms[updated])
+
+        # Append the rows of the new images, then write the header
+        if added:
+            store.append(histograms[added], [files[index] for index in added])
+        else:
+            store.flush()
+
+        return store
+
+    def _iter_histograms(self, filenames: list[str], workers: int, chunk_size: int):
+        """
+        Computes the histograms of images of the database, in the order of the given filenames.
+
+        Args:
+            filenames (list[str]): The filenames of the images.
+            workers (int): The number of worker processes. 1 computes the histograms in the current process.
+            chunk_size (int): The number of images sent to a worker process at once.
+
+        Yields:
+            tuple[tuple[np.ndarray, ...], tuple[float, ...]]: The descriptors of each image and the seconds spent on
+                each.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Construct the image paths
+        image_paths: list[str] = [os.path.join(self._db_path, 'images', filename) for filename in filenames]
 
-        # Iterate over each filename in the database files
+        # Sequential mode: compute the histograms in the current process
+        if workers == 1:
+            for image_path in image_paths:
+                # Open the image using PIL
+                image: Image.Image = Image.open(image_path)
+
+                # Compute the descriptors and their costs using the jp.describe method
+                described: tuple[tuple[np.ndarray, ...], tuple[float, ...]] = self._jp.describe(image)
+
+                # Close the image
+                image.close()
+
+                yield described
+            return
+
+        # Parallel mode: each worker process gets its own copy of the JPicture instance
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self._jp,)) as pool:
+            # imap returns the results in the order of the image paths, whatever the worker that computed them
+            yield from pool.imap(_compute_image_histograms, image_paths, chunksize=chunk_size)
+
+    def _checkpoint(
+            self,
+            stores: list[DescriptorStore | None],
+            manifest: Manifest,
+            batch: list[tuple[str, tuple[int, int], str]],
+            batch_histograms: list[tuple[np.ndarray, ...]]
+            ):
+        """
+        Writes a batch of computed histograms to the stores, then records the batch in the manifest.
+
+        Args:
+            stores (list[DescriptorStore | None]): The store of each histogram type, updated in place.
+            manifest (Manifest): The manifest of the database.
+            batch (list[tuple[str, tuple[int, int], str]]): The filename, signature and content hash of each image.
+            batch_histograms (list[tuple[np.ndarray, ...]]): The histograms of each image.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        start: float = time.perf_counter()
+        files: list[str] = [filename for filename, _, _ in batch]
+
+        # Write the histograms of each type
+        for index, histogram_type in enumerate(self._histograms_type):
+            histograms: np.ndarray = np.stack([histos[index].ravel() for histos in batch_histograms])
+            stores[index] = self._write_file(histogram_type, stores[index], files, histograms)
+
+        # Record the images in the manifest once their rows are on disk
+        versions: dict[str, int | str] = self._descriptor_versions()
+        for filename, signature, content_hash in batch:
+            manifest.set(filename, signature, content_hash, versions)
+        manifest.save()
+
+        INSTRUMENTATION.observe('write', time.perf_counter() - start)
+
+    def _open_graphs(self, stores: list[DescriptorStore | None]) -> list[tuple[str, KNNGraph, int]]:
+        """
+        Loads the k-nearest neighbours graphs of the stores (see QBE.build_knn_graph()), one per metric, that are up
+        to date with their store. Stale graphs are left as they are, and ignored by the queries.
+
+        Args:
+            stores (list[DescriptorStore | None]): The store of each histogram type.
+
+        Returns:
+            list[tuple[str, KNNGraph, int]]: The path, graph and histogram type index of each up to date graph.
+        """
+
+        graphs: list[tuple[str, KNNGraph, int]] = []
+        folder: str = os.path.dirname(self._file_path(''))
+        for index, histogram_type in enumerate(self._histograms_type):
+            if stores[index] is None:
+                continue
+
+            # The graphs are named after the store, followed by their metric
+            prefix: str = os.path.basename(self._file_path(f'.{histogram_type}.'))
+            for filename in sorted(os.listdir(folder)):
+                if not filename.startswith(prefix) or not filename.endswith(KNNGraph.EXTENSION):
+                    continue
+                if '.' in filename[len(prefix):-len(KNNGraph.EXTENSION)]:
+                    continue
+
+                path: str = os.path.join(folder, filename)
+                graph: KNNGraph = KNNGraph.load(path)
+                if graph.generation == stores[index].generation:
+                    graphs.append((path, graph, index))
+                else:
+                    logging.warning(f'Not patching {path}: computed on generation {graph.generation} of the store, not {stores[index].generation}')
+
+        return graphs
+
+    def _patch_graphs(
+            self,
+            graphs: list[tuple[str, KNNGraph, int]],
+            stores: list[DescriptorStore | None],
+            changed: list[str],
+            workers: int
+            ):
+        """
+        Patches the k-nearest neighbours graphs after an indexing, recomputing only the rows affected by the new,
+        changed and removed images (see KNNGraph.patch()), and saves them with the new generation of their store.
+
+        Args:
+            graphs (list[tuple[str, KNNGraph, int]]): The graphs loaded before the indexing (see _open_graphs()).
+            stores (list[DescriptorStore | None]): The store of each histogram type, after the indexing.
+            changed (list[str]): The filenames of the indexed images.
+            workers (int): The number of worker processes.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        for path, graph, index in graphs:
+            store: DescriptorStore = stores[index]
+            with INSTRUMENTATION.stage('knn_patch'):
+                graph.patch(store.matrix, store.files, changed, workers, store.quantizer, store.generation)
+                graph.save(path)
+
+    def index(self, workers: int | None = 1, chunk_size: int = 16, checkpoint_every: int = 256) -> float:
+        """
+        Indexes the database incrementally.
+
+        The manifest records the size, modification time, content hash and descriptor versions of each indexed
+        image. Only new or changed images are processed, images removed from the database are removed from the
+        stores, and the manifest is saved every checkpoint_every images so that an interrupted run resumes from
+        its last checkpoint. The k-NN graphs of the stores are then patched on the rows affected by the new, changed
+        and removed images.
+
+        Args:
+            workers (int): The number of worker processes computing the histograms. None uses every available core.
+            chunk_size (int): The number of images sent to a worker process at once in parallel mode.
+            checkpoint_every (int): The number of images processed between two checkpoints.
+
+        Returns:
+            float: The indexing throughput, in images per second.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Use every available core if no worker count is given
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        # Logging information
+        logging.info(f'Indexing database in {self._db_path} with {workers} worker(s)...')
+
+        # Load the manifest and the stores of the previous runs
+        manifest: Manifest = Manifest(self._file_path('.manifest.json'))
+        stores: list[DescriptorStore | None] = self._open_stores(manifest)
+        graphs: list[tuple[str, KNNGraph, int]] = self._open_graphs(stores)
+
+        # Remove the images that are not in the database anymore
+        removed: list[str] = sorted(set(manifest.entries) - set(self._db_files))
+        if removed:
+            logging.info(f'Removing {len(removed)} images from the index...')
+            for store in stores:
+                if store is not None:
+                    store.remove(removed)
+            for filename in removed:
+                manifest.remove(filename)
+            manifest.save()
+
+        # Find the new and changed images
+        versions: dict[str, int | str] = self._descriptor_versions()
+        todo: list[tuple[str, tuple[int, int], str]] = []
         for filename in self._db_files:
-            # Construct the image path
-            image_path = os.path.join(self._db_path, 'images', filename)
+            image_path: str = os.path.join(self._db_path, 'images', filename)
+            signature: tuple[int, int] = Manifest.file_signature(image_path)
 
-            # Open the image using PIL
-            image: Image.Image = Image.open(image_path)
+            # Same size and modification time: the image is up to date
+            if manifest.is_current(filename, signature, versions):
+                continue
 
-            # Compute the histograms using the jp.histograms method
-            histograms: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] = self._jp.histograms(image)
+            # Same content (e.g. the file was touched): only record its new signature
+            content_hash: str = Manifest.content_hash(image_path)
+            entry: dict | None = manifest.entries.get(filename)
+            if entry is not None and entry['hash'] == content_hash and entry['descriptors'] == versions:
+                manifest.set(filename, signature, content_hash, versions)
+                continue
 
-            # Close the image
-            image.close()
+            todo.append((filename, signature, content_hash))
 
-            # Write the file with the computed histograms
-            self._write_file(histograms)
-        
         # Logging information
-        logging.info('Database indexed successfully!')
+        logging.info(f'{len(todo)} images to index, {len(self._db_files) - len(todo)} up to date')
+
+        # Start measuring the indexing time
+        start: float = time.perf_counter()
+
+        # Compute the histograms of the images to index, checkpointing every batch
+        batch: list[tuple[str, tuple[int, int], str]] = []
+        batch_histograms: list[tuple[np.ndarray, ...]] = []
+        filenames: list[str] = [filename for filename, _, _ in todo]
+        costs: np.ndarray = np.zeros(len(self._histograms_type))
+        for image, (histograms, seconds) in zip(todo, self._iter_histograms(filenames, workers, chunk_size)):
+            costs += seconds
+            INSTRUMENTATION.count('images_indexed')
+            INSTRUMENTATION.count('bytes_read', image[1][0])
+            batch.append(image)
+            batch_histograms.append(histograms)
+
+            if len(batch) == checkpoint_every:
+                self._checkpoint(stores, manifest, batch, batch_histograms)
+                batch, batch_histograms = [], []
+
+        # Checkpoint the last batch and the touched images
+        if batch:
+            self._checkpoint(stores, manifest, batch, batch_histograms)
+        else:
+            manifest.save()
+
+        # Patch the rows of the k-NN graphs affected by the new, changed and removed images
+        if graphs and (todo or removed):
+            self._patch_graphs(graphs, stores, filenames, workers)
+
+        # Compute the indexing throughput
+        elapsed: float = time.perf_counter() - start
+        INSTRUMENTATION.observe('index', elapsed)
+        throughput: float = len(todo) / elapsed if elapsed > 0 else 0.0
+
+        # Mean cost of each descriptor, measured where it was computed (in the worker processes in parallel mode)
+        self.descriptor_costs = {
+            histogram_type: float(cost) / len(todo) for histogram_type, cost in zip(self._histograms_type, costs)
+        } if todo else {}
+
+        # Logging information
+        logging.info(f'Database indexed successfully! {len(todo)} images in {elapsed:.2f}s ({throughput:.1f} images/s)')
+        for histogram_type, cost in self.descriptor_costs.items():
+            logging.info(f'{histogram_type}: {cost * 1000:.2f} ms/image')
+
+        return throughput
@@ -0,0 +1,260 @@
+from bisect import bisect_left
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+
+
+class Instrumentation:
+    """
+    A class representing the instrumentation of the indexing and query pipeline: timers of the stages (decoding,
+    histograms, writing, loading, queries...) with a histogram of their durations, and counters (images decoded,
+    bytes read, distance evaluations...).
+
+    The instrumentation is disabled by default and then costs a method call per instrumented call: stage() returns
+    a shared no-op context and count() returns at once. Once enabled, the measures can be exported as JSON or in the
+    Prometheus text format, and a single run can be profiled with cProfile.
+
+    Stages run in worker processes (parallel indexing) are measured by these processes, not by the main one.
+
+    Attributes:
+        enabled (bool): True if the measures are recorded.
+        buckets (tuple[float, ...]): The upper bounds, in seconds, of the duration histogram buckets.
+        counters (dict[str, float]): The value of each counter.
+        stages (dict[str, dict]): The count, total and maximum duration, and histogram bucket counts of each stage.
+        _lock (threading.Lock): The lock protecting the measures (the query server is multithreaded).
+
+    Methods:
+        __init__(self, buckets: tuple[float, ...]): Initializes the Instrumentation object, disabled.
+        enable(self): Starts recording the measures.
+        disable(self): Stops recording the measures.
+        reset(self): Forgets every measure.
+        count(self, name: str, value: float): Increments a counter.
+        observe(self, name: str, seconds: float): Records a duration of a stage.
+        stage(self, name: str): Times a stage.
+        to_dict(self): Exports the measures.
+        to_json(self): Exports the measures as JSON.
+        to_prometheus(self, prefix: str): Exports the measures in the Prometheus text format.
+        profile(self, path: str, sort: str, limit: int): Profiles a run with cProfile.
+    """
+
+    # Durations from 100 µs to 10 s
+    DEFAULT_BUCKETS: tuple[float, ...] = (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+
+    enabled: bool
+    buckets: tuple[float, ...]
+    counters: dict[str, float]
+    stages: dict[str, dict]
+    _lock: threading.Lock
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        Initializes the Instrumentation object, disabled.
+
+        Args:
+            buckets (tuple[float, ...]): The upper bounds, in seconds, of the duration histogram buckets.
+        """
+
+        self.enabled = False
+        self.buckets = tuple(sorted(buckets))
+        self.counters = {}
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """
+        Starts recording the measures.
+        """
+
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops recording the measures, keeping the ones recorded so far.
+        """
+
+        self.enabled = False
+
+    def reset(self):
+        """
+        Forgets every measure.
+        """
+
+        with self._lock:
+            self.counters = {}
+            self.stages = {}
+
+    def count(self, name: str, value: float = 1):
+        """
+        Increments a counter.
+
+        Args:
+            name (str): The name of the counter (e.g. images_decoded).
+            value (float): The increment.
+        """
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        """
+        Records a duration of a stage.
+
+        Args:
+            name (str): The name of the stage (e.g. query).
+            seconds (float): The duration.
+        """
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            stage: dict | None = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'buckets': [0] * (len(self.buckets) + 1)
+                }
+            stage['count'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            stage['buckets'][bisect_left(self.buckets, seconds)] += 1
+
+    @contextlib.contextmanager
+    def _timer(self, name: str):
+        """
+        Times the body of a with statement as a stage.
+
+        Args:
+            name (str): The name of the stage.
+        """
+
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def stage(self, name: str) -> contextlib.AbstractContextManager:
+        """
+        Times a stage: `with INSTRUMENTATION.stage('decode'): ...`.
+
+        Args:
+            name (str): The name of the stage.
+
+        Returns:
+            contextlib.AbstractContextManager: The timer, or a shared no-op context when disabled.
+        """
+
+        if not self.enabled:
+            return _NO_TIMER
+
+        return self._timer(name)
+
+    def to_dict(self) -> dict:
+        """
+        Exports the measures.
+
+        Returns:
+            dict: The JSON-serializable counters and stages, each stage with its mean duration and its duration
+                histogram as {upper bound: count} (cumulative counts are left to the Prometheus export).
+        """
+
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {
+                    name: {
+                        'count': stage['count'],
+                        'seconds': stage['seconds'],
+                        'mean_seconds': stage['seconds'] / stage['count'],
+                        'max_seconds': stage['max_seconds'],
+                        'histogram': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], stage['buckets']))
+                    }
+                    for name, stage in self.stages.items()
+                }
+            }
+
+    def to_json(self) -> str:
+        """
+        Exports the measures as JSON.
+
+        Returns:
+            str: The JSON document of to_dict().
+        """
+
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix: str = 'qbe') -> str:
+        """
+        Exports the measures in the Prometheus text exposition format: one counter per counter, and a histogram of
+        the stage durations labelled by stage.
+
+        Args:
+            prefix (str): The prefix of the metric names.
+
+        Returns:
+            str: The exposition text.
+        """
+
+        lines: list[str] = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                lines.append(f'{prefix}_{name}_total {value:g}')
+
+            if self.stages:
+                lines.append(f'# TYPE {prefix}_stage_seconds histogram')
+            for name, stage in sorted(self.stages.items()):
+                cumulative: int = 0
+                for bound, bucket in zip([f'{bound:g}' for bound in self.buckets] + ['+Inf'], stage['buckets']):
+                    cumulative += bucket
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stage["seconds"]:g}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    @contextlib.contextmanager
+    def profile(self, path: str = '', sort: str = 'cumulative', limit: int = 30):
+        """
+        Profiles the body of a with statement with cProfile, e.g. a single indexing or query run:
+        `with INSTRUMENTATION.profile('query.prof'): qbe.request(...)`.
+
+        Args:
+            path (str): The file the statistics are dumped to (readable with pstats or snakeviz), empty to log the
+                most expensive functions instead.
+            sort (str): The sort key of the logged statistics.
+            limit (int): The number of logged functions.
+        """
+
+        profiler: cProfile.Profile = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            if path:
+                profiler.dump_stats(path)
+
+                # Logging information
+                logging.info(f'Profile written to {path}')
+            else:
+                report: io.StringIO = io.StringIO()
+                pstats.Stats(profiler, stream=report).sort_stats(sort).print_stats(limit)
+                logging.info(report.getvalue())
+
+
+# Context returned by stage() when the instrumentation is disabled
+_NO_TIMER: contextlib.nullcontext = contextlib.nullcontext()
+
+# Instrumentation shared by the whole pipeline
+INSTRUMENTATION: Instrumentation = Instrumentation()
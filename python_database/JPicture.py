@@ -1,219 +1,221 @@
-import inspect
+import argparse
+from .Descriptors import Extractor, Features, get_extractor
+from .Instrumentation import INSTRUMENTATION
+import json
 import logging
 import numpy as np
 import os
 from PIL import Image
+import sys
+import time
 
 
 class JPicture:
     """
-    JPicture class represents an image processing utility.
+    JPicture class represents an image processing utility: it decodes an image once and computes the configured
+    descriptors (see Descriptors) from its pixels, the extractors sharing their intermediates (luma, RGB bin
+    indices...).
+
+    The pixels are kept as the decoded uint8 values and binned with integer arithmetic: an RGB bin index is read from
+    a lookup table of the 256 values of a channel, and the luma of a pixel is the integer 299 R + 587 G + 114 B (the
+    luma formula scaled by 1000), whose bin is an integer division. No float copy of the image is made. The
+    histograms are the same as the ones of the normalized float pixels (value / 255).
+
+    In draft mode, JPEG images are decoded at a reduced resolution (1/2, 1/4 or 1/8, by the JPEG decoder itself),
+    which is much faster. The histograms then drift from the full resolution ones, by at most DRAFT_DRIFT_BOUNDS
+    (L1 distance between the normalized histograms, measured with draft_drift()).
 
     Attributes:
-        None
+        descriptors (tuple[str, ...]): The names of the computed descriptors.
+        _extractors (list[Extractor]): The extractor of each descriptor.
+        _draft_scale (int): The reduction of the JPEG decoding resolution, 1 for full resolution.
 
     Methods:
-        _compute_histrograms: Computes the histograms of an image.
-        _normalize_image: Normalizes the pixel values of an image.
-        _rgb_to_luma: Converts an RGB image to grayscale using the luma formula.
-        histrograms: Computes the histograms of an image and its grayscale version.
+        _pixels: Returns the uint8 pixel values of an image.
+        histograms: Computes the descriptors of an image.
+        describe: Computes the descriptors of an image and the time spent on each.
+        _describe: Computes the descriptors of a decoded image and the time spent on each.
+        draft_drift: Measures the drift of the draft mode histograms from the full resolution ones.
     """
 
-    def __init__(self):
-        pass
+    # Descriptors computed by default, the histograms of the original indexing
+    DEFAULT_DESCRIPTORS: tuple[str, ...] = ('HistGRAY_256', 'HistRGB_2x2x2', 'HistRGB_4x4x4', 'HistRGB_6x6x6')
 
-    def _compute_histograms(self, pixels: np.ndarray, nbins: int) -> np.ndarray:
-        """
-        Computes the histograms of an image.
+    # Largest L1 distance (out of 2) between a draft mode histogram and the full resolution one, by draft scale, for
+    # every histogram type: the maximum measured by draft_drift() on the images of Base10000, plus a margin
+    DRAFT_DRIFT_BOUNDS: dict[int, float] = {2: 0.3, 4: 0.55, 8: 0.9}
 
-        Args:
-            pixels (np.ndarray): The pixel values of the image.
-            nbins (int): The number of bins for the histograms.
+    descriptors: tuple[str, ...]
+    _extractors: list[Extractor]
+    _draft_scale: int
 
-        Returns:
-            np.ndarray: The computed histograms with normalized values.
+    def __init__(self, descriptors: tuple[str, ...] = DEFAULT_DESCRIPTORS, draft_scale: int = 1):
         """
+        Initializes the JPicture object.
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
-
-        # Initialize bins array
-        bins: np.ndarray
-
-        # Check if the image is RGB or grayscale
-        if pixels.shape.__len__() == 3:
-            # If array is 3D (RGB image)
-            bins = self._compute_RGB_histogram(pixels, nbins)
-        else:
-            # If not (grayscale image)
-            bins = self._compute_gray_level_histogram(pixels, nbins)
+        Args:
+            descriptors (tuple[str, ...]): The names of the descriptors to compute (see Descriptors.get_extractor()).
+            draft_scale (int): The reduction of the JPEG decoding resolution (2, 4 or 8), 1 for full resolution.
+        """
 
-        # Normalize the histogram by dividing by the total number of pixels
-        bins = bins / (pixels.shape[0] * pixels.shape[1])
+        if draft_scale not in (1, 2, 4, 8):
+            raise ValueError(f'The draft scale must be 1, 2, 4 or 8, not {draft_scale}')
 
-        # Return the computed histograms
-        return bins
+        self.descriptors = tuple(descriptors)
+        self._extractors = [get_extractor(name) for name in self.descriptors]
+        self._draft_scale = draft_scale
 
-    def _compute_RGB_histogram(self, pixels: np.ndarray, nbins: int) -> np.ndarray:
+    def _pixels(self, image: Image.Image) -> np.ndarray:
         """
-        Computes the RGB histogram of an image.
+        Returns the pixel values of an image, as decoded.
 
         Args:
-            pixels (np.ndarray): The pixel values of the image.
-            nbins (int): The number of bins for the histogram.
+            image (Image.Image): The decoded image.
 
         Returns:
-            np.ndarray: The computed RGB histogram.
+            np.ndarray: The (height, width, 3) uint8 RGB values.
         """
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
-
-        # Calculate the dimensions of the bins array
-        bins_dimension: tuple = tuple(nbins for _ in range(pixels.shape[2]))
-
-        # Initialize the bins array
-        bins: np.ndarray = np.zeros(bins_dimension, dtype=int)
-
-        # Calculate the step size for each bin
-        step: float = 1 / nbins
-
-        # Iterate over each pixel in the image
-        for line in pixels:
-            for pixel in line:
-                # Calculate the bin index for each color channel
-                red_index: int = int(pixel[0] // step)
-                green_index: int = int(pixel[1] // step)
-                blue_index: int = int(pixel[2] // step)
-
-                # If the pixel value is the maximum possible value, put it in the last bin
-                if red_index == nbins:
-                    red_index -= 1
-
-                if green_index == nbins:
-                    green_index -= 1
-
-                if blue_index == nbins:
-                    blue_index -= 1
-
-                # Increment the corresponding bin
-                bins[red_index, green_index, blue_index] += 1
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
 
-        return bins
+        return np.asarray(image)
 
-    def _compute_gray_level_histogram(self, pixels: np.ndarray, nbins: int) -> np.ndarray:
+    def histograms(self, image: Image.Image) -> tuple[np.ndarray, ...]:
         """
-        Computes the gray level histogram of an image.
+        Public method that computes the descriptors of an image.
 
         Args:
-            pixels (np.ndarray): The pixel values of the image.
-            nbins (int): The number of bins for the histogram.
+            image (Image.Image): The input image.
 
         Returns:
-            np.ndarray: The computed gray level histogram.
+            tuple[np.ndarray, ...]:
+                The flat descriptors, in the configured order.
+                With the default configuration: luma256, RGB 2x2x2, RGB 4x4x4, RGB 6x6x6.
         """
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
-
-        # Initialize the bins array
-        bins: np.ndarray = np.zeros(nbins, dtype=int)
-
-        # Calculate the step size for each bin
-        step: float = 1 / nbins
-
-        # Iterate over each pixel in the image
-        for line in pixels:
-            for pixel in line:
-                # Calculate the bin index
-                bin_index: int = int(pixel // step)
+        return self.describe(image)[0]
 
-                # If the pixel value is the maximum possible value, put it in the last bin
-                if bin_index == nbins:
-                    bin_index -= 1
-
-                # Increment the corresponding bin
-                bins[bin_index] += 1
-
-        return bins
-
-    def _normalize_image(self, image: Image.Image) -> np.ndarray:
+    def describe(self, image: Image.Image) -> tuple[tuple[np.ndarray, ...], tuple[float, ...]]:
         """
-        Normalizes the pixel values of an image.
+        Computes the descriptors of an image, and the time spent on each.
+
+        The image is decoded once (at a reduced resolution in draft mode), and every descriptor is computed from its
+        uint8 pixels.
 
         Args:
             image (Image.Image): The input image.
 
         Returns:
-            np.ndarray: The normalized pixel values.
+            tuple[tuple[np.ndarray, ...], tuple[float, ...]]: The flat descriptors and the seconds spent computing
+                each, in the configured order.
         """
 
         # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+        logging.debug('Computing the descriptors for %s...', getattr(image, 'filename', ''))
 
-        # Convert the image to a numpy array
-        pixels: np.ndarray = np.asarray(image)
+        # Let the JPEG decoder reduce the resolution in draft mode
+        if self._draft_scale > 1 and image.format == 'JPEG':
+            image.draft('RGB', (image.width // self._draft_scale, image.height // self._draft_scale))
 
-        # Normalize the pixel values by dividing them by the maximum possible value
-        normalized_pixels = pixels / (pow(2, image.bits) - 1)
+        # Decode the image
+        with INSTRUMENTATION.stage('decode'):
+            image.load()
+        INSTRUMENTATION.count('images_decoded')
 
-        return normalized_pixels
+        with INSTRUMENTATION.stage('histogram'):
+            return self._describe(image)
 
-    def _rgb_to_luma(self, image: np.ndarray) -> np.ndarray:
+    def _describe(self, image: Image.Image) -> tuple[tuple[np.ndarray, ...], tuple[float, ...]]:
         """
-        Converts an RGB image to grayscale using the luma formula.
+        Computes the descriptors of a decoded image, and the time spent on each.
 
         Args:
-            image (np.ndarray): The input RGB image.
+            image (Image.Image): The decoded image.
 
         Returns:
-            np.ndarray: The grayscale image.
+            tuple[tuple[np.ndarray, ...], tuple[float, ...]]: The flat descriptors and the seconds spent computing
+                each (including the shared intermediates each one computed first), in the configured order.
         """
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+        # Keep the uint8 pixel values of the image, shared by every extractor with their intermediates
+        features: Features = Features(self._pixels(image))
 
-        # Convert the RGB image to grayscale using the luma formula
-        image_luma: np.ndarray = np.array(
-            0.299 * image[:, :, 0] +
-            0.587 * image[:, :, 1] +
-            0.114 * image[:, :, 2]
-            )
+        descriptors: list[np.ndarray] = []
+        seconds: list[float] = []
+        for extractor in self._extractors:
+            start: float = time.perf_counter()
+            descriptors.append(extractor.extract(features))
+            seconds.append(time.perf_counter() - start)
+            INSTRUMENTATION.observe(f'descriptor_{extractor.name}', seconds[-1])
 
-        return image_luma
+        return tuple(descriptors), tuple(seconds)
 
-    def histograms(self, image: Image.Image) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    def draft_drift(self, image_paths: list[str], sample: int | None = None, seed: int = 0) -> dict:
         """
-        Public method that computes the histograms of an image (luma and RGB).
+        Measures how far the histograms of the draft mode drift from the full resolution ones.
 
         Args:
-            image (Image.Image): The input image.
+            image_paths (list[str]): The paths to the images to measure.
+            sample (int | None): The number of images measured, drawn at random among the paths, None for all.
+            seed (int): The seed of the choice of the sample.
 
         Returns:
-            tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
-                The corresponding histograms: luma256, RGB 2x2x2, RGB 4x4x4, RGB 6x6x6.
+            dict: The draft scale, the bound of the drift, the number of measured images, and the mean and maximum L1
+                distance between the draft and full resolution histograms of each configured descriptor.
         """
-            # nbins (int): The number of bins for the histograms.
-
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
-
-        # Logging information
-        logging.info(f'Computing the histograms for {os.path.basename(image.filename)}...')
-
-        # Normalize the pixel values of the image
-        pixels: np.ndarray = self._normalize_image(image)
-
-        # Compute the RGB histograms
-        rgb_histo_2x2x2: np.ndarray = self._compute_histograms(pixels, 2)
-        rgb_histo_4x4x4: np.ndarray = self._compute_histograms(pixels, 4)
-        rgb_histo_6x6x6: np.ndarray = self._compute_histograms(pixels, 6)
-
-        # Convert the image to grayscale
-        grayscale_pixels: np.ndarray = self._rgb_to_luma(pixels)
-
-        # Compute the luma histogram
-        gray_histo: np.ndarray = self._compute_histograms(grayscale_pixels, 256)
 
-        # Return the histograms
-        return (gray_histo, rgb_histo_2x2x2, rgb_histo_4x4x4, rgb_histo_6x6x6)
+        # Measure a random sample of the images
+        if sample is not None and sample < len(image_paths):
+            chosen: np.ndarray = np.random.default_rng(seed).choice(len(image_paths), max(0, sample), replace=False)
+            image_paths = [image_paths[position] for position in np.sort(chosen)]
+
+        full_resolution: JPicture = JPicture(self.descriptors)
+        drifts: np.ndarray = np.empty((len(image_paths), len(self.descriptors)))
+
+        for position, image_path in enumerate(image_paths):
+            with Image.open(image_path) as image:
+                image.load()
+                expected: tuple[np.ndarray, ...] = full_resolution._describe(image)[0]
+            with Image.open(image_path) as image:
+                found: tuple[np.ndarray, ...] = self.histograms(image)
+            drifts[position] = [np.abs(a - b).sum() for a, b in zip(found, expected)]
+
+        return {
+            'draft_scale': self._draft_scale,
+            'images': len(image_paths),
+            'bound': self.DRAFT_DRIFT_BOUNDS.get(self._draft_scale, 0.0),
+            'histograms': {
+                name: {'mean': float(drifts[:, column].mean()), 'max': float(drifts[:, column].max())}
+                for column, name in enumerate(self.descriptors)
+            } if image_paths else {}
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Checks that the draft mode histograms drift from the full resolution ones by at most DRAFT_DRIFT_BOUNDS'
+    )
+    parser.add_argument('images', help='Folder of the images')
+    parser.add_argument('--draft-scale', type=int, nargs='+', default=[2, 4, 8], help='Reductions of the JPEG decoding resolution to check (2, 4 or 8)')
+    parser.add_argument('--sample', type=int, default=None, help='Number of images checked, drawn at random, all by default')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the choice of the sample')
+    arguments = parser.parse_args()
+
+    image_paths: list[str] = [
+        os.path.join(arguments.images, filename) for filename in sorted(os.listdir(arguments.images))
+        if filename.lower().endswith(('.jpg', '.jpeg'))
+    ]
+
+    failed: bool = False
+    for draft_scale in arguments.draft_scale:
+        drift: dict = JPicture(draft_scale=draft_scale).draft_drift(image_paths, arguments.sample, arguments.seed)
+        print(json.dumps(drift, indent=2))
+
+        # Fail if a histogram drifts further than the documented bound
+        for name, values in drift['histograms'].items():
+            if values['max'] > drift['bound']:
+                print(f'{name} drifts by {values["max"]:.3f} at scale 1/{draft_scale}, above the bound {drift["bound"]}', file=sys.stderr)
+                failed = True
+
+    sys.exit(int(failed))
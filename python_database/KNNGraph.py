@@ -0,0 +1,371 @@
+import inspect
+import logging
+import multiprocessing
+import numpy as np
+import os
+from .Quantization import Quantizer
+from .SearchEngine import SearchEngine
+
+
+# Search engine used by the worker processes of a parallel graph build
+_worker_engine: SearchEngine
+
+
+def _init_worker(matrix: np.ndarray, files: list[str], metric: str, quantizer: Quantizer | None):
+    """
+    Initializes a worker process of a parallel graph build. Forked workers share the memory map of the matrix.
+
+    Args:
+        matrix (np.ndarray): The descriptors, one row per file.
+        files (list[str]): The filename of the image described by each row.
+        metric (str): The name of the distance metric.
+        quantizer (Quantizer | None): The quantizer of a compact matrix.
+    """
+
+    global _worker_engine
+    _worker_engine = SearchEngine(matrix, files, metric, quantizer)
+
+
+def _neighbours_block(task: tuple[np.ndarray, int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the nearest neighbours of a block of rows in a worker process, each row excluded from its neighbours.
+
+    Args:
+        task (tuple[np.ndarray, int]): The rows and the number of neighbours.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The (rows, k) neighbours and their distances, by increasing distance.
+    """
+
+    rows, k = task
+    return _worker_engine.batch_search(_worker_engine.vectors(rows), k, rows)
+
+
+class KNNGraph:
+    """
+    A class representing the precomputed k-nearest neighbours graph of a descriptor set: the k nearest rows of every
+    row (the row itself excluded) and their distances, stored as compact (N, k) int32 and float32 arrays. A query
+    for an image of the collection with at most k results is then a lookup of its row.
+
+    The graph is built with the blocked distance kernels of batch_search(), blocks of rows being spread over worker
+    processes. The results are the ones of batch_search(), the same as request() up to the rounding differences of
+    the metrics computed with products. After an incremental indexing, patch() recomputes only the rows that were
+    added or changed, the rows that had one of them (or a removed row) as a neighbour, and merges the changed rows
+    into the neighbours of the others.
+
+    Attributes:
+        metric (str): The name of the distance metric.
+        k (int): The number of neighbours of each row.
+        files (list[str]): The filename of the image of each row.
+        neighbours (np.ndarray): The (N, k) rows of the neighbours of each row, by increasing distance.
+        distances (np.ndarray): The (N, k) distances of the neighbours.
+        generation (int): The generation of the descriptor store the graph was computed on, -1 for a text file.
+        evaluations (int): The number of distance evaluations of the last search (always 0).
+        _rows (dict[str, int]): The row of each filename.
+
+    Methods:
+        __init__(self, metric, k, files, neighbours, distances, generation): Initializes the KNNGraph object.
+        _neighbours(engine, rows, k, workers, block_rows): Finds the nearest neighbours of rows of an engine.
+        build(matrix, files, metric, k, workers, quantizer, generation): Builds the graph of a descriptor set.
+        patch(self, matrix, files, changed, workers, quantizer, generation): Updates the graph after an indexing.
+        save(self, path: str): Saves the graph.
+        load(path: str): Loads a graph.
+        row(self, image_name: str): Returns the row of an image.
+        search(self, image_name: str, k: int): Returns the nearest neighbours of an image of the collection.
+    """
+
+    EXTENSION: str = '.knn.npz'
+
+    metric: str
+    k: int
+    files: list[str]
+    neighbours: np.ndarray
+    distances: np.ndarray
+    generation: int
+    evaluations: int
+    _rows: dict[str, int]
+
+    def __init__(
+            self,
+            metric: str,
+            k: int,
+            files: list[str],
+            neighbours: np.ndarray,
+            distances: np.ndarray,
+            generation: int = -1
+            ):
+        """
+        Initializes the KNNGraph object from its arrays.
+
+        Args:
+            metric (str): The name of the distance metric.
+            k (int): The number of neighbours of each row.
+            files (list[str]): The filename of the image of each row.
+            neighbours (np.ndarray): The (N, k) rows of the neighbours of each row.
+            distances (np.ndarray): The (N, k) distances of the neighbours.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+        """
+
+        self.metric = metric
+        self.k = k
+        self.files = list(files)
+        self.neighbours = neighbours
+        self.distances = distances
+        self.generation = generation
+        self.evaluations = 0
+
+        # Map each filename to its row, keeping the first row of a duplicated filename like SearchEngine
+        self._rows = {}
+        for row, filename in enumerate(self.files):
+            self._rows.setdefault(filename, row)
+
+    @staticmethod
+    def _neighbours(
+            engine: SearchEngine,
+            rows: np.ndarray,
+            k: int,
+            workers: int | None = None,
+            block_rows: int = 256
+            ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of rows of a search engine, each row excluded from its neighbours, by blocks of
+        rows spread over worker processes.
+
+        Args:
+            engine (SearchEngine): The search engine over the descriptors.
+            rows (np.ndarray): The rows whose neighbours are found.
+            k (int): The number of neighbours.
+            workers (int | None): The number of worker processes, None for every core, 1 for the current process.
+            block_rows (int): The number of rows per block.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (rows, k) int32 neighbours and float32 distances.
+        """
+
+        neighbours: np.ndarray = np.empty((rows.shape[0], k), dtype=np.int32)
+        distances: np.ndarray = np.empty((rows.shape[0], k), dtype=np.float32)
+        tasks: list[tuple[np.ndarray, int]] = [(rows[start:start + block_rows], k) for start in range(0, rows.shape[0], block_rows)]
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(tasks))
+
+        if workers <= 1:
+            results = (engine.batch_search(engine.vectors(block), k, block) for block, _ in tasks)
+            for position, (block_neighbours, block_distances) in zip(range(0, rows.shape[0], block_rows), results):
+                neighbours[position:position + block_rows] = block_neighbours
+                distances[position:position + block_rows] = block_distances
+            return neighbours, distances
+
+        # Workers get the engine arguments at fork, so a memory-mapped matrix is shared rather than copied
+        with multiprocessing.Pool(
+                workers, initializer=_init_worker, initargs=(engine.matrix, engine.files, engine.metric.name, engine.quantizer)
+                ) as pool:
+            # imap returns the blocks in order, whatever the worker that computed them
+            for position, (block_neighbours, block_distances) in zip(
+                    range(0, rows.shape[0], block_rows), pool.imap(_neighbours_block, tasks)
+                    ):
+                neighbours[position:position + block_rows] = block_neighbours
+                distances[position:position + block_rows] = block_distances
+
+        return neighbours, distances
+
+    @staticmethod
+    def build(
+            matrix: np.ndarray,
+            files: list[str],
+            metric: str = 'chebyshev',
+            k: int = 30,
+            workers: int | None = None,
+            quantizer: Quantizer | None = None,
+            generation: int = -1
+            ) -> 'KNNGraph':
+        """
+        Builds the k-nearest neighbours graph of a descriptor set.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one row per file.
+            files (list[str]): The filename of the image described by each row.
+            metric (str): The name of the distance metric (see Metrics.METRICS).
+            k (int): The number of neighbours of each row.
+            workers (int | None): The number of worker processes, None for every core, 1 for the current process.
+            quantizer (Quantizer | None): The quantizer of a compact matrix.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+
+        Returns:
+            KNNGraph: The graph.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        engine: SearchEngine = SearchEngine(matrix, files, metric, quantizer)
+        k = max(0, min(k, matrix.shape[0] - 1))
+        neighbours, distances = KNNGraph._neighbours(engine, np.arange(matrix.shape[0]), k, workers)
+
+        return KNNGraph(metric, k, files, neighbours, distances, generation)
+
+    def patch(
+            self,
+            matrix: np.ndarray,
+            files: list[str],
+            changed: list[str],
+            workers: int | None = None,
+            quantizer: Quantizer | None = None,
+            generation: int = -1
+            ):
+        """
+        Updates the graph after an incremental indexing, in place. The rows of the images that are new or changed,
+        and the rows that had one of them or a removed image as a neighbour, are recomputed. The other rows only
+        merge the changed rows into their neighbours (the metrics are symmetric), their order being updated to the
+        new rows: equal distances at the k-th neighbour may then be ordered differently than by a new build.
+
+        Args:
+            matrix (np.ndarray): The descriptors after the indexing, one row per file.
+            files (list[str]): The filename of the image described by each row after the indexing.
+            changed (list[str]): The filenames of the images whose descriptors were updated in place.
+            workers (int | None): The number of worker processes, None for every core, 1 for the current process.
+            quantizer (Quantizer | None): The quantizer of a compact matrix.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        engine: SearchEngine = SearchEngine(matrix, files, self.metric, quantizer)
+        count: int = matrix.shape[0]
+        k: int = max(0, min(self.k, count - 1))
+
+        # New row of each old row, -1 for the images removed or changed (their old neighbours are invalid)
+        changed_set: set[str] = set(changed)
+        new_rows: dict[str, int] = {}
+        for row, filename in enumerate(files):
+            new_rows.setdefault(filename, row)
+        old_to_new: np.ndarray = np.array(
+            [-1 if filename in changed_set else new_rows.get(filename, -1) for filename in self.files] + [-1],
+            dtype=np.intp
+        )
+
+        # Rows whose descriptor is new or changed
+        old_files: set[str] = set(self.files)
+        dirty: np.ndarray = np.array(
+            [row for row, filename in enumerate(files) if filename in changed_set or filename not in old_files],
+            dtype=np.intp
+        )
+
+        # Old neighbour lists, renumbered to the new rows: a list pointing to a removed or changed row is invalid
+        neighbours: np.ndarray = np.empty((count, k), dtype=np.int32)
+        distances: np.ndarray = np.empty((count, k), dtype=np.float32)
+        kept: np.ndarray = np.zeros(count, dtype=bool)
+        old_rows: np.ndarray = np.flatnonzero(old_to_new[:-1] >= 0)
+        if old_rows.size and k == self.k:
+            renumbered: np.ndarray = old_to_new[self.neighbours[old_rows]]
+            valid: np.ndarray = np.all(renumbered >= 0, axis=1)
+            targets: np.ndarray = old_to_new[old_rows[valid]]
+            neighbours[targets] = renumbered[valid]
+            distances[targets] = self.distances[old_rows[valid]]
+            kept[targets] = True
+
+        # Merge the changed rows into the kept lists: the distances of the changed rows to every row
+        kept_rows: np.ndarray = np.flatnonzero(kept)
+        if dirty.size and kept_rows.size:
+            dirty_vectors: np.ndarray = engine.vectors(dirty)
+            dirty_state: dict[str, np.ndarray] = engine.metric.prepare(dirty_vectors)
+            for start in range(0, kept_rows.shape[0], 1024):
+                rows: np.ndarray = kept_rows[start:start + 1024]
+                block: np.ndarray = engine.metric.block_distances(engine.vectors(rows), dirty_vectors, dirty_state)
+                candidates: np.ndarray = np.concatenate((neighbours[rows], np.broadcast_to(dirty, block.shape)), axis=1)
+                candidate_distances: np.ndarray = np.concatenate((distances[rows], block.astype(np.float32)), axis=1)
+                order: np.ndarray = np.lexsort((candidates, candidate_distances))[:, :k]
+                neighbours[rows] = np.take_along_axis(candidates, order, axis=1)
+                distances[rows] = np.take_along_axis(candidate_distances, order, axis=1)
+
+        # Recompute the new and changed rows and the rows whose lists are invalid
+        recomputed: np.ndarray = np.union1d(dirty, np.flatnonzero(~kept))
+        if recomputed.size:
+            neighbours[recomputed], distances[recomputed] = self._neighbours(engine, recomputed, k, workers)
+
+        self.k = k
+        self.neighbours = neighbours
+        self.distances = distances
+        self.generation = generation
+        self.files = list(files)
+        self._rows = {}
+        for row, filename in enumerate(self.files):
+            self._rows.setdefault(filename, row)
+
+        # Logging information
+        logging.info(f'k-NN graph patched: {recomputed.size} rows recomputed, {kept_rows.size} rows merged with {dirty.size} changed rows')
+
+    def save(self, path: str):
+        """
+        Saves the graph, e.g. next to its descriptor file.
+
+        Args:
+            path (str): The path to the .npz file.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Write next to the destination then move, so that a reader never sees a partially written graph
+        temporary_path: str = f'{path}.tmp.npz'
+        np.savez(
+            temporary_path,
+            neighbours=self.neighbours, distances=self.distances, files=np.array(self.files, dtype=str),
+            metric=np.array(self.metric), k=np.array(self.k), generation=np.array(self.generation)
+        )
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'KNNGraph':
+        """
+        Loads a graph saved by save().
+
+        Args:
+            path (str): The path to the .npz file.
+
+        Returns:
+            KNNGraph: The graph.
+        """
+
+        with np.load(path) as data:
+            return KNNGraph(
+                str(data['metric']), int(data['k']), data['files'].tolist(), data['neighbours'], data['distances'],
+                int(data['generation'])
+            )
+
+    def row(self, image_name: str) -> int:
+        """
+        Returns the row of an image.
+
+        Args:
+            image_name (str): The filename of the image.
+
+        Returns:
+            int: The row of the image in the graph.
+        """
+
+        try:
+            return self._rows[image_name]
+        except KeyError:
+            raise ValueError(f'{image_name} is not in the database') from None
+
+    def search(self, image_name: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the nearest neighbours of an image of the collection, the image itself excluded.
+
+        Args:
+            image_name (str): The filename of the query image.
+            k (int): The number of neighbours, at most the k of the graph.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The rows of the neighbours and their distances, by increasing distance.
+        """
+
+        if k > self.k:
+            raise ValueError(f'The graph holds {self.k} neighbours per image, not {k}')
+
+        row: int = self.row(image_name)
+
+        return self.neighbours[row, :k], self.distances[row, :k]
@@ -0,0 +1,139 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+
+
+class Manifest:
+    """
+    A class representing the manifest of an indexed database: for each indexed image, its size, modification time,
+    content hash and the version of each descriptor computed for it.
+
+    Attributes:
+        path (str): The path to the manifest file.
+        entries (dict[str, dict]): The manifest entry of each indexed image, by filename.
+
+    Methods:
+        __init__(self, path: str): Loads the manifest, or starts an empty one.
+        file_signature(path: str): Returns the size and modification time of a file.
+        content_hash(path: str): Computes the content hash of a file.
+        is_current(self, filename: str, signature: tuple[int, int], versions: dict[str, int]): Checks an entry.
+        set(self, filename: str, signature: tuple[int, int], content_hash: str, versions: dict[str, int]): Records an image.
+        remove(self, filename: str): Forgets an image.
+        save(self): Writes the manifest to disk.
+    """
+
+    path: str
+    entries: dict[str, dict]
+
+    def __init__(self, path: str):
+        """
+        Loads the manifest, or starts an empty one if the file doesn't exist.
+
+        Args:
+            path (str): The path to the manifest file.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        self.path = path
+        self.entries = {}
+
+        # Load the existing manifest
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def file_signature(path: str) -> tuple[int, int]:
+        """
+        Returns the size and modification time of a file.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            tuple[int, int]: The size in bytes and the modification time in nanoseconds.
+        """
+
+        stat: os.stat_result = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def content_hash(path: str) -> str:
+        """
+        Computes the content hash of a file.
+
+        Args:
+            path (str): The path to the file.
+
+        Returns:
+            str: The SHA-256 digest of the file content, in hexadecimal.
+        """
+
+        with open(path, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def is_current(self, filename: str, signature: tuple[int, int], versions: dict[str, int]) -> bool:
+        """
+        Checks whether an image is indexed with the given signature and descriptor versions.
+
+        Args:
+            filename (str): The filename of the image.
+            signature (tuple[int, int]): The current size and modification time of the image.
+            versions (dict[str, int]): The current version of each descriptor.
+
+        Returns:
+            bool: True if the image doesn't need to be indexed again.
+        """
+
+        entry: dict | None = self.entries.get(filename)
+        return (
+            entry is not None
+            and (entry['size'], entry['mtime']) == signature
+            and entry['descriptors'] == versions
+        )
+
+    def set(self, filename: str, signature: tuple[int, int], content_hash: str, versions: dict[str, int]):
+        """
+        Records an indexed image.
+
+        Args:
+            filename (str): The filename of the image.
+            signature (tuple[int, int]): The size and modification time of the image.
+            content_hash (str): The content hash of the image.
+            versions (dict[str, int]): The version of each descriptor computed for the image.
+        """
+
+        self.entries[filename] = {
+            'size': signature[0],
+            'mtime': signature[1],
+            'hash': content_hash,
+            'descriptors': dict(versions)
+        }
+
+    def remove(self, filename: str):
+        """
+        Forgets an image.
+
+        Args:
+            filename (str): The filename of the image.
+        """
+
+        self.entries.pop(filename, None)
+
+    def save(self):
+        """
+        Writes the manifest to disk. The file is written next to its destination then moved, so that an interruption
+        leaves the previous checkpoint intact.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        temporary_path: str = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(self.entries, file)
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,272 @@
+import numpy as np
+
+
+class Metric:
+    """
+    Base class of the distance metrics used to compare descriptors.
+
+    Each metric computes the distances between one query and every row of a matrix (one operation over the matrix)
+    and between a block of queries and a block of rows. Values that only depend on the rows and hold one number per
+    row (norms) are computed once by prepare() and given back to both kernels, sliced like the rows. Transforms as
+    large as the rows (square roots, cumulative sums) are not kept: the kernels compute them on the rows they are
+    given, so that a memory-mapped matrix is never copied whole, and the engines scan these metrics block by block.
+
+    The distance of a row computed by the one-query kernel doesn't depend on the other rows given with it (matrix-vector
+    products use einsum rather than BLAS, whose rounding depends on the blocking), so that searching a subset of the
+    rows, as indexes do, gives the same values as searching the whole matrix.
+
+    Attributes:
+        name (str): The name of the metric in the registry.
+        is_metric (bool): True if the distance is a true metric (triangle inequality), as required by metric trees.
+        uses_products (bool): True if the kernels use dot products with precomputed row values, whose rounding error
+            is larger than the one of element-wise kernels.
+        transforms_rows (bool): True if the kernels transform the rows they are given (as large as the rows), so that
+            a scan of a whole matrix goes block by block.
+
+    Methods:
+        prepare(self, matrix: np.ndarray): Precomputes the values that only depend on the rows.
+        distances(self, query: np.ndarray, matrix: np.ndarray, state: dict): One query against every row.
+        block_distances(self, queries: np.ndarray, matrix: np.ndarray, state: dict): A block of queries against rows.
+    """
+
+    name: str = ''
+    is_metric: bool = True
+    uses_products: bool = False
+    transforms_rows: bool = False
+
+    def prepare(self, matrix: np.ndarray) -> dict[str, np.ndarray]:
+        """
+        Precomputes the values that only depend on the rows of the matrix.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one per row.
+
+        Returns:
+            dict[str, np.ndarray]: The precomputed values, one entry (or row) per row of the matrix.
+        """
+
+        return {}
+
+    def distances(self, query: np.ndarray, matrix: np.ndarray, state: dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Computes the distances between a query and every row of a matrix.
+
+        Args:
+            query (np.ndarray): The query descriptor.
+            matrix (np.ndarray): The descriptors, one per row.
+            state (dict[str, np.ndarray]): The values precomputed by prepare() for these rows.
+
+        Returns:
+            np.ndarray: The distance to each row.
+        """
+
+        return self.block_distances(query[np.newaxis, :], matrix, state)[0]
+
+    def block_distances(self, queries: np.ndarray, matrix: np.ndarray, state: dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Computes the distances between a block of queries and a block of rows.
+
+        Args:
+            queries (np.ndarray): The query descriptors, one per row.
+            matrix (np.ndarray): The descriptors, one per row.
+            state (dict[str, np.ndarray]): The values precomputed by prepare() for these rows.
+
+        Returns:
+            np.ndarray: The (queries, rows) block of distances.
+        """
+
+        raise NotImplementedError
+
+
+class L1(Metric):
+    """
+    Manhattan distance: sum of the absolute differences.
+    """
+
+    name = 'l1'
+
+    def distances(self, query, matrix, state):
+        return np.sum(np.abs(matrix - query), axis=1)
+
+    def block_distances(self, queries, matrix, state):
+        return np.sum(np.abs(queries[:, np.newaxis, :] - matrix[np.newaxis, :, :]), axis=2)
+
+
+class L2(Metric):
+    """
+    Euclidean distance, expanded as |q|^2 + |m|^2 - 2 q.m so that a query costs a single matrix-vector product
+    with the precomputed squared row norms.
+    """
+
+    name = 'l2'
+    uses_products = True
+
+    def prepare(self, matrix):
+        return {'squared_norms': np.einsum('ij,ij->i', matrix, matrix)}
+
+    def distances(self, query, matrix, state):
+        squared: np.ndarray = state['squared_norms'] - 2 * np.einsum('ij,j->i', matrix, query) + np.dot(query, query)
+        return np.sqrt(np.maximum(squared, 0))
+
+    def block_distances(self, queries, matrix, state):
+        squared: np.ndarray = (
+            state['squared_norms'][np.newaxis, :]
+            - 2 * (queries @ matrix.T)
+            + np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+        )
+        return np.sqrt(np.maximum(squared, 0))
+
+
+class Chebyshev(Metric):
+    """
+    Chebyshev distance: largest absolute difference.
+    """
+
+    name = 'chebyshev'
+
+    def distances(self, query, matrix, state):
+        return np.max(np.abs(matrix - query), axis=1)
+
+    def block_distances(self, queries, matrix, state):
+        return np.max(np.abs(queries[:, np.newaxis, :] - matrix[np.newaxis, :, :]), axis=2)
+
+
+class HistogramIntersection(Metric):
+    """
+    Histogram intersection turned into a distance: 1 - sum of the bin-wise minimums (normalized histograms).
+    """
+
+    name = 'intersection'
+    is_metric = False
+
+    def distances(self, query, matrix, state):
+        return 1 - np.sum(np.minimum(matrix, query), axis=1)
+
+    def block_distances(self, queries, matrix, state):
+        return 1 - np.sum(np.minimum(queries[:, np.newaxis, :], matrix[np.newaxis, :, :]), axis=2)
+
+
+class ChiSquare(Metric):
+    """
+    Chi-square distance: 1/2 sum of (q - m)^2 / (q + m), bins empty in both histograms counting for 0.
+    """
+
+    name = 'chi2'
+    is_metric = False
+
+    @staticmethod
+    def _chi2(difference: np.ndarray, total: np.ndarray, axis: int) -> np.ndarray:
+        # Divide only where the bins are not both empty
+        terms: np.ndarray = np.divide(difference * difference, total, out=np.zeros_like(total), where=total > 0)
+        return 0.5 * np.sum(terms, axis=axis)
+
+    def distances(self, query, matrix, state):
+        return self._chi2(matrix - query, matrix + query, 1)
+
+    def block_distances(self, queries, matrix, state):
+        return self._chi2(
+            queries[:, np.newaxis, :] - matrix[np.newaxis, :, :],
+            queries[:, np.newaxis, :] + matrix[np.newaxis, :, :],
+            2
+        )
+
+
+class Hellinger(Metric):
+    """
+    Hellinger distance: sqrt(1 - BC), BC being the Bhattacharyya coefficient sum(sqrt(q m)) of normalized
+    histograms, computed with a single matrix-vector product over the square roots of the rows.
+    """
+
+    name = 'hellinger'
+    uses_products = True
+    transforms_rows = True
+
+    def _from_coefficients(self, coefficients: np.ndarray) -> np.ndarray:
+        return np.sqrt(np.maximum(1 - coefficients, 0))
+
+    def distances(self, query, matrix, state):
+        return self._from_coefficients(np.einsum('ij,j->i', np.sqrt(matrix), np.sqrt(query)))
+
+    def block_distances(self, queries, matrix, state):
+        return self._from_coefficients(np.sqrt(queries) @ np.sqrt(matrix).T)
+
+
+class Bhattacharyya(Hellinger):
+    """
+    Bhattacharyya distance: -ln(BC), BC being the Bhattacharyya coefficient of normalized histograms.
+    """
+
+    name = 'bhattacharyya'
+    is_metric = False
+
+    def _from_coefficients(self, coefficients: np.ndarray) -> np.ndarray:
+        # A coefficient of 0 (disjoint histograms) gives an infinite distance
+        with np.errstate(divide='ignore'):
+            return -np.log(np.clip(coefficients, 0, 1))
+
+
+class Cosine(Metric):
+    """
+    Cosine distance: 1 - q.m / (|q| |m|), computed with a single matrix-vector product and the precomputed row norms.
+    Null vectors are at distance 1 of everything.
+    """
+
+    name = 'cosine'
+    is_metric = False
+    uses_products = True
+
+    def prepare(self, matrix):
+        return {'norms': np.sqrt(np.einsum('ij,ij->i', matrix, matrix))}
+
+    @staticmethod
+    def _from_products(products: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        similarities: np.ndarray = np.divide(products, norms, out=np.zeros_like(products), where=norms > 0)
+        return 1 - similarities
+
+    def distances(self, query, matrix, state):
+        return self._from_products(np.einsum('ij,j->i', matrix, query), state['norms'] * np.linalg.norm(query))
+
+    def block_distances(self, queries, matrix, state):
+        norms: np.ndarray = np.linalg.norm(queries, axis=1)[:, np.newaxis] * state['norms'][np.newaxis, :]
+        return self._from_products(queries @ matrix.T, norms)
+
+
+class EMD1D(Metric):
+    """
+    Earth mover's distance between 1-D histograms (e.g. grey levels): sum of the absolute differences of the
+    cumulative histograms. Meaningless for flattened RGB histograms.
+    """
+
+    name = 'emd'
+    transforms_rows = True
+
+    def distances(self, query, matrix, state):
+        return np.sum(np.abs(np.cumsum(matrix, axis=1) - np.cumsum(query)), axis=1)
+
+    def block_distances(self, queries, matrix, state):
+        return np.sum(np.abs(np.cumsum(queries, axis=1)[:, np.newaxis, :] - np.cumsum(matrix, axis=1)[np.newaxis, :, :]), axis=2)
+
+
+# Registry of the available metrics, by name
+METRICS: dict[str, Metric] = {
+    metric.name: metric
+    for metric in (L1(), L2(), Chebyshev(), HistogramIntersection(), ChiSquare(), Hellinger(), Bhattacharyya(),
+                   Cosine(), EMD1D())
+}
+
+
+def get_metric(name: str) -> Metric:
+    """
+    Returns a metric of the registry.
+
+    Args:
+        name (str): The name of the metric.
+
+    Returns:
+        Metric: The metric.
+    """
+
+    try:
+        return METRICS[name]
+    except KeyError:
+        raise ValueError(f'Unknown metric {name}, available metrics: {", ".join(METRICS)}') from None
@@ -0,0 +1,396 @@
+import argparse
+import inspect
+import json
+import logging
+from .Metrics import get_metric, Metric
+import numpy as np
+import os
+from .SearchEngine import SearchEngine
+import time
+
+
+class ProjectionIndex:
+    """
+    A class representing a two-stage search over large descriptors (e.g. 256-bin grey histograms, 216-bin RGB
+    histograms or 512-dimensional CNN features), whose rows lie close to a much lower-dimensional subspace.
+
+    An offline fit projects every row onto a few dimensions, with a PCA (the principal axes of a sample of the rows)
+    or a random Gaussian projection, and stores the reduced matrix. A query is projected the same way, and the L2
+    distances in the reduced space, a product with the reduced matrix, select a shortlist of candidates. The
+    shortlist is then re-ranked with the exact distance of the metric on the original descriptors.
+
+    The results are the exact ones whenever the true neighbours fall in the shortlist: a larger shortlist or more
+    dimensions trade speed for agreement with the exact ranking, measured by agreement_report().
+
+    The projection is saved with the generation of the descriptor store (or the checksum of the text file) it was
+    fitted on, so that a reduced matrix outdated by an indexing run is not searched.
+
+    Attributes:
+        matrix (np.ndarray): The original descriptors, one per row.
+        metric (Metric): The distance metric of the re-ranking.
+        method (str): 'pca' or 'random'.
+        mean (np.ndarray): The mean row subtracted before the projection.
+        components (np.ndarray): The (dim, target dim) float32 projection.
+        reduced (np.ndarray): The (rows, target dim) float32 projected rows.
+        explained_variance (float): The share of the variance of the rows kept by a PCA (for a random projection,
+            the ratio of the projected variance to the original one, about 1).
+        shortlist (int): The number of candidates re-ranked with the exact distances.
+        generation (int): The generation of the descriptor store the projection was fitted on, -1 for a text file.
+        checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+        _reduced_norms (np.ndarray): The squared norm of each projected row.
+
+    Methods:
+        __init__(self, matrix, metric, arrays, shortlist, generation, checksum): Initializes the ProjectionIndex
+            object from its arrays.
+        _project(self, rows: np.ndarray): Projects rows onto the reduced space.
+        build(matrix: np.ndarray, metric, dim, method, shortlist, train_size, seed, generation, checksum): Fits the
+            projection.
+        save(self, path: str): Saves the projection and the reduced matrix.
+        load(path: str, matrix: np.ndarray, metric: str): Loads a projection.
+        search(self, query: np.ndarray, k: int, exclude: int): Finds the k nearest rows of a query.
+        agreement_report(self, query_rows: np.ndarray, k: int, shortlists): Measures the top-k agreement and the
+            speedup against a brute-force search.
+    """
+
+    EXTENSION: str = '.projection.npz'
+
+    matrix: np.ndarray
+    metric: Metric
+    method: str
+    mean: np.ndarray
+    components: np.ndarray
+    reduced: np.ndarray
+    explained_variance: float
+    shortlist: int
+    generation: int
+    checksum: str
+    _reduced_norms: np.ndarray
+
+    def __init__(
+            self,
+            matrix: np.ndarray,
+            metric: str,
+            arrays: dict[str, np.ndarray],
+            shortlist: int = 200,
+            generation: int = -1,
+            checksum: str = ''
+            ):
+        """
+        Initializes the ProjectionIndex object from its arrays.
+
+        Args:
+            matrix (np.ndarray): The original descriptors, one per row.
+            metric (str): The name of the distance metric of the re-ranking (see Metrics.METRICS).
+            arrays (dict[str, np.ndarray]): The projection arrays (method, mean, components, reduced,
+                explained_variance).
+            shortlist (int): The number of candidates re-ranked with the exact distances.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+            checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+        """
+
+        self.matrix = matrix
+        self.metric = get_metric(metric)
+        self.method = str(arrays['method'])
+        self.mean = arrays['mean']
+        self.components = arrays['components']
+        self.reduced = arrays['reduced']
+        self.explained_variance = float(arrays['explained_variance'])
+        self.shortlist = shortlist
+        self.generation = generation
+        self.checksum = checksum
+        self._reduced_norms = np.einsum('ij,ij->i', self.reduced, self.reduced)
+
+    def _project(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Projects rows onto the reduced space.
+
+        Args:
+            rows (np.ndarray): The rows, or a single descriptor.
+
+        Returns:
+            np.ndarray: The float32 projected rows.
+        """
+
+        return (np.asarray(rows, dtype=np.float32) - self.mean) @ self.components
+
+    @staticmethod
+    def build(
+            matrix: np.ndarray,
+            metric: str = 'chebyshev',
+            dim: int = 32,
+            method: str = 'pca',
+            shortlist: int = 200,
+            train_size: int = 20000,
+            seed: int = 0,
+            generation: int = -1,
+            checksum: str = ''
+            ) -> 'ProjectionIndex':
+        """
+        Fits the projection on a random sample of the rows, and projects every row.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one per row.
+            metric (str): The name of the distance metric of the re-ranking (see Metrics.METRICS).
+            dim (int): The target dimension, at most the dimension of the descriptors.
+            method (str): 'pca' for the principal axes of the sample, 'random' for a random Gaussian projection.
+            shortlist (int): The default number of candidates re-ranked with the exact distances.
+            train_size (int): The number of rows the PCA is fitted on.
+            seed (int): The seed of the sampling and of the random projection.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+            checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+
+        Returns:
+            ProjectionIndex: The index.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        if method not in ('pca', 'random'):
+            raise ValueError(f'The projection method must be pca or random, not {method}')
+
+        rows: int = matrix.shape[0]
+        dim = max(1, min(dim, matrix.shape[1]))
+        rng: np.random.Generator = np.random.default_rng(seed)
+
+        # Fit on a sample, in float64 for the covariance
+        train: np.ndarray = np.asarray(matrix[np.sort(rng.choice(rows, min(rows, train_size), replace=False))], dtype=np.float64)
+        mean: np.ndarray = train.mean(axis=0)
+        centered: np.ndarray = train - mean
+
+        components: np.ndarray
+        explained: float
+        if method == 'pca':
+            # Principal axes: the eigenvectors of the covariance with the largest eigenvalues
+            eigenvalues: np.ndarray
+            eigenvectors: np.ndarray
+            eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered)
+            order: np.ndarray = np.argsort(eigenvalues)[::-1][:dim]
+            components = eigenvectors[:, order]
+            explained = float(eigenvalues[order].sum() / max(eigenvalues.sum(), np.finfo(np.float64).tiny))
+        else:
+            # Random Gaussian projection, scaled to preserve the distances on average
+            components = rng.standard_normal((matrix.shape[1], dim)) / np.sqrt(dim)
+            projected: np.ndarray = centered @ components
+            explained = float(np.sum(projected * projected) / max(np.sum(centered * centered), np.finfo(np.float64).tiny))
+
+        # Project every row, by blocks of rows
+        components = components.astype(np.float32)
+        mean = mean.astype(np.float32)
+        reduced: np.ndarray = np.empty((rows, dim), dtype=np.float32)
+        for start in range(0, rows, 65536):
+            reduced[start:start + 65536] = (np.asarray(matrix[start:start + 65536], dtype=np.float32) - mean) @ components
+
+        arrays: dict[str, np.ndarray] = {
+            'method': np.array(method),
+            'mean': mean,
+            'components': components,
+            'reduced': reduced,
+            'explained_variance': np.array(explained)
+        }
+
+        # Logging information
+        logging.info(f'{method} projection of {rows} rows from {matrix.shape[1]} to {dim} dimensions ({explained:.1%} of the variance)')
+
+        return ProjectionIndex(matrix, metric, arrays, shortlist, generation, checksum)
+
+    def save(self, path: str):
+        """
+        Saves the projection and the reduced matrix, e.g. next to their descriptor file.
+
+        Args:
+            path (str): The path to the .npz file.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Write next to the destination then move, so that a reader never sees a partially written projection
+        temporary_path: str = f'{path}.tmp.npz'
+        np.savez(
+            temporary_path,
+            method=np.array(self.method), mean=self.mean, components=self.components, reduced=self.reduced,
+            explained_variance=np.array(self.explained_variance), shortlist=np.array(self.shortlist),
+            shape=np.array(self.matrix.shape), generation=np.array(self.generation), checksum=np.array(self.checksum)
+        )
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path: str, matrix: np.ndarray, metric: str = 'chebyshev', shortlist: int | None = None) -> 'ProjectionIndex':
+        """
+        Loads a projection saved by save(). The same projection serves every metric of the re-ranking. The caller
+        checks its generation or checksum against the descriptors (a projection saved without them has none, and is
+        outdated).
+
+        Args:
+            path (str): The path to the .npz file.
+            matrix (np.ndarray): The descriptors the projection was fitted on.
+            metric (str): The name of the distance metric of the re-ranking (see Metrics.METRICS).
+            shortlist (int | None): The number of candidates re-ranked with the exact distances, None for the saved
+                one.
+
+        Returns:
+            ProjectionIndex: The index.
+        """
+
+        with np.load(path) as data:
+            # The projection is only valid for the matrix it was fitted on
+            if tuple(data['shape']) != matrix.shape:
+                raise ValueError(f'{path} was fitted on a {tuple(data["shape"])} matrix, not {matrix.shape}')
+
+            arrays: dict[str, np.ndarray] = {
+                name: data[name] for name in ('method', 'mean', 'components', 'reduced', 'explained_variance')
+            }
+            return ProjectionIndex(
+                matrix, metric, arrays, int(data['shortlist']) if shortlist is None else shortlist,
+                int(data['generation']) if 'generation' in data else -1,
+                str(data['checksum']) if 'checksum' in data else ''
+            )
+
+    def search(self, query: np.ndarray, k: int, exclude: int = -1) -> tuple[np.ndarray, np.ndarray, int]:
+        """
+        Finds the k nearest rows of a query: the shortlist of the rows nearest to it in the reduced space is
+        re-ranked with the exact distances.
+
+        Args:
+            query (np.ndarray): The query descriptor.
+            k (int): The number of rows to find.
+            exclude (int): A row to leave out of the results (e.g. the query image), -1 for none.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, int]: The rows and their distances by increasing distance (then by row),
+                and the number of (reduced or exact) distance evaluations the search needed.
+        """
+
+        # Squared L2 distances in the reduced space, |r - q|^2 = |r|^2 + |q|^2 - 2 r.q, the last term not
+        # changing the ranking
+        projected: np.ndarray = self._project(query)
+        estimates: np.ndarray = self._reduced_norms - 2 * (self.reduced @ projected)
+
+        # Re-rank the shortlist with the exact distances, in row order so that ties are ordered by row
+        shortlist: np.ndarray = np.sort(SearchEngine.top_k(estimates, max(k, self.shortlist), exclude))
+        rows: np.ndarray = self.matrix[shortlist]
+        distances: np.ndarray = self.metric.distances(np.asarray(query, dtype=rows.dtype), rows, self.metric.prepare(rows))
+        selected: np.ndarray = SearchEngine.top_k(distances, k)
+
+        return shortlist[selected], distances[selected], estimates.shape[0] + shortlist.shape[0]
+
+    def agreement_report(
+            self,
+            query_rows: np.ndarray,
+            k: int = 30,
+            shortlists: tuple[int, ...] = (50, 100, 200, 500, 1000)
+            ) -> dict:
+        """
+        Measures the top-k agreement with the exact ranking and the speedup of several shortlist sizes, against a
+        brute-force search of the original descriptors. Each query row is excluded from its own results.
+
+        Args:
+            query_rows (np.ndarray): The rows used as queries.
+            k (int): The number of neighbours searched.
+            shortlists (tuple[int, ...]): The shortlist sizes to measure.
+
+        Returns:
+            dict: The JSON-serializable report: the brute-force latency and, for each shortlist size, the mean share
+                of the exact top-k found, the share of queries whose top-k is exactly the same, the mean and 95th
+                percentile latencies, the speedup and the mean number of distance evaluations.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        def milliseconds(latencies: list[float]) -> dict[str, float]:
+            return {'mean_ms': float(np.mean(latencies)) * 1000, 'p95_ms': float(np.percentile(latencies, 95)) * 1000}
+
+        # Exact neighbours and brute-force latency
+        state: dict[str, np.ndarray] = self.metric.prepare(self.matrix)
+        exact: list[np.ndarray] = []
+        latencies: list[float] = []
+        for row in query_rows:
+            start: float = time.perf_counter()
+            distances: np.ndarray = self.metric.distances(self.matrix[row], self.matrix, state)
+            exact.append(SearchEngine.top_k(distances, k, int(row)))
+            latencies.append(time.perf_counter() - start)
+        brute_force: dict[str, float] = milliseconds(latencies)
+
+        # Restore the shortlist size of the index afterwards
+        setting: int = self.shortlist
+        results: list[dict] = []
+        try:
+            for shortlist in shortlists:
+                self.shortlist = shortlist
+                agreements: list[float] = []
+                identical: list[bool] = []
+                evaluations: list[int] = []
+                latencies = []
+                for row, neighbours in zip(query_rows, exact):
+                    start = time.perf_counter()
+                    found, _, count = self.search(self.matrix[row], k, int(row))
+                    latencies.append(time.perf_counter() - start)
+                    agreements.append(np.intersect1d(neighbours, found).shape[0] / max(1, neighbours.shape[0]))
+                    identical.append(np.array_equal(neighbours, found))
+                    evaluations.append(count)
+
+                result: dict = {
+                    'shortlist': shortlist,
+                    'agreement': float(np.mean(agreements)),
+                    'identical': float(np.mean(identical))
+                }
+                result.update(milliseconds(latencies))
+                result['speedup'] = brute_force['mean_ms'] / result['mean_ms']
+                result['evaluations'] = float(np.mean(evaluations))
+                results.append(result)
+
+                # Logging information
+                logging.info(f'shortlist={shortlist}: top-{k} agreement {result["agreement"]:.3f}, {result["mean_ms"]:.2f} ms ({result["speedup"]:.1f}x)')
+        finally:
+            self.shortlist = setting
+
+        return {
+            'rows': self.matrix.shape[0],
+            'dim': self.matrix.shape[1],
+            'method': self.method,
+            'reduced_dim': self.reduced.shape[1],
+            'explained_variance': self.explained_variance,
+            'metric': self.metric.name,
+            'queries': len(query_rows),
+            'k': k,
+            'brute_force': brute_force,
+            'results': results
+        }
+
+
+if __name__ == '__main__':
+    from .QBE import QBE
+
+    parser = argparse.ArgumentParser(description='Fits a projection prefilter and reports its top-k agreement vs speedup')
+    parser.add_argument('descriptor', help='Name of the descriptor file')
+    parser.add_argument('--db-path', default='Base10000', help='Path to the database')
+    parser.add_argument('--descriptors-path', default='Base10000_descriptors', help='Path to the descriptors')
+    parser.add_argument('--metric', default='chebyshev', help='Name of the distance metric of the re-ranking')
+    parser.add_argument('--build', action='store_true', help='Fit (or fit again) the projection before the report')
+    parser.add_argument('--dim', type=int, default=32, help='Target dimension')
+    parser.add_argument('--method', default='pca', choices=('pca', 'random'), help='Projection method')
+    parser.add_argument('--shortlist', type=int, default=200, help='Default number of candidates re-ranked exactly')
+    parser.add_argument('--queries', type=int, default=200, help='Number of random query rows of the report')
+    parser.add_argument('--k', type=int, default=30, help='Number of neighbours of the report')
+    parser.add_argument('--shortlists', type=int, nargs='+', default=[50, 100, 200, 500, 1000], help='Shortlist sizes to report')
+    parser.add_argument('--output', default='', help='JSON file of the report')
+    arguments = parser.parse_args()
+
+    # Set the logging level and format
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    qbe = QBE(arguments.db_path, arguments.descriptors_path)
+    if arguments.build:
+        qbe.build_projection(arguments.descriptor, arguments.dim, arguments.method, arguments.shortlist)
+
+    report: dict = qbe.projection_report(
+        arguments.descriptor, arguments.metric, arguments.k, tuple(arguments.shortlists), arguments.queries
+    )
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
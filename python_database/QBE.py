@@ -1,9 +1,33 @@
+from collections import OrderedDict
+from .Dedup import DuplicateFinder
+from .DescriptorStore import DescriptorStore
+from .Descriptors import get_extractor
+from .Fusion import FusionEngine
+import hashlib
+import html
 import inspect
+from .Instrumentation import INSTRUMENTATION
+import io
+from .IVFPQ import IVFPQ
+from .JPicture import JPicture
+from .KNNGraph import KNNGraph
 import logging
+from .Metrics import get_metric, Metric
+import multiprocessing
 import numpy as np
 import os
-from scipy.spatial.distance import chebyshev
-from typing import TypedDict
+from PIL import Image
+from .Projection import ProjectionIndex
+from .Quantization import Quantizer
+from .ResultCache import ResultCache
+from .SearchEngine import SearchEngine
+from .ShardedStore import ShardedEngine, ShardedStore
+from .Streaming import StreamingEngine
+import threading
+from .Thumbnails import ThumbnailCache
+import time
+from typing import BinaryIO, Callable, TypedDict
+from .VPTree import VPTree
 
 
 class Distance(TypedDict):
@@ -19,27 +43,90 @@ class Distance(TypedDict):
     distance: float
 
 
+def _write_html_pages(pages: list[tuple[str, str, str, list[tuple[str, str, float]], int]]) -> int:
+    """
+    Renders and writes HTML pages of query results, in a worker process of the batch report mode.
+
+    Args:
+        pages (list[tuple[str, str, str, list[tuple[str, str, float]], int]]): The path, title, query image link,
+            results and image height of each page (see QBE._html_page()).
+
+    Returns:
+        int: The number of written pages.
+    """
+
+    for file_path, title, query_link, results, image_height in pages:
+        page: str = QBE._html_page(title, query_link, results, image_height)
+        with open(file_path, 'w') as file:
+            file.write(page)
+
+    return len(pages)
+
+
 class QBE:
     """
     QBE class represents a Query By Example system.
+
+    The query image is an image of the database, or an external image (a file or its bytes) whose descriptor is
+    computed on the fly by JPicture, like the indexing. The descriptors of the last external images are cached by
+    the SHA-256 hash of their content, so that querying the same image again skips its decoding.
+
+    The results of the queries on images of the database are cached (see ResultCache) with the version of the
+    descriptor files, so that repeated queries skip the search and the rewriting of their HTML file until the
+    descriptors change.
+
+    The HTML files link the thumbnails of the images (see Thumbnails.ThumbnailCache) once generated, and the results
+    pages of many queries are rendered in parallel by batch_report().
+
+    The search engines over the shards of a descriptor file keep their worker processes between queries, until the
+    catalog of the shards changes or close() is called.
     """
 
     db_path: str
     descriptors_path: str
     db_files: list[str]
+    max_cached_images: int
+    result_cache: ResultCache
+    thumbnails: ThumbnailCache
+    _image_descriptors: OrderedDict
+    _image_descriptors_lock: threading.Lock
+    _store_generations: dict[str, tuple[tuple[int, int, int], int]]
+    _graphs: dict[str, tuple[tuple[int, int, int, int], KNNGraph | None]]
+    _sharded_engines: dict[tuple[str, str], tuple[tuple[int, int, int], ShardedEngine]]
+    _sharded_engines_lock: threading.Lock
 
-    def __init__(self, db_path: str, descriptors_path: str):
+    def __init__(
+            self,
+            db_path: str,
+            descriptors_path: str,
+            max_cached_images: int = 256,
+            max_cached_results: int = 1024,
+            result_cache_path: str | None = None
+            ):
         """
         Initializes a QBE object.
 
         Args:
             db_path (str): Path to the database.
             descriptors_path (str): Path to the descriptors.
+            max_cached_images (int): Number of external query images whose descriptors are cached.
+            max_cached_results (int): Number of query results cached in memory.
+            result_cache_path (str | None): Folder where the query results evicted from memory are spilled, None to
+                drop them.
         """
 
         self.db_path = db_path
         self.descriptors_path = descriptors_path
         self.db_files = []
+        self.max_cached_images = max_cached_images
+        self.result_cache = ResultCache(max_cached_results, result_cache_path)
+        self.thumbnails = ThumbnailCache(os.path.join(db_path, 'images'), os.path.join(db_path, 'thumbnails'))
+        self._image_descriptors = OrderedDict()
+        self._image_descriptors_lock = threading.Lock()
+        self._store_generations = {}
+        self._graphs = {}
+        self._sharded_engines = {}
+        self._sharded_engines_lock = threading.Lock()
         self._get_db_files()
 
     def _get_db_files(self):
@@ -67,19 +154,53 @@ class QBE:
         # Close the file
         file.close()
 
-    def _init_descriptors(self, descriptor_file_name: str) -> np.ndarray:
+    def _store_path(self, descriptor_file_name: str) -> str:
         """
-        Initializes the descriptors from a file.
+        Constructs the path of the binary descriptor store of a descriptor file.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file, or of the store.
+
+        Returns:
+            str: The path to the store file.
+        """
+
+        store_path: str = os.path.join(self.descriptors_path, descriptor_file_name)
+        if not store_path.endswith(DescriptorStore.EXTENSION):
+            store_path += DescriptorStore.EXTENSION
+
+        return store_path
+
+    def _load_descriptors(self, descriptor_file_name: str, compact: bool = False) -> tuple[np.ndarray, list[str]]:
+        """
+        Loads the descriptors from a file, without modifying the QBE object.
+
+        A binary descriptor store (the descriptor file name followed by the store extension, or the path of a store)
+        is memory-mapped without copy, and comes with its own filename list. Otherwise the descriptors are parsed
+        from the text file, whose rows follow the list of database files. The codes of a compact store are decoded
+        in memory, unless compact is True.
 
         Args:
             descriptor_file_name (str): Name of the descriptor file.
+            compact (bool): True to return the codes of a compact store as they are stored.
 
         Returns:
-            np.ndarray: Array of descriptors.
+            tuple[np.ndarray, list[str]]: Array of descriptors and the filename of the image described by each row.
         """
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+        # Look for a binary descriptor store
+        store_path: str = self._store_path(descriptor_file_name)
+
+        start: float = time.perf_counter()
+        matrix: np.ndarray
+        if os.path.exists(store_path):
+            # Memory-map the store, whose rows follow its own filename list
+            store: DescriptorStore = DescriptorStore(store_path)
+            matrix = store.matrix
+            if store.quantizer is not None and not compact:
+                matrix = store.quantizer.decode(matrix)
+            INSTRUMENTATION.observe('load', time.perf_counter() - start)
+            return matrix, store.files
 
         # Create an empty list to store the descriptors
         descriptors: list[list[float]] = []
@@ -95,142 +216,1386 @@ class QBE:
             # Append the values to the descriptors list
             descriptors.append(values)
 
+        # Close the file
+        descriptor_file.close()
+        INSTRUMENTATION.count('bytes_read', os.path.getsize(descriptor_file.name))
+
         # Convert the descriptors list to a numpy array and return it
-        return np.asarray(descriptors)
+        matrix = np.asarray(descriptors)
+        INSTRUMENTATION.observe('load', time.perf_counter() - start)
+
+        return matrix, self.db_files
+
+    def _init_descriptors(self, descriptor_file_name: str) -> np.ndarray:
+        """
+        Initializes the descriptors from a file. The filename list of a binary descriptor store replaces the list
+        of database files.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+
+        Returns:
+            np.ndarray: Array of descriptors.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        descriptors: np.ndarray
+        descriptors, self.db_files = self._load_descriptors(descriptor_file_name)
+
+        return descriptors
+
+    def _descriptor_version(self, descriptor_file_name: str) -> str:
+        """
+        Returns the version of the files a query on a descriptor file reads (shard catalog, store and text file):
+        the generation of the store, and the size and modification time of each file. The header of a store is only
+        read again when the file changed.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+
+        Returns:
+            str: The version, which changes whenever the descriptors are rewritten (e.g. by an indexing run).
+        """
+
+        store_path: str = self._store_path(descriptor_file_name)
+        versions: list[str] = []
+        paths: tuple[str, ...] = (
+            self._catalog_path(descriptor_file_name), store_path, os.path.join(self.descriptors_path, descriptor_file_name)
+        )
+        for path in dict.fromkeys(paths):
+            try:
+                status: os.stat_result = os.stat(path)
+            except FileNotFoundError:
+                continue
+            version: str = f'{os.path.basename(path)}:{status.st_size}:{status.st_mtime_ns}'
+
+            # Add the generation of the store, counted by every write of the store
+            if path == store_path:
+                version += f':{self._store_generation(path, status)}'
+            versions.append(version)
+
+        return '|'.join(versions)
+
+    def _store_generation(self, store_path: str, status: os.stat_result | None = None) -> int:
+        """
+        Returns the generation of a descriptor store, only reading its header again when the file changed.
+
+        Args:
+            store_path (str): The path to the store file.
+            status (os.stat_result | None): The status of the file, None to read it.
+
+        Returns:
+            int: The generation of the store.
+        """
+
+        if status is None:
+            status = os.stat(store_path)
+        signature: tuple[int, int, int] = (status.st_ino, status.st_size, status.st_mtime_ns)
+
+        cached: tuple[tuple[int, int, int], int] | None = self._store_generations.get(store_path)
+        if cached is None or cached[0] != signature:
+            cached = (signature, DescriptorStore._read_header(store_path)[0]['generation'])
+            self._store_generations[store_path] = cached
+
+        return cached[1]
+
+    def _descriptor_generation(self, descriptor_file_name: str) -> tuple[int, str]:
+        """
+        Returns what ties an index (vantage-point tree, IVF-PQ, projection) to the descriptors it was built over: the
+        generation of the store, or the checksum of the text file and of the list of database files its rows follow.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+
+        Returns:
+            tuple[int, str]: The generation of the store (-1 for a text file) and the checksum of the text file
+                (empty for a store).
+        """
+
+        store_path: str = self._store_path(descriptor_file_name)
+        if os.path.exists(store_path):
+            return self._store_generation(store_path), ''
+
+        checksum = hashlib.sha256('\n'.join(self.db_files).encode('utf-8'))
+        with open(os.path.join(self.descriptors_path, descriptor_file_name), 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                checksum.update(chunk)
+
+        return -1, checksum.hexdigest()
+
+    def _check_index(self, descriptor_file_name: str, path: str, index: VPTree | IVFPQ | ProjectionIndex):
+        """
+        Checks that an index was built over the current descriptors, e.g. not before an indexing run rewrote them
+        in place with the same number of rows.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            path (str): The path to the index file.
+            index (VPTree | IVFPQ | ProjectionIndex): The index.
+
+        Raises:
+            ValueError: If the index was built over other descriptors.
+        """
+
+        generation: int
+        checksum: str
+        generation, checksum = self._descriptor_generation(descriptor_file_name)
+        if index.generation != generation:
+            raise ValueError(f'{path} was built over generation {index.generation} of the store, not {generation}')
+        if index.checksum != checksum:
+            raise ValueError(f'{path} was built over another version of {descriptor_file_name}')
+
+    def _tree_path(self, descriptor_file_name: str, metric: str) -> str:
+        """
+        Constructs the path of the vantage-point tree of a descriptor file, next to it.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric of the tree.
+
+        Returns:
+            str: The path to the tree file.
+        """
+
+        return os.path.join(self.descriptors_path, f'{descriptor_file_name}.{metric}{VPTree.EXTENSION}')
+
+    def build_tree(self, descriptor_file_name: str, metric: str = 'chebyshev', leaf_size: int = 32):
+        """
+        Builds the vantage-point tree of a descriptor file and saves it next to the file. Queries with the same
+        descriptor file and metric then search the tree instead of scanning every row.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric, which must be a true metric.
+            leaf_size (int): Maximum number of rows of a leaf of the tree.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        descriptors: np.ndarray = self._load_descriptors(descriptor_file_name)[0]
+        generation: int
+        checksum: str
+        generation, checksum = self._descriptor_generation(descriptor_file_name)
+        VPTree.build(descriptors, metric, leaf_size, generation=generation, checksum=checksum).save(
+            self._tree_path(descriptor_file_name, metric)
+        )
+
+    def _ivfpq_path(self, descriptor_file_name: str) -> str:
+        """
+        Constructs the path of the IVF-PQ index of a descriptor file, next to it.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+
+        Returns:
+            str: The path to the index file.
+        """
+
+        return os.path.join(self.descriptors_path, descriptor_file_name + IVFPQ.EXTENSION)
+
+    def build_ivfpq(
+            self,
+            descriptor_file_name: str,
+            nlist: int | None = None,
+            m: int | None = None,
+            nprobe: int = 8,
+            rerank: int = 0
+            ):
+        """
+        Builds the IVF-PQ approximate index (L2) of a descriptor file and saves it next to the file. Queries with the
+        same descriptor file then use it when they ask for an approximate search.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            nlist (int | None): Number of inverted lists, None for 4 sqrt(rows).
+            m (int | None): Number of sub-vectors, which must divide the dimension, None to choose it.
+            nprobe (int): Number of inverted lists scanned per query.
+            rerank (int): Size of the shortlist re-ranked with the exact distances, 0 for none.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        descriptors: np.ndarray = self._load_descriptors(descriptor_file_name)[0]
+        generation: int
+        checksum: str
+        generation, checksum = self._descriptor_generation(descriptor_file_name)
+        IVFPQ.build(descriptors, nlist, m, nprobe=nprobe, rerank=rerank, generation=generation, checksum=checksum).save(
+            self._ivfpq_path(descriptor_file_name)
+        )
+
+    def ivfpq_report(
+            self,
+            descriptor_file_name: str,
+            k: int = 30,
+            nprobes: tuple[int, ...] = (1, 2, 4, 8, 16, 32),
+            reranks: tuple[int, ...] = (0, 100),
+            nqueries: int = 200,
+            seed: int = 0
+            ) -> dict:
+        """
+        Measures the recall@k vs latency trade-off of the IVF-PQ index of a descriptor file against a brute-force
+        search of the same descriptors, with random images of the database as queries.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            k (int): Number of results per query.
+            nprobes (tuple[int, ...]): Numbers of inverted lists scanned to measure.
+            reranks (tuple[int, ...]): Shortlist sizes to measure, 0 for no re-ranking.
+            nqueries (int): Number of query images.
+            seed (int): Seed of the choice of the query images.
+
+        Returns:
+            dict: The JSON-serializable report (see IVFPQ.recall_report).
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        descriptors: np.ndarray = np.array(self._load_descriptors(descriptor_file_name)[0])
+        index_path: str = self._ivfpq_path(descriptor_file_name)
+        index: IVFPQ = IVFPQ.load(index_path, descriptors)
+        self._check_index(descriptor_file_name, index_path, index)
+        query_rows: np.ndarray = np.random.default_rng(seed).choice(
+            descriptors.shape[0], min(nqueries, descriptors.shape[0]), replace=False
+        )
+
+        report: dict = index.recall_report(query_rows, k, nprobes, reranks)
+        report['descriptor'] = descriptor_file_name
+
+        return report
+
+    def _projection_path(self, descriptor_file_name: str) -> str:
+        """
+        Constructs the path of the projection prefilter of a descriptor file, next to it.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+
+        Returns:
+            str: The path to the projection file.
+        """
+
+        return os.path.join(self.descriptors_path, descriptor_file_name + ProjectionIndex.EXTENSION)
+
+    def build_projection(
+            self,
+            descriptor_file_name: str,
+            dim: int = 32,
+            method: str = 'pca',
+            shortlist: int = 200
+            ) -> ProjectionIndex:
+        """
+        Fits the projection prefilter (PCA or random projection) of a descriptor file and saves it with the reduced
+        matrix next to the file. Queries with the same descriptor file then use it when they ask for a prefiltered
+        search, with any metric.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            dim (int): Target dimension of the reduced matrix.
+            method (str): 'pca' or 'random'.
+            shortlist (int): Number of candidates of the reduced matrix re-ranked with the exact distances.
+
+        Returns:
+            ProjectionIndex: The prefilter.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        descriptors: np.ndarray = self._load_descriptors(descriptor_file_name)[0]
+        generation: int
+        checksum: str
+        generation, checksum = self._descriptor_generation(descriptor_file_name)
+        index: ProjectionIndex = ProjectionIndex.build(
+            descriptors, dim=dim, method=method, shortlist=shortlist, generation=generation, checksum=checksum
+        )
+        index.save(self._projection_path(descriptor_file_name))
+
+        return index
+
+    def projection_report(
+            self,
+            descriptor_file_name: str,
+            metric: str = 'chebyshev',
+            k: int = 30,
+            shortlists: tuple[int, ...] = (50, 100, 200, 500, 1000),
+            nqueries: int = 200,
+            seed: int = 0
+            ) -> dict:
+        """
+        Measures the top-k agreement with the exact ranking and the speedup of the projection prefilter of a
+        descriptor file, with random images of the database as queries.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            k (int): Number of results per query.
+            shortlists (tuple[int, ...]): Shortlist sizes to measure.
+            nqueries (int): Number of query images.
+            seed (int): Seed of the choice of the query images.
+
+        Returns:
+            dict: The JSON-serializable report (see ProjectionIndex.agreement_report).
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        descriptors: np.ndarray = np.array(self._load_descriptors(descriptor_file_name)[0])
+        index_path: str = self._projection_path(descriptor_file_name)
+        index: ProjectionIndex = ProjectionIndex.load(index_path, descriptors, metric)
+        self._check_index(descriptor_file_name, index_path, index)
+        query_rows: np.ndarray = np.random.default_rng(seed).choice(
+            descriptors.shape[0], min(nqueries, descriptors.shape[0]), replace=False
+        )
+
+        report: dict = index.agreement_report(query_rows, k, shortlists)
+        report['descriptor'] = descriptor_file_name
+
+        return report
+
+    def load_engine(
+            self,
+            descriptor_file_name: str,
+            metric: str = 'chebyshev',
+            resident: bool = False,
+            approximate: bool = False,
+            prefilter: bool = False,
+            shortlist: int | None = None
+            ) -> SearchEngine:
+        """
+        Loads the descriptors from a file into a search engine, with the vantage-point tree of the file and metric
+        if one was built, its IVF-PQ index for an approximate search, or its projection prefilter. The codes of a
+        compact store (float16 or uint8, see Quantization.Quantizer) are searched as they are, by an exact scan.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            resident (bool): True to copy the descriptors in memory instead of memory-mapping them.
+            approximate (bool): True to search the IVF-PQ index of the file (L2 only) instead of an exact search.
+            prefilter (bool): True to shortlist the candidates on the reduced matrix of the file (see
+                build_projection) and re-rank them exactly.
+            shortlist (int | None): Number of candidates of the prefilter, None for the one it was built with.
+
+        Returns:
+            SearchEngine: The search engine over the descriptors.
+        """
+
+        descriptors: np.ndarray
+        files: list[str]
+        descriptors, files = self._load_descriptors(descriptor_file_name, compact=True)
+
+        # Read the whole matrix in memory
+        if resident:
+            descriptors = np.array(descriptors)
+
+        # Scan the codes of a compact store, the indexes being built over float descriptors
+        store_path: str = self._store_path(descriptor_file_name)
+        if descriptors.dtype.name in Quantizer.DTYPES and os.path.exists(store_path):
+            if approximate or prefilter:
+                raise ValueError(f'The {"approximate" if approximate else "prefiltered"} search needs float descriptors, not {descriptors.dtype.name}')
+            return SearchEngine(descriptors, files, metric, DescriptorStore(store_path).quantizer)
+
+        engine: SearchEngine = SearchEngine(descriptors, files, metric)
+
+        # Attach the projection prefilter fitted on these descriptors
+        if prefilter:
+            projection_path: str = self._projection_path(descriptor_file_name)
+            projection: ProjectionIndex = ProjectionIndex.load(projection_path, descriptors, metric, shortlist)
+            self._check_index(descriptor_file_name, projection_path, projection)
+            engine.index = projection
+            return engine
+
+        # Attach the approximate index built over these descriptors
+        if approximate:
+            if metric != 'l2':
+                raise ValueError(f'The approximate search uses the l2 metric, not {metric}')
+            index_path: str = self._ivfpq_path(descriptor_file_name)
+            index: IVFPQ = IVFPQ.load(index_path, descriptors)
+            self._check_index(descriptor_file_name, index_path, index)
+            engine.index = index
+            return engine
+
+        # Attach the tree built over these descriptors, unless they changed since
+        tree_path: str = self._tree_path(descriptor_file_name, metric)
+        if os.path.exists(tree_path):
+            try:
+                tree: VPTree = VPTree.load(tree_path, descriptors)
+                self._check_index(descriptor_file_name, tree_path, tree)
+                engine.index = tree
+            except ValueError as error:
+                logging.warning(f'Ignoring the vantage-point tree: {error}')
+
+        return engine
+
+    def _graph_path(self, descriptor_file_name: str, metric: str) -> str:
+        """
+        Constructs the path of the k-nearest neighbours graph of a descriptor file, next to it.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric of the graph.
+
+        Returns:
+            str: The path to the graph file.
+        """
+
+        # The graph of a store is named after the descriptor file, like the ones patched by the indexing
+        name: str = self._store_path(descriptor_file_name)[:-len(DescriptorStore.EXTENSION)]
+
+        return f'{name}.{metric}{KNNGraph.EXTENSION}'
+
+    def build_knn_graph(
+            self,
+            descriptor_file_name: str,
+            metric: str = 'chebyshev',
+            k: int = 30,
+            workers: int | None = None
+            ) -> KNNGraph:
+        """
+        Builds the k-nearest neighbours graph of a descriptor file and saves it next to the file. Queries on an image
+        of the file with the same metric and at most k results then read its row of the graph. The incremental
+        indexing patches the graph of a store (see IndexDatabase.index()).
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            k (int): Number of neighbours of each image.
+            workers (int | None): Number of worker processes, None for every core.
+
+        Returns:
+            KNNGraph: The graph.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        descriptors: np.ndarray
+        files: list[str]
+        descriptors, files = self._load_descriptors(descriptor_file_name, compact=True)
+
+        # The graph of a store is tied to its generation, the one of a text file to the list of database files
+        store_path: str = self._store_path(descriptor_file_name)
+        quantizer: Quantizer | None = None
+        generation: int = -1
+        if os.path.exists(store_path):
+            store: DescriptorStore = DescriptorStore(store_path)
+            quantizer, generation = store.quantizer, store.generation
+
+        start: float = time.perf_counter()
+        graph: KNNGraph = KNNGraph.build(descriptors, files, metric, k, workers, quantizer, generation)
+        graph.save(self._graph_path(descriptor_file_name, metric))
+
+        # Logging information
+        logging.info(f'k-NN graph of {descriptor_file_name} ({len(files)} images, k={graph.k}) built in {time.perf_counter() - start:.1f} s')
+
+        return graph
+
+    def _load_graph(self, descriptor_file_name: str, metric: str, nresults: int) -> KNNGraph | None:
+        """
+        Loads the k-nearest neighbours graph of a descriptor file and metric, if it answers queries of nresults
+        results and is up to date with the descriptors. The graph is kept in memory, and only loaded and checked
+        again when its file or the generation of the store changed.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric.
+            nresults (int): Number of results of the query.
+
+        Returns:
+            KNNGraph | None: The graph, None if there is no usable graph.
+        """
+
+        graph_path: str = self._graph_path(descriptor_file_name, metric)
+        try:
+            status: os.stat_result = os.stat(graph_path)
+        except FileNotFoundError:
+            return None
+
+        store_path: str = self._store_path(descriptor_file_name)
+        generation: int = -1
+        try:
+            generation = self._store_generation(store_path)
+        except FileNotFoundError:
+            pass
+
+        signature: tuple[int, int, int, int] = (status.st_ino, status.st_size, status.st_mtime_ns, generation)
+        cached: tuple[tuple[int, int, int, int], KNNGraph | None] | None = self._graphs.get(graph_path)
+        if cached is None or cached[0] != signature:
+            graph: KNNGraph | None = KNNGraph.load(graph_path)
+
+            # Ignore a graph computed on other descriptors than the current ones
+            if generation >= 0 and graph.generation != generation:
+                logging.warning(f'Ignoring {graph_path}: computed on generation {graph.generation} of the store, not {generation}')
+                graph = None
+            elif generation < 0 and graph.files != self.db_files:
+                logging.warning(f'Ignoring {graph_path}: computed on another list of database files')
+                graph = None
+
+            cached = (signature, graph)
+            self._graphs[graph_path] = cached
+
+        if cached[1] is None or nresults > cached[1].k:
+            return None
+
+        return cached[1]
+
+    def _catalog_path(self, descriptor_file_name: str) -> str:
+        """
+        Constructs the path of the shard catalog of a descriptor file.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+
+        Returns:
+            str: The path to the catalog file.
+        """
+
+        return os.path.join(self.descriptors_path, descriptor_file_name + ShardedStore.EXTENSION)
+
+    def build_shards(self, descriptor_file_name: str, shard_count: int, dtype: str = 'float32') -> ShardedStore:
+        """
+        Splits the descriptors of a file into shards, written with their catalog next to the file. Queries on the
+        descriptor file then search the shards in parallel. New images are added later as new shards with
+        ShardedStore.add_shard(), without rebuilding the existing ones.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            shard_count (int): Number of shards.
+            dtype (str): Type of the stored values (see DescriptorStore.write()).
+
+        Returns:
+            ShardedStore: The sharded store.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        descriptors: np.ndarray
+        files: list[str]
+        descriptors, files = self._load_descriptors(descriptor_file_name)
+
+        return ShardedStore.create(
+            self._catalog_path(descriptor_file_name), descriptor_file_name.split('.')[-1], descriptors, files, shard_count, dtype
+        )
+
+    def load_sharded_engine(self, descriptor_file_name: str, metric: str = 'chebyshev', workers: int | None = None) -> ShardedEngine:
+        """
+        Opens the shards of a descriptor file (see build_shards()) and the worker processes searching them.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            workers (int | None): Number of worker processes, None for one per shard up to the number of cores.
+
+        Returns:
+            ShardedEngine: The search engine over the shards, to close once done.
+        """
+
+        return ShardedEngine(ShardedStore(self._catalog_path(descriptor_file_name)), metric, workers)
+
+    def _sharded_engine(self, descriptor_file_name: str, metric: str) -> ShardedEngine | None:
+        """
+        Returns the search engine over the shards of a descriptor file, kept open with its worker processes (which
+        memory-map the shards once) between queries. It is only opened again when the catalog changed, e.g. after a
+        shard was added, the previous one being closed.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric.
+
+        Returns:
+            ShardedEngine | None: The search engine over the shards, None if the descriptor file is not sharded.
+        """
+
+        catalog_path: str = self._catalog_path(descriptor_file_name)
+        try:
+            status: os.stat_result = os.stat(catalog_path)
+        except FileNotFoundError:
+            return None
+
+        # The catalog is replaced by a new file on every change
+        signature: tuple[int, int, int] = (status.st_ino, status.st_size, status.st_mtime_ns)
+        key: tuple[str, str] = (catalog_path, metric)
+        with self._sharded_engines_lock:
+            cached: tuple[tuple[int, int, int], ShardedEngine] | None = self._sharded_engines.get(key)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            if cached is not None:
+                cached[1].close()
+
+            engine: ShardedEngine = self.load_sharded_engine(descriptor_file_name, metric)
+            self._sharded_engines[key] = (signature, engine)
+
+        return engine
+
+    def close(self):
+        """
+        Stops the worker processes of the search engines over the shards.
+        """
+
+        with self._sharded_engines_lock:
+            for _, engine in self._sharded_engines.values():
+                engine.close()
+            self._sharded_engines.clear()
+
+    def load_streaming_engine(
+            self,
+            descriptor_file_name: str,
+            metric: str = 'chebyshev',
+            chunk_rows: int = 65536
+            ) -> StreamingEngine:
+        """
+        Opens a descriptor file for out-of-core queries, which scan it chunk by chunk instead of loading it (see
+        Streaming.StreamingEngine): memory stays bounded by a few chunks whatever the size of the file.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            chunk_rows (int): Number of rows read at once.
+
+        Returns:
+            StreamingEngine: The search engine over the descriptor file.
+        """
+
+        # Scan the binary store of the descriptor file if there is one, the text file otherwise
+        path: str = self._store_path(descriptor_file_name)
+        if not os.path.exists(path):
+            path = os.path.join(self.descriptors_path, descriptor_file_name)
+
+        return StreamingEngine(path, self.db_files, metric, chunk_rows)
+
+    def _query(self, engine: SearchEngine | ShardedEngine | KNNGraph | StreamingEngine, base_image_name: str, nresults: int) -> list[Distance]:
+        """
+        Finds the nearest images of an image of the database.
+
+        Args:
+            engine (SearchEngine | ShardedEngine | KNNGraph | StreamingEngine): The search engine over the descriptors, or the k-NN graph.
+            base_image_name (str): Name of the base image.
+            nresults (int): Number of results to retrieve.
+
+        Returns:
+            list[Distance]: The nearest images and their distances, in ascending order, the base image excluded.
+        """
+
+        # Compute every distance at once and select the nearest images, the base image excluded
+        rows: np.ndarray
+        rows_distances: np.ndarray
+        rows, rows_distances = engine.search(base_image_name, nresults)
+
+        return self._distances(engine, rows, rows_distances)
+
+    def _distances(self, engine: SearchEngine | ShardedEngine | KNNGraph | StreamingEngine, rows: np.ndarray, rows_distances: np.ndarray) -> list[Distance]:
+        """
+        Builds the results of a query.
+
+        Args:
+            engine (SearchEngine | ShardedEngine | KNNGraph | StreamingEngine): The search engine or graph that answered the query.
+            rows (np.ndarray): The rows of the nearest images.
+            rows_distances (np.ndarray): Their distances, in ascending order.
+
+        Returns:
+            list[Distance]: The nearest images and their distances, in ascending order.
+        """
+
+        # Debugging information
+        logging.debug('%d distance evaluations (%d rows)', engine.evaluations, len(engine.files))
+        INSTRUMENTATION.count('queries')
+
+        # Build the list of distances of the selected images, in ascending order
+        return [
+            {'file': engine.files[row], 'distance': float(distance)}
+            for row, distance in zip(rows, rows_distances)
+        ]
+
+    def image_descriptor(self, descriptor_file_name: str, image: str | bytes | BinaryIO) -> np.ndarray:
+        """
+        Computes the descriptor of an external image, like the indexing (JPicture, full resolution), or returns it
+        from the cache if an image with the same content was described before.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file, whose type (e.g. HistRGB_6x6x6) is computed.
+            image (str | bytes | BinaryIO): The path to the image file, its content, or a binary file object.
+
+        Returns:
+            np.ndarray: The flattened descriptor.
+        """
+
+        # The descriptor types of the registry of extractors
+        descriptor: str = descriptor_file_name.removesuffix(DescriptorStore.EXTENSION).split('.')[-1]
+        try:
+            get_extractor(descriptor)
+        except ValueError:
+            raise ValueError(f'{descriptor} descriptors cannot be computed from an image') from None
+
+        # Read the content of the image
+        content: bytes
+        if isinstance(image, (bytes, bytearray)):
+            content = bytes(image)
+        elif isinstance(image, str):
+            with open(image, 'rb') as file:
+                content = file.read()
+        else:
+            content = image.read()
+
+        # Look for the descriptor of an image with the same content
+        key: tuple[str, str] = (hashlib.sha256(content).hexdigest(), descriptor)
+        with self._image_descriptors_lock:
+            values: np.ndarray | None = self._image_descriptors.get(key)
+            if values is not None:
+                self._image_descriptors.move_to_end(key)
+                INSTRUMENTATION.count('image_descriptor_hits')
+                return values
+        INSTRUMENTATION.count('image_descriptor_misses')
+
+        # Decode the image and compute its descriptor
+        with Image.open(io.BytesIO(content)) as decoded:
+            values = JPicture((descriptor,)).histograms(decoded)[0]
+
+        # Cache it, forgetting the least recently used descriptors
+        with self._image_descriptors_lock:
+            self._image_descriptors[key] = values
+            while len(self._image_descriptors) > self.max_cached_images:
+                self._image_descriptors.popitem(last=False)
+
+        return values
+
+    def image_request(
+            self,
+            descriptor_file_name: str,
+            image: str | bytes | BinaryIO,
+            nresults: int,
+            metric: str = 'chebyshev',
+            engine: SearchEngine | Callable[[], SearchEngine] | None = None
+            ) -> list[Distance]:
+        """
+        Performs a query with an external image (not necessarily in the database), whose descriptor is computed on
+        the fly (see image_descriptor()).
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            image (str | bytes | BinaryIO): The path to the image file, its content, or a binary file object.
+            nresults (int): Number of results to retrieve.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            engine (SearchEngine | Callable[[], SearchEngine] | None): A search engine already loaded over the
+                descriptor file, or a function returning it (unused if the file is sharded), None for load_engine().
+
+        Returns:
+            list[Distance]: The nearest images of the database and their distances, in ascending order.
+        """
+
+        start: float = time.perf_counter()
+        query: np.ndarray = self.image_descriptor(descriptor_file_name, image)
+
+        # Search the descriptor in every shard of a sharded descriptor file, or with the search engine of the file
+        distances: list[Distance]
+        sharded_engine: ShardedEngine | None = (
+            self._sharded_engine(descriptor_file_name, metric) if not isinstance(engine, SearchEngine) else None
+        )
+        if sharded_engine is not None:
+            distances = self._distances(sharded_engine, *sharded_engine.search_vector(query, nresults))
+        else:
+            if engine is None:
+                engine = self.load_engine(descriptor_file_name, metric)
+            elif not isinstance(engine, SearchEngine):
+                engine = engine()
+            if query.shape[0] != engine.matrix.shape[1]:
+                raise ValueError(f'The image descriptor has {query.shape[0]} values, {descriptor_file_name} has {engine.matrix.shape[1]}')
+            distances = self._distances(engine, *engine.search_vector(query.astype(engine.dtype), nresults))
+        INSTRUMENTATION.observe('request', time.perf_counter() - start)
+
+        return distances
 
     def _compute_descriptors_distance(
             self,
             descriptor1: np.ndarray,
-            descriptor2: np.ndarray
-            ) -> float:
+            descriptor2: np.ndarray,
+            metric: str = 'chebyshev'
+            ) -> float | np.ndarray:
         """
-        Computes the distance between two descriptors.
+        Computes the distance between descriptors.
 
         Args:
             descriptor1 (np.ndarray): First descriptor.
-            descriptor2 (np.ndarray): Second descriptor.
+            descriptor2 (np.ndarray): Second descriptor, or a matrix of descriptors (one per row).
+            metric (str): Name of the distance metric (see Metrics.METRICS).
 
         Returns:
-            float: Distance between the descriptors.
+            float | np.ndarray: Distance between the descriptors, or distance to each row of the matrix.
         """
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+        # Compute the distance to each row with the vectorized kernel of the metric
+        distance_metric: Metric = get_metric(metric)
+        matrix: np.ndarray = np.atleast_2d(descriptor2)
+        distances: np.ndarray = distance_metric.distances(np.asarray(descriptor1), matrix, distance_metric.prepare(matrix))
+
+        return distances if np.ndim(descriptor2) > 1 else float(distances[0])
+
+    def _html_path(
+            self,
+            descriptor_file_path: str,
+            image_name: str,
+            nb_results: int,
+            metric: str = 'chebyshev',
+            mode: str = 'exact'
+            ) -> str:
+        """
+        Constructs the path of the HTML file of a query, in the requests folder of the database.
+
+        Args:
+            descriptor_file_path (str): Path to the descriptor file.
+            image_name (str): Name of the base image.
+            nb_results (int): Number of results to display.
+            metric (str): Name of the distance metric, added to the file name unless it is the default one.
+            mode (str): Search mode of the results (exact, approximate or prefilter), added to the file name unless
+                it is the exact one, so that the pages of different modes never replace each other.
+
+        Returns:
+            str: The path to the HTML file.
+        """
+
+        metric_suffix: str = '' if metric == 'chebyshev' else f'_{metric}'
+        mode_suffix: str = '' if mode == 'exact' else f'_{mode}'
 
-        # Compute the distance between the descriptors using the chebyshev function from scipy
-        return chebyshev(descriptor1, descriptor2)
+        return os.path.join(
+            self.db_path,
+            'requests',
+            f'{"".join(image_name.split(".")[:-1])}_{descriptor_file_path.split(".")[-1]}{metric_suffix}{mode_suffix}_{nb_results}.html'
+        )
+
+    @staticmethod
+    def _html_page(title: str, query_link: str, results: list[tuple[str, str, float]], image_height: int = 100) -> str:
+        """
+        Renders the HTML page of a query, in memory.
+
+        Args:
+            title (str): The title of the page.
+            query_link (str): The link to the (thumbnail of the) base image.
+            results (list[tuple[str, str, float]]): The link, filename and distance of each result, in ascending
+                order of distance.
+            image_height (int): The height of the images in the page.
+
+        Returns:
+            str: The HTML page.
+        """
+
+        # Header and query information
+        lines: list[str] = [
+            '<!DOCTYPE html>',
+            '<html>',
+            '<head><style>figure { display: inline-block; margin: 4px; text-align: center; font-size: small; }</style></head>',
+            '<body>',
+            f'<h1>{html.escape(title)}</h1>',
+            f'<img src="{html.escape(query_link)}" height="{image_height}" />',
+            '<h2>Results</h2>'
+        ]
+
+        # Image results, each with its filename and distance under it
+        for link, filename, distance in results:
+            lines.append(
+                f'<figure><img src="{html.escape(link)}" height="{image_height}" loading="lazy" />'
+                f'<figcaption>{html.escape(filename)}<br />{distance:.6g}</figcaption></figure>'
+            )
+
+        # Footer
+        lines.extend(['</body>', '</html>', ''])
+
+        return '\n'.join(lines)
 
     def _generate_html_file(
             self,
             descriptor_file_path: str,
             image_name: str,
             distances: list[Distance],
-            nb_results: int
+            nb_results: int,
+            metric: str = 'chebyshev',
+            mode: str = 'exact'
             ):
         """
-        Generates an HTML file with the query results.
+        Generates an HTML file with the query results, linking the thumbnails of the images when they were generated
+        (see Thumbnails.ThumbnailCache) and showing the distance under each result.
 
         Args:
             descriptor_file_path (str): Path to the descriptor file.
             image_name (str): Name of the base image.
             distances (list[Distance]): List of distances.
             nb_results (int): Number of results to display.
+            metric (str): Name of the distance metric, added to the file name unless it is the default one.
+            mode (str): Search mode of the results (exact, approximate or prefilter), added to the file name unless
+                it is the exact one.
         """
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
-
-        # Define the folder path for the generated HTML file
-        folder: str = os.path.join(self.db_path, 'requests')
+        # Define the file path for the generated HTML file
+        metric_suffix: str = '' if metric == 'chebyshev' else f'_{metric}'
+        mode_suffix: str = '' if mode == 'exact' else f' ({mode})'
+        file_path: str = self._html_path(descriptor_file_path, image_name, nb_results, metric, mode)
 
         # Create the folder if it doesn't exist
+        folder: str = os.path.dirname(file_path)
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        # Define the file path for the generated HTML file
-        file_path = os.path.join(
-                folder,
-                f'{"".join(image_name.split(".")[:-1])}_{descriptor_file_path.split(".")[-1]}_{nb_results}.html'
+        # Render the page in memory, then write it at once
+        with INSTRUMENTATION.stage('html'):
+            page: str = self._html_page(
+                f'Query for image {image_name} using {os.path.basename(descriptor_file_path)}{metric_suffix}{mode_suffix} limited to {nb_results} results',
+                self.thumbnails.link(image_name),
+                [
+                    (self.thumbnails.link(distance['file']), distance['file'], distance['distance'])
+                    for distance in distances[:nb_results]
+                ],
+                self.thumbnails.height
             )
+            with open(file_path, 'w') as file:
+                file.write(page)
 
-        # Define the height of the images in the HTML file
-        image_height: int = 100
+    def _search(
+            self,
+            descriptor_file_name: str,
+            base_image_name: str,
+            nresults: int,
+            metric: str = 'chebyshev',
+            approximate: bool = False,
+            streaming: bool = False,
+            prefilter: bool = False,
+            load: Callable[[], SearchEngine] | None = None
+            ) -> list[Distance]:
+        """
+        Finds the nearest images of an image of the database, with the k-nearest neighbours graph, the shards, the
+        streaming scan or the search engine of the descriptor file.
 
-        # Open the file in write mode
-        with open(file_path, 'w') as file:
-            # Write the HTML file header
-            file.write('<!DOCTYPE html>\n')
-            file.write('<html>\n')
-            file.write('<head></head>\n')
-            file.write('<body>\n')
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            base_image_name (str): Name of the base image.
+            nresults (int): Number of results to retrieve.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            approximate (bool): True to search the IVF-PQ index of the descriptor file (see build_ivfpq).
+            streaming (bool): True to scan the descriptor file chunk by chunk instead of loading it.
+            prefilter (bool): True to shortlist the candidates on the reduced matrix of the descriptor file and
+                re-rank them exactly (see build_projection).
+            load (Callable[[], SearchEngine] | None): Returns the search engine of the descriptor file when neither
+                the graph nor the shards answer the query (e.g. a resident one, see QBEServer), None for load_engine().
+
+        Returns:
+            list[Distance]: The nearest images and their distances, in ascending order, the base image excluded.
+        """
 
-            # Write the query information in the HTML file
-            file.write(f'<h1>Query for image {image_name} using {os.path.basename(descriptor_file_path)} limited to {nb_results} results</h1>\n')
-            file.write(f'<img src="../images/{image_name}" height="{image_height}" />\n')
-            file.write('<h2>Results</h2>\n')
+        # Read the nearest images of an image of the collection from the k-nearest neighbours graph
+        graph: KNNGraph | None = None
+        if not approximate and not prefilter:
+            graph = self._load_graph(descriptor_file_name, metric, nresults)
+        if graph is not None:
+            try:
+                graph.row(base_image_name)
+            except ValueError:
+                # The image is not in the graph: search the descriptors
+                graph = None
+        if graph is not None:
+            return self._query(graph, base_image_name, nresults)
 
-            # Write the image results in the HTML file
-            for i in range(nb_results):
-                file.write(f'<img src="../images/{distances[i]["file"]}" height="{image_height}" />\n')
+        # Scan the descriptor file chunk by chunk, without loading it
+        if streaming:
+            return self._query(self.load_streaming_engine(descriptor_file_name, metric), base_image_name, nresults)
 
-            # Write the HTML file footer
-            file.write('</body>\n')
-            file.write('</html>\n')
+        # Find the nearest images of the base image in every shard of a sharded descriptor file
+        if not approximate and not prefilter:
+            sharded_engine: ShardedEngine | None = self._sharded_engine(descriptor_file_name, metric)
+            if sharded_engine is not None:
+                return self._query(sharded_engine, base_image_name, nresults)
 
-            # Close the file
-            file.close()
+        # Load the descriptors into a search engine, which maps each filename to its row once
+        engine: SearchEngine = (
+            load() if load is not None
+            else self.load_engine(descriptor_file_name, metric, approximate=approximate, prefilter=prefilter)
+        )
 
-    def request(self, descriptor_file_name: str, base_image_name: str, nresults: int):
+        # Find the nearest images of the base image
+        return self._query(engine, base_image_name, nresults)
+
+    def cached_query(
+            self,
+            descriptor_file_name: str,
+            base_image_name: str,
+            nresults: int,
+            metric: str = 'chebyshev',
+            approximate: bool = False,
+            streaming: bool = False,
+            prefilter: bool = False,
+            search: Callable[[], list[Distance]] | None = None
+            ) -> tuple[list[Distance], bool]:
         """
-        Performs a query using a descriptor file and a base image.
+        Finds the nearest images of an image of the database, from the result cache if the query (or the same query
+        with more results) was answered on the current version of the descriptor file.
 
         Args:
             descriptor_file_name (str): Name of the descriptor file.
             base_image_name (str): Name of the base image.
             nresults (int): Number of results to retrieve.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            approximate (bool): True to search the IVF-PQ index of the descriptor file (see build_ivfpq).
+            streaming (bool): True to scan the descriptor file chunk by chunk instead of loading it.
+            prefilter (bool): True to shortlist the candidates on the reduced matrix of the descriptor file and
+                re-rank them exactly (see build_projection).
+            search (Callable[[], list[Distance]] | None): The search run on a cache miss, None for _search().
+
+        Returns:
+            tuple[list[Distance], bool]: The nearest images and their distances, in ascending order, and True if
+                they were read from the cache.
         """
 
-        # Debugging information
-        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+        # The streaming scan finds the same results as the exact search, the approximate and prefiltered searches
+        # other ones, which also depend on the version of their index
+        mode: str = 'exact'
+        if approximate or prefilter:
+            index_path: str = (
+                self._ivfpq_path(descriptor_file_name) if approximate else self._projection_path(descriptor_file_name)
+            )
+            mode = f'{"approximate" if approximate else "prefilter"}:{os.stat(index_path).st_mtime_ns}'
+        key: tuple[str, str, str, str] = (descriptor_file_name, base_image_name, metric, mode)
+        version: str = self._descriptor_version(descriptor_file_name)
+
+        distances: list[Distance] | None = self.result_cache.get(key, version, nresults)
+        if distances is not None:
+            return distances, True
+
+        if search is None:
+            distances = self._search(
+                descriptor_file_name, base_image_name, nresults, metric, approximate, streaming, prefilter
+            )
+        else:
+            distances = search()
+        self.result_cache.put(key, version, nresults, distances)
+
+        return distances, False
+
+    def request(
+            self,
+            descriptor_file_name: str,
+            base_image_name: str,
+            nresults: int,
+            metric: str = 'chebyshev',
+            approximate: bool = False,
+            streaming: bool = False,
+            prefilter: bool = False
+            ):
+        """
+        Performs a query using a descriptor file and a base image. A query answered from the result cache keeps its
+        HTML file if it was already generated.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            base_image_name (str): Name of the base image.
+            nresults (int): Number of results to retrieve.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            approximate (bool): True to search the IVF-PQ index of the descriptor file (see build_ivfpq).
+            streaming (bool): True to scan the descriptor file chunk by chunk instead of loading it, for files
+                larger than memory (see load_streaming_engine).
+            prefilter (bool): True to shortlist the candidates on the reduced matrix of the descriptor file and
+                re-rank them exactly, for large descriptors (see build_projection).
+        """
 
         # Logging information
         logging.info(f'Similarity requested for image {base_image_name} using {descriptor_file_name} limited to {nresults} results. Processing...')
+        start: float = time.perf_counter()
 
-        # Initialize descriptors from the descriptor file
-        descriptors: np.ndarray = self._init_descriptors(descriptor_file_name)
+        # Find the nearest images, or read them from the result cache
+        distances: list[Distance]
+        cached: bool
+        distances, cached = self.cached_query(
+            descriptor_file_name, base_image_name, nresults, metric, approximate, streaming, prefilter
+        )
 
-        # Get the index of the base image in the list of database files
-        base_image_index: int = self.db_files.index(base_image_name)
+        # Generate an HTML file with the query results, unless the cached results already have theirs: each search
+        # mode has its own file, the streaming scan sharing the one of the exact search
+        mode: str = 'approximate' if approximate else 'prefilter' if prefilter else 'exact'
+        if not cached or not os.path.exists(self._html_path(descriptor_file_name, base_image_name, nresults, metric, mode)):
+            self._generate_html_file(descriptor_file_name, base_image_name, distances, nresults, metric, mode)
+        INSTRUMENTATION.observe('request', time.perf_counter() - start)
 
-        # Get the descriptor of the base image
-        base_image_descriptor: np.ndarray = descriptors[base_image_index]
+        # Logging information
+        logging.info(f'Query for image {base_image_name} done{" (cached)" if cached else ""}.')
 
-        # Create an empty list to store the distances
-        distances: list[Distance] = []
+    def find_duplicates(
+            self,
+            hash_file_name: str,
+            histogram_file_name: str | None = None,
+            metric: str = 'l1',
+            max_hamming: int = 6,
+            max_histogram_distance: float = 0.3
+            ) -> dict:
+        """
+        Finds the clusters of near-duplicate images of the collection (see Dedup.DuplicateFinder), from the
+        perceptual hashes computed by the indexing (e.g. DHash_8 or PHash_8), the candidate pairs being verified
+        with a histogram descriptor.
 
-        # Iterate over each image in the database
-        for current_image_name in self.db_files:
+        Args:
+            hash_file_name (str): Name of the hash descriptor file.
+            histogram_file_name (str | None): Name of the histogram descriptor file verifying the candidate pairs,
+                None to verify them with their Hamming distance only.
+            metric (str): Name of the distance between the histograms (see Metrics.METRICS).
+            max_hamming (int): Largest Hamming distance between the hashes of two duplicates.
+            max_histogram_distance (float): Largest distance between the histograms of two duplicates.
 
-            # Skip the base image
-            if current_image_name != base_image_name:
+        Returns:
+            dict: The JSON-serializable clusters (the filenames of each cluster) and statistics of the search.
+        """
 
-                # Get the index of the current image in the list of database files
-                current_image_index: int = self.db_files.index(current_image_name)
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
 
-                # Get the descriptor of the current image
-                current_image_descriptor: np.ndarray = descriptors[current_image_index]
+        hashes: np.ndarray
+        files: list[str]
+        hashes, files = self._load_descriptors(hash_file_name)
 
-                # Compute the distance between the current image and the base image
-                distance: float = self._compute_descriptors_distance(current_image_descriptor, base_image_descriptor)
+        # Align the histograms with the hashes, on the images described by both
+        histograms: np.ndarray | None = None
+        if histogram_file_name is not None:
+            histogram_matrix: np.ndarray
+            histogram_files: list[str]
+            histogram_matrix, histogram_files = self._load_descriptors(histogram_file_name)
+            rows: dict[str, int] = {}
+            for row, filename in enumerate(histogram_files):
+                rows.setdefault(filename, row)
+            described: np.ndarray = np.array([row for row, filename in enumerate(files) if filename in rows], dtype=np.intp)
+            if described.size < len(files):
+                logging.warning(f'{len(files) - described.size} hashed images are not described in {histogram_file_name}')
+            hashes, files = hashes[described], [files[row] for row in described]
+            histograms = np.asarray(histogram_matrix[[rows[filename] for filename in files]])
 
-                # Add the distance to the list of distances
-                distances.append({'file': current_image_name, 'distance': distance})
+        finder: DuplicateFinder = DuplicateFinder(hashes, files, histograms, metric)
+        clusters: list[list[str]] = finder.find(max_hamming, max_histogram_distance)
 
-        # Sort the distances in ascending order
-        distances.sort(key=lambda x: x['distance'])
+        return {
+            'hashes': hash_file_name,
+            'histograms': histogram_file_name,
+            'metric': metric,
+            'max_hamming': max_hamming,
+            'max_histogram_distance': max_histogram_distance,
+            'statistics': finder.statistics,
+            'clusters': clusters
+        }
 
-        # Generate an HTML file with the query results
-        self._generate_html_file(descriptor_file_name, base_image_name, distances, nresults)
+    def load_fusion_engine(
+            self,
+            descriptor_file_names: list[str],
+            metrics: list[str] | None = None,
+            resident: bool = False
+            ) -> FusionEngine:
+        """
+        Loads several descriptor files into a fusion engine, which caches the distances of its last queries so that
+        they can be re-weighted without being computed again.
+
+        Args:
+            descriptor_file_names (list[str]): Names of the descriptor files.
+            metrics (list[str] | None): Name of the distance metric of each file, None for chebyshev everywhere.
+            resident (bool): True to copy the descriptors in memory instead of memory-mapping them.
+
+        Returns:
+            FusionEngine: The fusion engine over the descriptor files.
+        """
+
+        metrics = metrics or ['chebyshev'] * len(descriptor_file_names)
+        engines: list[SearchEngine] = [
+            self.load_engine(name, metric, resident) for name, metric in zip(descriptor_file_names, metrics)
+        ]
+
+        return FusionEngine(engines, list(descriptor_file_names))
+
+    def fusion_request(
+            self,
+            descriptor_file_names: list[str],
+            base_image_name: str,
+            nresults: int,
+            weights: list[float] | None = None,
+            metrics: list[str] | None = None,
+            normalization: str = 'zscore',
+            fusion: str = 'late'
+            ) -> list[Distance]:
+        """
+        Performs a query ranking the images by a weighted mix of several descriptor files.
+
+        Args:
+            descriptor_file_names (list[str]): Names of the descriptor files.
+            base_image_name (str): Name of the base image.
+            nresults (int): Number of results to retrieve.
+            weights (list[float] | None): Weight of each descriptor file, None for equal weights.
+            metrics (list[str] | None): Name of the distance metric of each file, None for chebyshev everywhere.
+            normalization (str): Normalization of the distances of each file before a late fusion: 'none',
+                'minmax', 'zscore' or 'rank'.
+            fusion (str): 'late' (weighted sum of the normalized distances) or 'early' (distance between the
+                concatenated descriptors, l1, l2 or chebyshev only).
+
+        Returns:
+            list[Distance]: The nearest images and their fused distances, in ascending order.
+        """
+
+        # Logging information
+        logging.info(f'Similarity requested for image {base_image_name} using {" + ".join(descriptor_file_names)} ({fusion} fusion) limited to {nresults} results. Processing...')
+
+        engine: FusionEngine = self.load_fusion_engine(descriptor_file_names, metrics)
+        rows: np.ndarray
+        rows_distances: np.ndarray
+        rows, rows_distances = engine.search(base_image_name, nresults, weights, normalization, fusion)
+        distances: list[Distance] = [
+            {'file': engine.files[row], 'distance': float(distance)} for row, distance in zip(rows, rows_distances)
+        ]
+
+        # Generate an HTML file named after every descriptor of the fusion
+        fused_name: str = f'Fusion.{"+".join(name.split(".")[-1] for name in descriptor_file_names)}'
+        self._generate_html_file(fused_name, base_image_name, distances, nresults, f'{fusion}_{normalization}')
 
         # Logging information
         logging.info(f'Query for image {base_image_name} done.')
+
+        return distances
+
+    def batch_request(
+            self,
+            descriptor_file_name: str,
+            image_names: list[str],
+            k: int,
+            metric: str = 'chebyshev'
+            ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Performs a query for many images of the database at once, loading the descriptors once and computing the
+        query x database distances in cache-sized tiles.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            image_names (list[str]): Names of the query images.
+            k (int): Number of results to retrieve per image.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (images, k) IDs of the results (their rows in the list of database
+                files) and their distances, by increasing distance. Each query image is excluded from its results.
+        """
+
+        # Logging information
+        logging.info(f'Similarity requested for {len(image_names)} images using {descriptor_file_name} limited to {k} results. Processing...')
+
+        # Load the descriptors into a search engine, which maps each filename to its row once
+        engine: SearchEngine = self.load_engine(descriptor_file_name, metric)
+
+        # Get the rows of the query images
+        query_rows: np.ndarray = np.array([engine.row(image_name) for image_name in image_names], dtype=np.intp)
+
+        # Search the nearest images of every query image in one pass, each query image excluded from its results
+        results: tuple[np.ndarray, np.ndarray] = engine.batch_search(engine.vectors(query_rows), k, query_rows)
+
+        # Logging information
+        logging.info(f'Query for {len(image_names)} images done.')
+
+        return results
+
+    def batch_report(
+            self,
+            descriptor_file_name: str,
+            image_names: list[str],
+            nresults: int,
+            metric: str = 'chebyshev',
+            workers: int | None = None,
+            thumbnails: bool = True,
+            report_name: str | None = None,
+            chunk_size: int = 64
+            ) -> str:
+        """
+        Renders the results pages of many images of the database (e.g. a whole category of the ground truth) and an
+        index page linking them. The queries are answered at once with the batched distance kernels, the thumbnails
+        of the shown images are generated if needed, and the pages are rendered and written in parallel.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            image_names (list[str]): Names of the query images.
+            nresults (int): Number of results of each page.
+            metric (str): Name of the distance metric (see Metrics.METRICS).
+            workers (int | None): Number of worker processes, None for every core.
+            thumbnails (bool): True to generate the missing thumbnails of the shown images first.
+            report_name (str | None): Name of the index page, None to name it after the descriptor.
+            chunk_size (int): Number of pages rendered by a worker process at once.
+
+        Returns:
+            str: The path to the index page.
+        """
+
+        # Logging information
+        logging.info(f'Report requested for {len(image_names)} images using {descriptor_file_name} limited to {nresults} results. Processing...')
+        start: float = time.perf_counter()
+
+        # Search the nearest images of every query image in one pass, each query image excluded from its results
+        engine: SearchEngine = self.load_engine(descriptor_file_name, metric)
+        query_rows: np.ndarray = np.array([engine.row(image_name) for image_name in image_names], dtype=np.intp)
+        rows: np.ndarray
+        rows_distances: np.ndarray
+        rows, rows_distances = engine.batch_search(engine.vectors(query_rows), nresults, query_rows)
+        INSTRUMENTATION.count('queries', len(image_names))
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        # Generate the thumbnails of the query and result images that have none
+        if thumbnails:
+            self.thumbnails.generate(list(image_names) + [engine.files[row] for row in np.unique(rows)], workers)
+
+        # The content of each page, rendered by the worker processes
+        metric_suffix: str = '' if metric == 'chebyshev' else f'_{metric}'
+        pages: list[tuple[str, str, str, list[tuple[str, str, float]], int]] = [
+            (
+                self._html_path(descriptor_file_name, image_name, nresults, metric),
+                f'Query for image {image_name} using {os.path.basename(descriptor_file_name)}{metric_suffix} limited to {nresults} results',
+                self.thumbnails.link(image_name),
+                [
+                    (self.thumbnails.link(engine.files[row]), engine.files[row], float(distance))
+                    for row, distance in zip(query_result_rows, query_distances)
+                ],
+                self.thumbnails.height
+            )
+            for image_name, query_result_rows, query_distances in zip(image_names, rows, rows_distances)
+        ]
+        folder: str = os.path.join(self.db_path, 'requests')
+        os.makedirs(folder, exist_ok=True)
+
+        # Render and write the pages, in chunks of pages per worker process
+        chunks: list[list[tuple]] = [pages[position:position + chunk_size] for position in range(0, len(pages), chunk_size)]
+        with INSTRUMENTATION.stage('html'):
+            if workers <= 1 or len(chunks) <= 1:
+                for chunk in chunks:
+                    _write_html_pages(chunk)
+            else:
+                with multiprocessing.Pool(min(workers, len(chunks))) as pool:
+                    for _ in pool.imap_unordered(_write_html_pages, chunks):
+                        pass
+
+        # Index page, linking the page of each query image
+        report_name = report_name or f'batch_{descriptor_file_name.split(".")[-1]}{metric_suffix}_{nresults}.html'
+        index_path: str = os.path.join(folder, report_name)
+        index_lines: list[str] = [
+            f'<figure><a href="{html.escape(os.path.basename(page[0]))}"><img src="{html.escape(page[2])}" height="{self.thumbnails.height}" loading="lazy" /></a>'
+            f'<figcaption>{html.escape(image_name)}</figcaption></figure>'
+            for image_name, page in zip(image_names, pages)
+        ]
+        with open(index_path, 'w') as file:
+            file.write('\n'.join([
+                '<!DOCTYPE html>',
+                '<html>',
+                '<head><style>figure { display: inline-block; margin: 4px; text-align: center; font-size: small; }</style></head>',
+                '<body>',
+                f'<h1>Report of {len(pages)} queries using {html.escape(os.path.basename(descriptor_file_name))}{metric_suffix} limited to {nresults} results</h1>',
+                *index_lines,
+                '</body>',
+                '</html>',
+                ''
+            ]))
+
+        elapsed: float = time.perf_counter() - start
+        INSTRUMENTATION.count('report_pages', len(pages))
+        INSTRUMENTATION.observe('batch_report', elapsed)
+
+        # Logging information
+        logging.info(f'Report of {len(pages)} queries written to {index_path} in {elapsed:.1f} s ({len(pages) / max(elapsed, 1e-9):.0f} pages/s)')
+
+        return index_path
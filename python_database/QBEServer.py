@@ -0,0 +1,414 @@
+import argparse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import inspect
+from .Instrumentation import INSTRUMENTATION
+import json
+import logging
+import os
+from .QBE import Distance, QBE
+from .SearchEngine import SearchEngine
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class QBEServer:
+    """
+    QBEServer class represents a long-running Query By Example service: the descriptor sets are loaded once and kept
+    in memory, and queries are answered with JSON results over a local HTTP or Unix-socket endpoint.
+
+    The queries are exact, and answered like QBE.request(): from the k-nearest neighbours graph of the descriptor set
+    if one was built, from its shards if it is sharded, and from its resident search engine otherwise.
+
+    Endpoints:
+        GET /query?descriptor=<name>&image=<name>&k=<int>&metric=<name>&html=<0|1>: Answers a query.
+        POST /query_image?descriptor=<name>&k=<int>&metric=<name>: Answers a query with the image sent as the body.
+        GET|POST /reload?descriptor=<name>: Reloads one resident descriptor set, or all of them without descriptor.
+        GET /status: Lists the resident descriptor sets and the counters of the result cache.
+        GET /metrics?format=<prometheus|json>: Exports the stage timers and counters (see Instrumentation).
+
+    Attributes:
+        qbe (QBE): The QBE object loading the descriptors and rendering the HTML files.
+        max_resident_sets (int): The maximum number of descriptor sets kept in memory.
+        _engines (OrderedDict[tuple[str, str], SearchEngine]): The resident search engines by (descriptor, metric),
+            least recently used first.
+        _lock (threading.Lock): The lock protecting the resident search engines and the loading locks.
+        _loading (dict[tuple[str, str], threading.Lock]): The lock of each descriptor set being loaded, so that
+            concurrent requests for a set load it once while the other sets keep answering.
+
+    Methods:
+        __init__(self, qbe: QBE, max_resident_sets: int): Initializes the QBEServer object.
+        get_engine(self, descriptor_file_name: str, metric: str): Returns a resident search engine, loading it if needed.
+        query(self, descriptor_file_name: str, image_name: str, k: int, metric: str, html: bool): Answers a query.
+        query_image(self, descriptor_file_name: str, content: bytes, k: int, metric: str): Answers a query with an
+            external image.
+        reload(self, descriptor_file_name: str | None): Reloads resident descriptor sets without downtime.
+        status(self): Describes the resident descriptor sets and the result cache.
+        serve_http(self, host: str, port: int): Serves the endpoints over HTTP.
+        serve_unix(self, socket_path: str): Serves the endpoints over a Unix socket.
+    """
+
+    qbe: QBE
+    max_resident_sets: int
+    _engines: OrderedDict
+    _lock: threading.Lock
+    _loading: dict[tuple[str, str], threading.Lock]
+
+    def __init__(self, qbe: QBE, max_resident_sets: int = 4):
+        """
+        Initializes the QBEServer object.
+
+        Args:
+            qbe (QBE): The QBE object loading the descriptors and rendering the HTML files.
+            max_resident_sets (int): The maximum number of descriptor sets kept in memory.
+        """
+
+        self.qbe = qbe
+        self.max_resident_sets = max_resident_sets
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def get_engine(self, descriptor_file_name: str, metric: str = 'chebyshev') -> SearchEngine:
+        """
+        Returns the resident search engine of a descriptor set, loading it in memory if needed and evicting the least
+        recently used set beyond the resident limit.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            metric (str): Name of the distance metric.
+
+        Returns:
+            SearchEngine: The search engine over the descriptors.
+        """
+
+        key: tuple[str, str] = (descriptor_file_name, metric)
+
+        with self._lock:
+            if key in self._engines:
+                self._engines.move_to_end(key)
+                return self._engines[key]
+            loading: threading.Lock = self._loading.setdefault(key, threading.Lock())
+
+        # The loading is done under the lock of the set, so that concurrent requests don't load the same set twice,
+        # while the queries on the resident sets don't wait for it
+        with loading:
+            with self._lock:
+                if key in self._engines:
+                    self._engines.move_to_end(key)
+                    return self._engines[key]
+
+            # Logging information
+            logging.info(f'Loading {descriptor_file_name} ({metric}) in memory...')
+
+            try:
+                engine: SearchEngine = self.qbe.load_engine(descriptor_file_name, metric, resident=True)
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(key, None)
+                raise
+
+            with self._lock:
+                self._engines[key] = engine
+                self._loading.pop(key, None)
+
+                # Evict the least recently used sets
+                while len(self._engines) > self.max_resident_sets:
+                    evicted: tuple[str, str] = self._engines.popitem(last=False)[0]
+                    logging.info(f'Evicting {evicted[0]} ({evicted[1]}) from memory')
+
+            return engine
+
+    def query(
+            self,
+            descriptor_file_name: str,
+            image_name: str,
+            k: int,
+            metric: str = 'chebyshev',
+            html: bool = False
+            ) -> dict:
+        """
+        Answers a query.
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            image_name (str): Name of the base image.
+            k (int): Number of results to retrieve.
+            metric (str): Name of the distance metric.
+            html (bool): True to also generate the HTML file of the results.
+
+        Returns:
+            dict: The JSON-serializable query and results.
+        """
+
+        start: float = time.perf_counter()
+
+        # Read the results from the result cache, or search the graph, the shards or the resident engine (a
+        # reference: a concurrent reload swaps it without affecting this query)
+        distances: list[Distance]
+        cached: bool
+        distances, cached = self.qbe.cached_query(
+            descriptor_file_name, image_name, k, metric,
+            search=lambda: self.qbe._search(
+                descriptor_file_name, image_name, k, metric, load=lambda: self.get_engine(descriptor_file_name, metric)
+            )
+        )
+
+        # Render the HTML file on demand
+        if html:
+            self.qbe._generate_html_file(descriptor_file_name, image_name, distances, k, metric)
+
+        return {
+            'descriptor': descriptor_file_name,
+            'image': image_name,
+            'metric': metric,
+            'k': k,
+            'results': distances,
+            'cached': cached,
+            'elapsed_ms': (time.perf_counter() - start) * 1000
+        }
+
+    def query_image(self, descriptor_file_name: str, content: bytes, k: int, metric: str = 'chebyshev') -> dict:
+        """
+        Answers a query with an external image, whose descriptor is computed on the fly (and cached by content).
+
+        Args:
+            descriptor_file_name (str): Name of the descriptor file.
+            content (bytes): The content of the image file.
+            k (int): Number of results to retrieve.
+            metric (str): Name of the distance metric.
+
+        Returns:
+            dict: The JSON-serializable query and results.
+        """
+
+        # Search the shards, or the resident engine
+        start: float = time.perf_counter()
+        distances: list[Distance] = self.qbe.image_request(
+            descriptor_file_name, content, k, metric, lambda: self.get_engine(descriptor_file_name, metric)
+        )
+
+        return {
+            'descriptor': descriptor_file_name,
+            'metric': metric,
+            'k': k,
+            'results': distances,
+            'elapsed_ms': (time.perf_counter() - start) * 1000
+        }
+
+    def reload(self, descriptor_file_name: str | None = None) -> list[str]:
+        """
+        Reloads resident descriptor sets, e.g. after a re-indexing. The new sets are loaded while the old ones keep
+        answering queries, then swapped in, and the results cached while the old ones were resident are dropped.
+
+        Args:
+            descriptor_file_name (str | None): Name of the descriptor file to reload, None for every resident set.
+
+        Returns:
+            list[str]: The reloaded descriptor sets, as 'descriptor (metric)'.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        with self._lock:
+            keys: list[tuple[str, str]] = [
+                key for key in self._engines if descriptor_file_name is None or key[0] == descriptor_file_name
+            ]
+
+        reloaded: list[str] = []
+        for key in keys:
+            # Load the new set outside the lock
+            engine: SearchEngine = self.qbe.load_engine(key[0], key[1], resident=True)
+
+            # Swap it in, unless it was evicted meanwhile
+            with self._lock:
+                if key in self._engines:
+                    self._engines[key] = engine
+                    reloaded.append(f'{key[0]} ({key[1]})')
+
+            # Forget the results cached while the old set was resident
+            self.qbe.result_cache.invalidate(key[0])
+
+        # Logging information
+        logging.info(f'Reloaded: {", ".join(reloaded) or "nothing"}')
+
+        return reloaded
+
+    def status(self) -> dict:
+        """
+        Describes the resident descriptor sets and the result cache.
+
+        Returns:
+            dict: The JSON-serializable list of resident sets, least recently used first, and the counters of the
+                result cache (see ResultCache.statistics()).
+        """
+
+        with self._lock:
+            return {
+                'max_resident_sets': self.max_resident_sets,
+                'resident': [
+                    {'descriptor': key[0], 'metric': key[1], 'count': engine.matrix.shape[0], 'dim': engine.matrix.shape[1]}
+                    for key, engine in self._engines.items()
+                ],
+                'result_cache': self.qbe.result_cache.statistics()
+            }
+
+    def _handler(self) -> type:
+        """
+        Builds the HTTP request handler class bound to this server.
+
+        Returns:
+            type: The BaseHTTPRequestHandler subclass.
+        """
+
+        server: QBEServer = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def address_string(self) -> str:
+                # Unix-socket clients have no address
+                return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+            def log_message(self, format: str, *args):
+                logging.debug(f'{self.address_string()} - {format % args}')
+
+            def _send_json(self, status: int, body: dict | list):
+                payload: bytes = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_text(self, status: int, body: str):
+                payload: bytes = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _dispatch(self):
+                url = urlparse(self.path)
+                params: dict[str, str] = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                try:
+                    if url.path == '/query':
+                        self._send_json(200, server.query(
+                            params['descriptor'],
+                            params['image'],
+                            int(params.get('k', 30)),
+                            params.get('metric', 'chebyshev'),
+                            params.get('html', '0') not in ('0', 'false', '')
+                        ))
+                    elif url.path == '/query_image':
+                        content: bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                        if not content:
+                            raise ValueError('The image must be sent as the body of a POST request')
+                        self._send_json(200, server.query_image(
+                            params['descriptor'],
+                            content,
+                            int(params.get('k', 30)),
+                            params.get('metric', 'chebyshev')
+                        ))
+                    elif url.path == '/reload':
+                        self._send_json(200, {'reloaded': server.reload(params.get('descriptor'))})
+                    elif url.path == '/status':
+                        self._send_json(200, server.status())
+                    elif url.path == '/metrics':
+                        if params.get('format') == 'json':
+                            self._send_json(200, INSTRUMENTATION.to_dict())
+                        else:
+                            self._send_text(200, INSTRUMENTATION.to_prometheus())
+                    else:
+                        self._send_json(404, {'error': f'Unknown endpoint {url.path}'})
+                except KeyError as error:
+                    self._send_json(400, {'error': f'Missing parameter {error}'})
+                except (ValueError, OSError) as error:
+                    self._send_json(400, {'error': str(error)})
+                except Exception as error:
+                    logging.exception(f'Error while answering {self.path}')
+                    self._send_json(500, {'error': f'{type(error).__name__}: {error}'})
+
+            do_GET = _dispatch
+            do_POST = _dispatch
+
+        return Handler
+
+    def serve_http(self, host: str = '127.0.0.1', port: int = 8000):
+        """
+        Serves the endpoints over HTTP, each request in its own thread, until interrupted.
+
+        Args:
+            host (str): The address to listen on.
+            port (int): The port to listen on.
+        """
+
+        # Logging information
+        logging.info(f'QBE server listening on http://{host}:{port}')
+
+        with ThreadingHTTPServer((host, port), self._handler()) as http_server:
+            http_server.serve_forever()
+
+    def serve_unix(self, socket_path: str):
+        """
+        Serves the endpoints over HTTP on a Unix socket, each request in its own thread, until interrupted.
+
+        Args:
+            socket_path (str): The path to the Unix socket.
+        """
+
+        class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        # Remove a socket left by a previous run
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        # Logging information
+        logging.info(f'QBE server listening on unix:{socket_path}')
+
+        with ThreadingUnixHTTPServer(socket_path, self._handler()) as unix_server:
+            unix_server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Long-running Query By Example server')
+    parser.add_argument('--db-path', default='Base10000', help='Path to the database')
+    parser.add_argument('--descriptors-path', default='Base10000_descriptors', help='Path to the descriptors')
+    parser.add_argument('--preload', nargs='*', default=[], help='Descriptor files to load at startup')
+    parser.add_argument('--max-resident-sets', type=int, default=4, help='Maximum number of descriptor sets in memory')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--unix-socket', default='', help='Unix socket to listen on instead of a TCP port')
+    parser.add_argument('--max-cached-results', type=int, default=1024, help='Maximum number of query results in memory')
+    parser.add_argument('--result-cache-path', default='', help='Folder where the results evicted from memory are spilled')
+    parser.add_argument('--instrument', action='store_true', help='Record the stage timers and counters of /metrics')
+    arguments = parser.parse_args()
+
+    # Set the logging level and format
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if arguments.instrument:
+        INSTRUMENTATION.enable()
+
+    qbe: QBE = QBE(
+        arguments.db_path, arguments.descriptors_path,
+        max_cached_results=arguments.max_cached_results, result_cache_path=arguments.result_cache_path or None
+    )
+    qbe_server = QBEServer(qbe, arguments.max_resident_sets)
+
+    # Load the requested descriptor sets before serving
+    for preloaded in arguments.preload:
+        qbe_server.get_engine(preloaded)
+
+    try:
+        if arguments.unix_socket:
+            qbe_server.serve_unix(arguments.unix_socket)
+        else:
+            qbe_server.serve_http(arguments.host, arguments.port)
+    finally:
+        # Stop the worker processes of the sharded searches
+        qbe.close()
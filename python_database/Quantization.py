@@ -0,0 +1,143 @@
+import numpy as np
+
+
+class Quantizer:
+    """
+    A class representing the compact storage of descriptors: float16 values, or uint8 codes scalar-quantized with a
+    scale and an offset per dimension (value = offset + scale x code, the 256 codes spanning the range of the
+    dimension over the matrix the quantizer was fitted on).
+
+    Compact matrices are searched without ever decoding them whole: the distance kernels decode one block of rows at
+    a time to float32, a block small enough to stay in cache, so a scan reads 2 (float16) or 1 (uint8) byte per value
+    from memory instead of 4 or 8, and no full-size float copy is made.
+
+    Attributes:
+        dtype (np.dtype): The type of the stored values, float16 or uint8.
+        scale (np.ndarray | None): The float32 step of each dimension (uint8 only).
+        offset (np.ndarray | None): The float32 value of code 0 of each dimension (uint8 only).
+
+    Methods:
+        __init__(self, dtype: str, scale: np.ndarray | None, offset: np.ndarray | None): Initializes the Quantizer.
+        fit(matrix: np.ndarray, dtype: str): Fits a quantizer on the range of a matrix.
+        from_header(header: dict): Reads the quantizer of a store header.
+        to_header(self): Describes the quantizer in a store header.
+        encode(self, values: np.ndarray): Quantizes descriptors.
+        decode(self, codes: np.ndarray): Decodes compact descriptors to float32.
+    """
+
+    # Stored types of the compact matrices, the other types being stored as they are
+    DTYPES: tuple[str, ...] = ('float16', 'uint8')
+
+    dtype: np.dtype
+    scale: np.ndarray | None
+    offset: np.ndarray | None
+
+    def __init__(self, dtype: str, scale: np.ndarray | None = None, offset: np.ndarray | None = None):
+        """
+        Initializes the Quantizer object.
+
+        Args:
+            dtype (str): The type of the stored values, 'float16' or 'uint8'.
+            scale (np.ndarray | None): The step of each dimension, required for uint8.
+            offset (np.ndarray | None): The value of code 0 of each dimension, required for uint8.
+        """
+
+        if dtype not in self.DTYPES:
+            raise ValueError(f'Unknown compact type {dtype}, available types: {", ".join(self.DTYPES)}')
+        if dtype == 'uint8' and (scale is None or offset is None):
+            raise ValueError('A uint8 quantizer needs a scale and an offset per dimension')
+
+        self.dtype = np.dtype(dtype)
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float32)
+        self.offset = None if offset is None else np.asarray(offset, dtype=np.float32)
+
+    @staticmethod
+    def fit(matrix: np.ndarray, dtype: str) -> 'Quantizer':
+        """
+        Fits a quantizer on a matrix: for uint8, the codes of each dimension span its minimum to its maximum.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one per row.
+            dtype (str): The type of the stored values, 'float16' or 'uint8'.
+
+        Returns:
+            Quantizer: The quantizer.
+        """
+
+        if dtype != 'uint8':
+            return Quantizer(dtype)
+
+        matrix = np.asarray(matrix)
+        if matrix.shape[0] == 0:
+            return Quantizer(dtype, np.ones(matrix.shape[1]), np.zeros(matrix.shape[1]))
+
+        low: np.ndarray = matrix.min(axis=0).astype(np.float64)
+        spread: np.ndarray = matrix.max(axis=0) - low
+
+        # A constant dimension keeps a unit step, every value being encoded as code 0
+        return Quantizer(dtype, np.where(spread > 0, spread / 255, 1.0), low)
+
+    @staticmethod
+    def from_header(header: dict) -> 'Quantizer | None':
+        """
+        Reads the quantizer of a store header.
+
+        Args:
+            header (dict): The JSON header of a store.
+
+        Returns:
+            Quantizer | None: The quantizer of a compact store, None for a store of float32 or float64 values.
+        """
+
+        if header['dtype'] not in Quantizer.DTYPES:
+            return None
+
+        return Quantizer(header['dtype'], header.get('scale'), header.get('offset'))
+
+    def to_header(self) -> dict:
+        """
+        Describes the quantizer in a store header.
+
+        Returns:
+            dict: The scale and offset of each dimension, empty for float16.
+        """
+
+        if self.scale is None:
+            return {}
+
+        return {'scale': self.scale.tolist(), 'offset': self.offset.tolist()}
+
+    def encode(self, values: np.ndarray) -> np.ndarray:
+        """
+        Quantizes descriptors. uint8 values outside the fitted range are clipped to it.
+
+        Args:
+            values (np.ndarray): The descriptors, one per row.
+
+        Returns:
+            np.ndarray: The compact descriptors.
+        """
+
+        if self.scale is None:
+            return np.asarray(values, dtype=self.dtype)
+
+        codes: np.ndarray = np.rint((np.asarray(values, dtype=np.float32) - self.offset) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Decodes compact descriptors to float32.
+
+        Args:
+            codes (np.ndarray): The compact descriptors, one per row (or a single descriptor).
+
+        Returns:
+            np.ndarray: The float32 descriptors.
+        """
+
+        if self.scale is None:
+            return np.asarray(codes, dtype=np.float32)
+
+        values: np.ndarray = np.multiply(codes, self.scale, dtype=np.float32)
+        values += self.offset
+        return values
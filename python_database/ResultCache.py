@@ -0,0 +1,315 @@
+from collections import OrderedDict
+import hashlib
+import inspect
+from .Instrumentation import INSTRUMENTATION
+import json
+import logging
+import os
+import threading
+
+
+class ResultCache:
+    """
+    A class representing a bounded cache of query results, so that the popular images queried over and over are
+    answered without scanning the descriptors again.
+
+    An entry is keyed on (descriptor set, query image, metric, mode) and holds the results of the largest k queried
+    so far: a query with a smaller k is answered with the first results of a larger one. Each entry records the
+    version of the descriptor files it was computed on (see QBE._descriptor_version()), and is dropped when it is
+    read with another version, e.g. after an indexing run rewrote the store.
+
+    The entries are kept in memory, least recently used first. Beyond max_entries, the least recently used entries
+    are evicted, or spilled as JSON files to the spill folder when there is one, to be read back by a later query.
+    The spill folder keeps at most max_spilled entries, the oldest being deleted first.
+
+    Attributes:
+        max_entries (int): The number of entries kept in memory.
+        spill_path (str | None): The folder of the spilled entries, None to drop the evicted entries.
+        max_spilled (int): The number of entries kept in the spill folder.
+        hits (int): The number of queries answered from the cache.
+        misses (int): The number of queries not found in the cache (or with too few results).
+        evictions (int): The number of entries dropped from the cache (memory and spill folder).
+        invalidations (int): The number of entries dropped because the descriptors changed.
+        spills (int): The number of entries written to the spill folder.
+        _entries (OrderedDict[tuple, dict]): The entries in memory by key, least recently used first.
+        _spilled (OrderedDict[str, None]): The files of the spill folder, oldest first.
+        _lock (threading.Lock): The lock protecting the entries and the counters.
+
+    Methods:
+        __init__(self, max_entries: int, spill_path: str | None, max_spilled: int): Initializes the ResultCache object.
+        _file_name(key: tuple): Returns the name of the spill file of an entry.
+        get(self, key: tuple, version: str, k: int): Returns the first k cached results of a query.
+        put(self, key: tuple, version: str, k: int, results: list[dict]): Caches the results of a query.
+        _spill(self, key: tuple, entry: dict): Writes an evicted entry to the spill folder.
+        _unspill(self, key: tuple): Reads an entry back from the spill folder.
+        invalidate(self, descriptor_file_name: str | None): Drops the entries of a descriptor set.
+        statistics(self): Returns the counters and sizes of the cache.
+    """
+
+    max_entries: int
+    spill_path: str | None
+    max_spilled: int
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    spills: int
+    _entries: OrderedDict
+    _spilled: OrderedDict
+    _lock: threading.Lock
+
+    def __init__(self, max_entries: int = 1024, spill_path: str | None = None, max_spilled: int = 65536):
+        """
+        Initializes the ResultCache object, with the entries spilled by a previous run.
+
+        Args:
+            max_entries (int): The number of entries kept in memory.
+            spill_path (str | None): The folder of the spilled entries, None to drop the evicted entries.
+            max_spilled (int): The number of entries kept in the spill folder.
+        """
+
+        self.max_entries = max(0, max_entries)
+        self.spill_path = spill_path
+        self.max_spilled = max(0, max_spilled)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.spills = 0
+        self._entries = OrderedDict()
+        self._spilled = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Keep the entries spilled by a previous run, oldest first
+        if spill_path is not None:
+            os.makedirs(spill_path, exist_ok=True)
+            spilled: list[os.DirEntry] = [entry for entry in os.scandir(spill_path) if entry.name.endswith('.json')]
+            for entry in sorted(spilled, key=lambda entry: entry.stat().st_mtime_ns):
+                self._spilled[entry.name] = None
+
+    @staticmethod
+    def _file_name(key: tuple) -> str:
+        """
+        Returns the name of the spill file of an entry, prefixed by the hash of its descriptor set so that the
+        entries of a set can be found without reading them.
+
+        Args:
+            key (tuple): The key of the entry.
+
+        Returns:
+            str: The name of the spill file.
+        """
+
+        descriptor: str = hashlib.sha256(str(key[0]).encode('utf-8')).hexdigest()[:16]
+        query: str = hashlib.sha256(json.dumps(list(key)).encode('utf-8')).hexdigest()[:32]
+
+        return f'{descriptor}-{query}.json'
+
+    def get(self, key: tuple, version: str, k: int) -> list[dict] | None:
+        """
+        Returns the first k cached results of a query, from memory or from the spill folder.
+
+        Args:
+            key (tuple): The (descriptor set, query image, metric, mode) of the query.
+            version (str): The current version of the descriptors.
+            k (int): The number of results of the query.
+
+        Returns:
+            list[dict] | None: The results, None if the query is not cached with at least k results.
+        """
+
+        with self._lock:
+            entry: dict | None = self._entries.get(key)
+            if entry is None:
+                entry = self._unspill(key)
+
+            # Drop an entry computed on other descriptors than the current ones
+            if entry is not None and entry['version'] != version:
+                self._entries.pop(key, None)
+                self.invalidations += 1
+                INSTRUMENTATION.count('result_cache_invalidations')
+                entry = None
+
+            if entry is None or entry['k'] < k:
+                self.misses += 1
+                INSTRUMENTATION.count('result_cache_misses')
+                return None
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            INSTRUMENTATION.count('result_cache_hits')
+
+            return entry['results'][:k]
+
+    def put(self, key: tuple, version: str, k: int, results: list[dict]):
+        """
+        Caches the results of a query, evicting the least recently used entries beyond max_entries. The entry of a
+        larger k computed on the same descriptors is kept.
+
+        Args:
+            key (tuple): The (descriptor set, query image, metric, mode) of the query.
+            version (str): The version of the descriptors the results were computed on.
+            k (int): The number of results of the query.
+            results (list[dict]): The results, in ascending order of distance.
+        """
+
+        with self._lock:
+            entry: dict | None = self._entries.get(key)
+            if entry is not None and entry['version'] == version and entry['k'] >= k:
+                self._entries.move_to_end(key)
+                return
+
+            self._entries[key] = {'version': version, 'k': k, 'results': list(results)}
+            self._entries.move_to_end(key)
+
+            # Evict the least recently used entries, to the spill folder if there is one
+            while len(self._entries) > self.max_entries:
+                evicted_key: tuple
+                evicted: dict
+                evicted_key, evicted = self._entries.popitem(last=False)
+                if self.spill_path is not None and self.max_spilled > 0:
+                    self._spill(evicted_key, evicted)
+                else:
+                    self.evictions += 1
+                    INSTRUMENTATION.count('result_cache_evictions')
+
+    def _spill(self, key: tuple, entry: dict):
+        """
+        Writes an evicted entry to the spill folder, deleting the oldest spilled entries beyond max_spilled. The
+        caller holds the lock.
+
+        Args:
+            key (tuple): The key of the entry.
+            entry (dict): The entry.
+        """
+
+        file_name: str = self._file_name(key)
+        path: str = os.path.join(self.spill_path, file_name)
+
+        # Write the entry atomically, so that a concurrent reader never sees a partial file
+        temporary_path: str = f'{path}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({'key': list(key), **entry}, file)
+        os.replace(temporary_path, path)
+
+        self._spilled.pop(file_name, None)
+        self._spilled[file_name] = None
+        self.spills += 1
+        INSTRUMENTATION.count('result_cache_spills')
+
+        # Delete the oldest spilled entries
+        while len(self._spilled) > self.max_spilled:
+            try:
+                os.remove(os.path.join(self.spill_path, self._spilled.popitem(last=False)[0]))
+            except FileNotFoundError:
+                pass
+            self.evictions += 1
+            INSTRUMENTATION.count('result_cache_evictions')
+
+    def _unspill(self, key: tuple) -> dict | None:
+        """
+        Reads an entry back from the spill folder into memory. The caller holds the lock.
+
+        Args:
+            key (tuple): The key of the entry.
+
+        Returns:
+            dict | None: The entry, None if it was not spilled.
+        """
+
+        if self.spill_path is None:
+            return None
+
+        file_name: str = self._file_name(key)
+        if file_name not in self._spilled:
+            return None
+
+        # The entry moves back to memory
+        path: str = os.path.join(self.spill_path, file_name)
+        try:
+            with open(path, 'r') as file:
+                spilled: dict = json.load(file)
+            os.remove(path)
+        except (OSError, ValueError) as error:
+            logging.warning(f'Ignoring the spilled result {path}: {error}')
+            spilled = {}
+        del self._spilled[file_name]
+
+        # Ignore a file of another key with the same hash
+        if tuple(spilled.get('key', ())) != key:
+            return None
+
+        entry: dict = {'version': spilled['version'], 'k': spilled['k'], 'results': spilled['results']}
+
+        # Make room for it in memory, spilling the least recently used entries in its place
+        if self.max_entries > 0:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._spill(*self._entries.popitem(last=False))
+
+        return entry
+
+    def invalidate(self, descriptor_file_name: str | None = None) -> int:
+        """
+        Drops the entries of a descriptor set, in memory and in the spill folder, e.g. when it is reloaded.
+
+        Args:
+            descriptor_file_name (str | None): Name of the descriptor set, None for every set.
+
+        Returns:
+            int: The number of dropped entries.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        with self._lock:
+            keys: list[tuple] = [
+                key for key in self._entries if descriptor_file_name is None or key[0] == descriptor_file_name
+            ]
+            for key in keys:
+                del self._entries[key]
+
+            # The spill files of the set start with the hash of its name
+            prefix: str = self._file_name((descriptor_file_name,)).split('-')[0] + '-'
+            files: list[str] = [
+                file_name for file_name in self._spilled
+                if descriptor_file_name is None or file_name.startswith(prefix)
+            ]
+            for file_name in files:
+                del self._spilled[file_name]
+                try:
+                    os.remove(os.path.join(self.spill_path, file_name))
+                except FileNotFoundError:
+                    pass
+
+            dropped: int = len(keys) + len(files)
+            self.invalidations += dropped
+            INSTRUMENTATION.count('result_cache_invalidations', dropped)
+
+        return dropped
+
+    def statistics(self) -> dict:
+        """
+        Returns the counters and sizes of the cache.
+
+        Returns:
+            dict: The JSON-serializable hits, misses, hit rate, evictions, invalidations, spills and numbers of
+                entries in memory and in the spill folder.
+        """
+
+        with self._lock:
+            queries: int = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / queries if queries else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'spills': self.spills,
+                'entries': len(self._entries),
+                'spilled': len(self._spilled),
+                'max_entries': self.max_entries,
+                'max_spilled': self.max_spilled if self.spill_path is not None else 0
+            }
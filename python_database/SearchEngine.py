@@ -0,0 +1,409 @@
+from .Instrumentation import INSTRUMENTATION
+from .Metrics import get_metric, Metric
+import numpy as np
+from .Quantization import Quantizer
+import time
+
+
+class SearchEngine:
+    """
+    A class representing a brute-force nearest neighbours search over a descriptor matrix.
+
+    A compact matrix (float16 or uint8 codes, see Quantization.Quantizer) is scanned in blocks of rows decoded to
+    float32 one at a time, its values that only depend on the rows being kept when they are one value per row and
+    recomputed for each block otherwise.
+
+    Attributes:
+        matrix (np.ndarray): The descriptors, one row per file.
+        files (list[str]): The filename of the image described by each row.
+        metric (Metric): The distance metric.
+        quantizer (Quantizer | None): The quantizer of a compact matrix, None for a matrix of float values.
+        dtype (np.dtype): The type the distances are computed in (float32 for a compact matrix).
+        index: An optional index answering search_vector() instead of the brute-force scan (e.g. a VPTree).
+        evaluations (int): The number of distance evaluations of the last search_vector() call.
+        _state (dict[str, np.ndarray]): The values precomputed by the metric for the rows of the matrix.
+        _block_state (bool): True if the values precomputed by the metric are recomputed for each decoded block.
+        _block_rows (int): The number of rows of a decoded block of a compact matrix.
+        _rows (dict[str, int]): The row of each filename.
+
+    Methods:
+        __init__(self, matrix: np.ndarray, files: list[str], metric: str, quantizer: Quantizer | None):
+            Initializes the SearchEngine object.
+        row(self, image_name: str): Returns the row of an image.
+        vectors(self, rows): Returns decoded rows of the matrix.
+        _rows_block(self, start: int, stop: int): Returns a range of rows and their precomputed values.
+        distances(self, query: np.ndarray): Computes the distances between a descriptor and every row.
+        block_distances(self, queries: np.ndarray, start: int, stop: int): Computes a block of distances.
+        top_k(distances: np.ndarray, k: int, exclude: int): Selects the k smallest distances.
+        _merge_top_k(best_rows, best_distances, block, start, k, exclude): Merges a block of distances into running top-k.
+        search_vector(self, query: np.ndarray, k: int, exclude: int): Finds the nearest neighbours of a descriptor.
+        search(self, image_name: str, k: int): Finds the nearest neighbours of an image of the database.
+        batch_search(self, queries: np.ndarray, k: int, exclude: np.ndarray, query_tile: int, tile_bytes: int):
+            Finds the nearest neighbours of many descriptors, tile by tile.
+    """
+
+    # Row number of the empty slots of a running top-k, sorting after every real row
+    NO_ROW: int = np.iinfo(np.intp).max
+
+    matrix: np.ndarray
+    files: list[str]
+    metric: Metric
+    quantizer: Quantizer | None
+    dtype: np.dtype
+    index: object | None
+    evaluations: int
+    _state: dict[str, np.ndarray]
+    _block_state: bool
+    _block_rows: int
+    _rows: dict[str, int]
+
+    # Number of values of a decoded block of a compact matrix (256 KiB of float32, which stays in cache)
+    BLOCK_VALUES: int = 1 << 16
+
+    def __init__(self, matrix: np.ndarray, files: list[str], metric: str = 'chebyshev', quantizer: Quantizer | None = None):
+        """
+        Initializes the SearchEngine object.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one row per file.
+            files (list[str]): The filename of the image described by each row.
+            metric (str): The name of the distance metric (see Metrics.METRICS).
+            quantizer (Quantizer | None): The quantizer of a compact matrix, None for a matrix of float values.
+        """
+
+        self.matrix = matrix
+        self.files = files
+        self.quantizer = quantizer
+        self.dtype = matrix.dtype if quantizer is None else np.dtype(np.float32)
+        self._block_rows = max(1, self.BLOCK_VALUES // max(1, matrix.shape[1]))
+
+        # Get the metric and precompute its values that only depend on the rows (norms...)
+        self.metric = get_metric(metric)
+        self._block_state = False
+        if quantizer is None:
+            self._state = self.metric.prepare(matrix)
+        else:
+            # Keep the values of a compact matrix that are one per row, block by block
+            blocks: list[dict[str, np.ndarray]] = [
+                self.metric.prepare(quantizer.decode(matrix[start:start + self._block_rows]))
+                for start in range(0, matrix.shape[0], self._block_rows)
+            ] or [self.metric.prepare(np.empty((0, matrix.shape[1]), dtype=self.dtype))]
+            self._state = {
+                name: np.concatenate([block[name] for block in blocks])
+                for name, values in blocks[0].items() if values.ndim == 1
+            }
+            self._block_state = len(self._state) < len(blocks[0])
+
+        # Brute-force scan until an index is attached
+        self.index = None
+        self.evaluations = 0
+
+        # Map each filename to its row, keeping the first row of a duplicated filename like list.index()
+        self._rows = {}
+        for row, filename in enumerate(files):
+            self._rows.setdefault(filename, row)
+
+    def row(self, image_name: str) -> int:
+        """
+        Returns the row of an image.
+
+        Args:
+            image_name (str): The filename of the image.
+
+        Returns:
+            int: The row of the image in the descriptor matrix.
+        """
+
+        try:
+            return self._rows[image_name]
+        except KeyError:
+            raise ValueError(f'{image_name} is not in the database') from None
+
+    def vectors(self, rows) -> np.ndarray:
+        """
+        Returns rows of the matrix, decoded if the matrix is compact, e.g. to use them as queries.
+
+        Args:
+            rows: A row index, or an array of row indices.
+
+        Returns:
+            np.ndarray: The descriptors of the rows.
+        """
+
+        if self.quantizer is None:
+            return self.matrix[rows]
+
+        return self.quantizer.decode(self.matrix[rows])
+
+    def _rows_block(self, start: int, stop: int) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        """
+        Returns a range of rows of the matrix, decoded if the matrix is compact, and their precomputed values.
+
+        Args:
+            start (int): The first row of the range.
+            stop (int): The end of the range (excluded).
+
+        Returns:
+            tuple[np.ndarray, dict[str, np.ndarray]]: The rows and the values precomputed by the metric for them.
+        """
+
+        if self.quantizer is None:
+            return self.matrix[start:stop], {name: values[start:stop] for name, values in self._state.items()}
+
+        rows: np.ndarray = self.quantizer.decode(self.matrix[start:stop])
+        if self._block_state:
+            return rows, self.metric.prepare(rows)
+
+        return rows, {name: values[start:stop] for name, values in self._state.items()}
+
+    def distances(self, query: np.ndarray) -> np.ndarray:
+        """
+        Computes the distance between a descriptor and every row of the matrix, in one operation (one per block for
+        a compact matrix or a metric that transforms the rows, so that no copy of the whole matrix is made).
+
+        Args:
+            query (np.ndarray): The query descriptor.
+
+        Returns:
+            np.ndarray: The distance to each row.
+        """
+
+        if self.quantizer is None and not self.metric.transforms_rows:
+            return self.metric.distances(query, self.matrix, self._state)
+
+        query = np.asarray(query, dtype=self.dtype)
+        count: int = self.matrix.shape[0]
+        result: np.ndarray = np.empty(count, dtype=self.dtype)
+        for start in range(0, count, self._block_rows):
+            stop: int = min(start + self._block_rows, count)
+            result[start:stop] = self.metric.distances(query, *self._rows_block(start, stop))
+
+        return result
+
+    def block_distances(self, queries: np.ndarray, start: int, stop: int) -> np.ndarray:
+        """
+        Computes the distances between several descriptors and a range of rows of the matrix.
+
+        Args:
+            queries (np.ndarray): The query descriptors, one per row.
+            start (int): The first row of the range.
+            stop (int): The end of the range (excluded).
+
+        Returns:
+            np.ndarray: The (queries, rows) block of distances.
+        """
+
+        return self.metric.block_distances(queries, *self._rows_block(start, stop))
+
+    @staticmethod
+    def top_k(distances: np.ndarray, k: int, exclude: int = -1) -> np.ndarray:
+        """
+        Selects the rows with the k smallest distances with a partial selection, sorted by increasing distance.
+        Equal distances are ordered by row, like a stable sort of every distance.
+
+        Args:
+            distances (np.ndarray): The distance to each row.
+            k (int): The number of rows to select.
+            exclude (int): A row to leave out of the selection (e.g. the query image), -1 for none.
+
+        Returns:
+            np.ndarray: The selected rows.
+        """
+
+        # Leave the excluded row out without modifying the caller's array
+        if exclude >= 0:
+            distances = distances.copy()
+            distances[exclude] = np.inf
+            k = min(k, distances.shape[0] - 1)
+        k = min(k, distances.shape[0])
+
+        if k <= 0:
+            return np.empty(0, dtype=np.intp)
+
+        # Find the k-th smallest distance without sorting every distance
+        kth: float = distances[np.argpartition(distances, k - 1)[k - 1]]
+
+        # Keep every row up to that distance (in increasing row order), then sort them stably by distance
+        candidates: np.ndarray = np.flatnonzero(distances <= kth)
+        if exclude >= 0:
+            candidates = candidates[candidates != exclude]
+        order: np.ndarray = np.argsort(distances[candidates], kind='stable')
+
+        return candidates[order[:k]]
+
+    @staticmethod
+    def _merge_top_k(
+            best_rows: np.ndarray,
+            best_distances: np.ndarray,
+            block: np.ndarray,
+            start: int,
+            k: int,
+            exclude: np.ndarray
+            ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Merges a block of distances into the running top-k of each query. The block covers rows after every row
+        already in the running top-k, so equal distances keep being ordered by row.
+
+        Args:
+            best_rows (np.ndarray): The (queries, k) running top-k rows, NO_ROW where there is no row yet.
+            best_distances (np.ndarray): The (queries, k) running top-k distances, inf where there is no row yet.
+            block (np.ndarray): The (queries, rows) block of distances, inf in the excluded columns.
+            start (int): The row of the first column of the block.
+            k (int): The number of rows to select.
+            exclude (np.ndarray): The excluded column of each query, -1 for none.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The merged top-k rows and distances.
+        """
+
+        # Select the k smallest distances of the block for each query
+        columns: np.ndarray
+        if block.shape[1] <= k:
+            columns = np.broadcast_to(np.arange(block.shape[1]), block.shape)
+        else:
+            columns = np.argpartition(block, k - 1, axis=1)[:, :k]
+
+            # The partial selection breaks ties arbitrarily: redo it exactly for the queries with ties on the k-th
+            kth: np.ndarray = np.take_along_axis(block, columns, axis=1).max(axis=1, keepdims=True)
+            for query in np.flatnonzero((block <= kth).sum(axis=1) > k):
+                columns[query] = SearchEngine.top_k(block[query], k, exclude[query])
+
+        # An excluded column selected with the other infinite distances sorts after every real row
+        selected_rows: np.ndarray = np.where(columns == exclude[:, np.newaxis], SearchEngine.NO_ROW, columns + start)
+
+        # Sort the running top-k and the block selection together, by distance then by row
+        rows: np.ndarray = np.concatenate((best_rows, selected_rows), axis=1)
+        distances: np.ndarray = np.concatenate((best_distances, np.take_along_axis(block, columns, axis=1)), axis=1)
+        order: np.ndarray = np.lexsort((rows, distances))[:, :k]
+
+        return np.take_along_axis(rows, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def search_vector(self, query: np.ndarray, k: int, exclude: int = -1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of a descriptor, through the index of the engine if it has one.
+
+        Args:
+            query (np.ndarray): The query descriptor.
+            k (int): The number of neighbours to find.
+            exclude (int): A row to leave out of the results (e.g. the query image), -1 for none.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The rows of the neighbours and their distances, by increasing distance.
+        """
+
+        with INSTRUMENTATION.stage('query'):
+            # Search the index, which reports how many distances it evaluated
+            if self.index is not None:
+                rows: np.ndarray
+                distances: np.ndarray
+                rows, distances, self.evaluations = self.index.search(query, k, exclude)
+                INSTRUMENTATION.count('distance_evaluations', self.evaluations)
+                return rows, distances
+
+            # Compute the distance between the query and every row
+            all_distances: np.ndarray = self.distances(query)
+            self.evaluations = all_distances.shape[0]
+            INSTRUMENTATION.count('distance_evaluations', self.evaluations)
+
+            # Select the nearest neighbours
+            selected: np.ndarray = self.top_k(all_distances, k, exclude)
+
+            return selected, all_distances[selected]
+
+    def search(self, image_name: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of an image of the database, the image itself excluded.
+
+        Args:
+            image_name (str): The filename of the query image.
+            k (int): The number of neighbours to find.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The rows of the neighbours and their distances, by increasing distance.
+        """
+
+        # Search the neighbours of the descriptor of the query image, the image itself excluded
+        query_row: int = self.row(image_name)
+
+        return self.search_vector(self.vectors(query_row), k, query_row)
+
+    def batch_search(
+            self,
+            queries: np.ndarray,
+            k: int,
+            exclude: np.ndarray | None = None,
+            query_tile: int = 32,
+            tile_bytes: int = 1 << 23
+            ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of many descriptors in one pass over the matrix. Distances are computed in
+        (query tile x row tile) blocks of about tile_bytes, so memory is bounded by the tile size, not by the number
+        of queries times the number of rows. Each query gets the same results as with search(), up to the rounding
+        differences between matrix-vector and matrix-matrix products for the metrics computed with products.
+
+        Args:
+            queries (np.ndarray): The query descriptors, one per row.
+            k (int): The number of neighbours to find.
+            exclude (np.ndarray | None): The row to leave out of the results of each query (e.g. the query image
+                itself), -1 for none. None leaves out nothing.
+            query_tile (int): The number of queries per tile.
+            tile_bytes (int): The approximate size of a block of distance computations, in bytes.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (queries, k) rows of the neighbours and their distances,
+                by increasing distance.
+        """
+
+        queries = np.asarray(queries, dtype=self.dtype).reshape(-1, self.matrix.shape[1])
+        count: int = self.matrix.shape[0]
+
+        # Rows left out of each query's results
+        if exclude is None:
+            exclude = np.full(queries.shape[0], -1)
+
+        # Never return more neighbours than there are rows left
+        k = min(k, count - 1 if np.any(exclude >= 0) else count)
+
+        # Number of rows per tile, so that a (query tile x row tile x dimension) block fits in tile_bytes
+        row_tile: int = max(1, tile_bytes // max(1, query_tile * queries.shape[1] * self.dtype.itemsize))
+
+        # Count the distances of the whole batch at once
+        INSTRUMENTATION.count('distance_evaluations', queries.shape[0] * count)
+        start_time: float = time.perf_counter()
+
+        # Output arrays
+        all_rows: np.ndarray = np.empty((queries.shape[0], k), dtype=np.intp)
+        all_distances: np.ndarray = np.empty((queries.shape[0], k), dtype=self.dtype)
+
+        # Iterate over each tile of queries
+        for query_start in range(0, queries.shape[0], query_tile):
+            query_stop: int = min(query_start + query_tile, queries.shape[0])
+            tile_queries: np.ndarray = queries[query_start:query_stop]
+            tile_exclude: np.ndarray = exclude[query_start:query_stop]
+
+            # Running top-k of the tile queries
+            best_rows: np.ndarray = np.full((tile_queries.shape[0], k), self.NO_ROW, dtype=np.intp)
+            best_distances: np.ndarray = np.full((tile_queries.shape[0], k), np.inf, dtype=self.dtype)
+
+            # Iterate over each tile of rows, in row order
+            for start in range(0, count, row_tile):
+                stop: int = min(start + row_tile, count)
+                block: np.ndarray = self.block_distances(tile_queries, start, stop)
+
+                # Leave the excluded rows out of the block
+                excluded: np.ndarray = np.flatnonzero((tile_exclude >= start) & (tile_exclude < stop))
+                block[excluded, tile_exclude[excluded] - start] = np.inf
+                exclude_columns: np.ndarray = np.full(tile_queries.shape[0], -1)
+                exclude_columns[excluded] = tile_exclude[excluded] - start
+
+                # Merge the block into the running top-k
+                best_rows, best_distances = self._merge_top_k(
+                    best_rows, best_distances, block, start, k, exclude_columns
+                )
+
+            all_rows[query_start:query_stop] = best_rows
+            all_distances[query_start:query_stop] = best_distances
+
+        INSTRUMENTATION.observe('batch_query', time.perf_counter() - start_time)
+
+        return all_rows, all_distances
@@ -0,0 +1,421 @@
+from .DescriptorStore import DescriptorStore
+import heapq
+import inspect
+from .Instrumentation import INSTRUMENTATION
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+from .SearchEngine import SearchEngine
+
+
+# Search engines opened by a worker process of a sharded search, by (shard path, metric)
+_worker_engines: dict[tuple[str, str], SearchEngine] = {}
+
+
+def _shard_engine(path: str, metric: str) -> SearchEngine:
+    """
+    Returns the search engine over a shard, memory-mapping the shard on first use in the current process.
+
+    Args:
+        path (str): The path to the shard store.
+        metric (str): The name of the distance metric.
+
+    Returns:
+        SearchEngine: The search engine over the shard.
+    """
+
+    engine: SearchEngine | None = _worker_engines.get((path, metric))
+    if engine is None:
+        store: DescriptorStore = DescriptorStore(path)
+        engine = _worker_engines[(path, metric)] = SearchEngine(store.matrix, store.files, metric, store.quantizer)
+
+    return engine
+
+
+def _search_shard(task: tuple[str, str, int, np.ndarray, int, int]) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Finds the nearest neighbours of a descriptor in one shard, in a worker process.
+
+    Args:
+        task (tuple[str, str, int, np.ndarray, int, int]): The shard path, the metric, the row of the first row of
+            the shard, the query descriptor, the number of neighbours and the row to leave out (-1 for none).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, int]: The rows of the neighbours in the whole collection, their distances,
+            by increasing distance, and the number of distance evaluations.
+    """
+
+    path, metric, start, query, k, exclude = task
+    engine: SearchEngine = _shard_engine(path, metric)
+    rows, distances = engine.search_vector(query, k, exclude - start if start <= exclude < start + len(engine.files) else -1)
+
+    return rows + start, distances, engine.evaluations
+
+
+class ShardedStore:
+    """
+    A class representing a descriptor store partitioned into shards: each shard is a descriptor store holding a
+    range of rows of the collection (and the filenames of these rows), and a JSON catalog records the shards in
+    row order. A shard is never rewritten when the collection grows: new images go to a new shard, added to the
+    catalog.
+
+    Catalog layout:
+        {"format": 1, "descriptor": ..., "dtype": ..., "dim": ..., "generation": ...,
+         "shards": [{"file": "<name>.shard0000.store", "start": 0, "count": ...}, ...]}
+    The shard files are relative to the folder of the catalog.
+
+    Attributes:
+        path (str): The path to the catalog file.
+        descriptor (str): The descriptor type.
+        dtype (str): The type of the stored values (see DescriptorStore.write()).
+        dim (int): The dimension of the descriptors.
+        generation (int): A counter incremented each time the catalog is written.
+        shards (list[dict]): The file, first row and number of rows of each shard.
+
+    Methods:
+        __init__(self, path: str, catalog: dict | None): Reads a catalog.
+        count(self): Returns the number of rows of the collection.
+        shard_path(self, shard: dict): Returns the path to a shard store.
+        _save(self): Writes the catalog.
+        create(path, descriptor, matrix, files, shard_count, dtype): Splits descriptors into a new sharded store.
+        _write_shard(self, matrix: np.ndarray, files: list[str]): Writes a shard of new rows.
+        add_shard(self, matrix: np.ndarray, files: list[str]): Adds a shard of new rows.
+    """
+
+    EXTENSION: str = '.catalog.json'
+    FORMAT_VERSION: int = 1
+
+    path: str
+    descriptor: str
+    dtype: str
+    dim: int
+    generation: int
+    shards: list[dict]
+
+    def __init__(self, path: str, catalog: dict | None = None):
+        """
+        Reads a catalog.
+
+        Args:
+            path (str): The path to the catalog file.
+            catalog (dict | None): The content of the catalog, None to read it from the file.
+        """
+
+        self.path = path
+        if catalog is None:
+            with open(path, 'r') as file:
+                catalog = json.load(file)
+
+        self.descriptor = catalog['descriptor']
+        self.dtype = catalog['dtype']
+        self.dim = catalog['dim']
+        self.generation = catalog['generation']
+        self.shards = catalog['shards']
+
+    def count(self) -> int:
+        """
+        Returns the number of rows of the collection.
+
+        Returns:
+            int: The number of rows of every shard.
+        """
+
+        return sum(shard['count'] for shard in self.shards)
+
+    def shard_path(self, shard: dict) -> str:
+        """
+        Returns the path to a shard store.
+
+        Args:
+            shard (dict): The catalog entry of the shard.
+
+        Returns:
+            str: The path to the shard store, next to the catalog.
+        """
+
+        return os.path.join(os.path.dirname(self.path), shard['file'])
+
+    def _save(self):
+        """
+        Writes the catalog, incrementing its generation. The catalog is written next to its destination then moved,
+        so that a reader never sees a partially written catalog.
+        """
+
+        self.generation += 1
+        temporary_path: str = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({
+                'format': ShardedStore.FORMAT_VERSION,
+                'descriptor': self.descriptor,
+                'dtype': self.dtype,
+                'dim': self.dim,
+                'generation': self.generation,
+                'shards': self.shards
+            }, file, indent=2)
+        os.replace(temporary_path, self.path)
+
+    @staticmethod
+    def create(
+            path: str,
+            descriptor: str,
+            matrix: np.ndarray,
+            files: list[str],
+            shard_count: int,
+            dtype: str = 'float32'
+            ) -> 'ShardedStore':
+        """
+        Splits descriptors into shards of consecutive rows of about the same size, and writes their catalog.
+
+        Args:
+            path (str): The path to the catalog file, ending with the catalog extension.
+            descriptor (str): The descriptor type.
+            matrix (np.ndarray): The descriptors, one row per file.
+            files (list[str]): The filename of the image described by each row.
+            shard_count (int): The number of shards.
+            dtype (str): The type of the stored values (see DescriptorStore.write()).
+
+        Returns:
+            ShardedStore: The sharded store.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        if not path.endswith(ShardedStore.EXTENSION):
+            raise ValueError(f'The catalog path must end with {ShardedStore.EXTENSION}')
+
+        matrix = np.asarray(matrix)
+        if matrix.shape[0] != len(files):
+            raise ValueError(f'{matrix.shape[0]} descriptors for {len(files)} files')
+
+        # Keep counting the generations of a catalog that is replaced
+        generation: int = -1
+        if os.path.exists(path):
+            try:
+                generation = ShardedStore(path).generation
+            except (ValueError, KeyError):
+                pass
+
+        # Start from an empty catalog, the catalog file being replaced once every shard is written
+        store: ShardedStore = ShardedStore(path, {
+            'descriptor': descriptor, 'dtype': dtype, 'dim': matrix.shape[1], 'generation': generation, 'shards': []
+        })
+
+        # Write the shards, then the catalog
+        bounds: np.ndarray = np.linspace(0, len(files), max(1, shard_count) + 1).astype(int)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            store._write_shard(matrix[start:stop], files[start:stop])
+        store._save()
+
+        # Logging information
+        logging.info(f'{path}: {len(files)} descriptors in {len(store.shards)} shards')
+
+        return store
+
+    def _write_shard(self, matrix: np.ndarray, files: list[str]):
+        """
+        Writes a shard of new rows after the last shard, and records it in the catalog (not saved).
+
+        Args:
+            matrix (np.ndarray): The new descriptors, one row per file.
+            files (list[str]): The filename of the image described by each new row.
+        """
+
+        name: str = os.path.basename(self.path).removesuffix(self.EXTENSION)
+        shard: dict = {'file': f'{name}.shard{len(self.shards):04d}{DescriptorStore.EXTENSION}', 'start': self.count(), 'count': len(files)}
+        DescriptorStore.write(self.shard_path(shard), self.descriptor, matrix, files, self.dtype)
+        self.shards.append(shard)
+
+    def add_shard(self, matrix: np.ndarray, files: list[str]):
+        """
+        Adds a shard of new rows after the last one, without rewriting the existing shards.
+
+        Args:
+            matrix (np.ndarray): The new descriptors, one row per file.
+            files (list[str]): The filename of the image described by each new row, none already in the collection.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        matrix = np.asarray(matrix).reshape(len(files), self.dim)
+
+        # A filename maps to a single row of the collection
+        existing: set[str] = set()
+        for shard in self.shards:
+            existing.update(DescriptorStore(self.shard_path(shard)).files)
+        duplicated: list[str] = [filename for filename in files if filename in existing]
+        if duplicated:
+            raise ValueError(f'{len(duplicated)} images are already in the collection (e.g. {duplicated[0]})')
+
+        self._write_shard(matrix, files)
+        self._save()
+
+        # Logging information
+        logging.info(f'{self.path}: shard {len(self.shards) - 1} added ({len(files)} descriptors)')
+
+
+class ShardedEngine:
+    """
+    A class representing a nearest neighbours search over a sharded store: each query is scattered to every shard,
+    searched in parallel by a pool of worker processes (each memory-mapping the shards it searches once), and the
+    sorted top-k of the shards are gathered with a heap merge. Equal distances are ordered by row, so the results are
+    the ones of a search of the whole collection in a single store.
+
+    Attributes:
+        store (ShardedStore): The sharded store.
+        metric (str): The name of the distance metric.
+        files (list[str]): The filename of the image described by each row of the collection.
+        evaluations (int): The number of distance evaluations of the last search_vector() call.
+        _paths (list[str]): The path to each shard store.
+        _starts (list[int]): The first row of each shard.
+        _stores (list[DescriptorStore]): The shard stores, memory-mapped to read the query descriptors.
+        _rows (dict[str, int]): The row of each filename.
+        _pool (multiprocessing.pool.Pool | None): The worker processes, None to search the shards in this process.
+
+    Methods:
+        __init__(self, store: ShardedStore, metric: str, workers: int | None): Opens the shards and the workers.
+        row(self, image_name: str): Returns the row of an image.
+        vector(self, row: int): Returns the descriptor of a row.
+        search_vector(self, query: np.ndarray, k: int, exclude: int): Finds the nearest neighbours of a descriptor.
+        search(self, image_name: str, k: int): Finds the nearest neighbours of an image of the collection.
+        close(self): Stops the worker processes.
+    """
+
+    store: ShardedStore
+    metric: str
+    files: list[str]
+    evaluations: int
+    _paths: list[str]
+    _starts: list[int]
+    _stores: list[DescriptorStore]
+    _rows: dict[str, int]
+    _pool: object | None
+
+    def __init__(self, store: ShardedStore, metric: str = 'chebyshev', workers: int | None = None):
+        """
+        Opens the shards and starts the worker processes.
+
+        Args:
+            store (ShardedStore): The sharded store.
+            metric (str): The name of the distance metric (see Metrics.METRICS).
+            workers (int | None): The number of worker processes, None for one per shard up to the number of cores,
+                0 to search the shards one after the other in this process.
+        """
+
+        self.store = store
+        self.metric = metric
+        self.evaluations = 0
+        self._paths = [store.shard_path(shard) for shard in store.shards]
+        self._starts = [shard['start'] for shard in store.shards]
+        self._stores = [DescriptorStore(path) for path in self._paths]
+
+        # Filenames of the collection, in row order
+        self.files = [filename for shard_store in self._stores for filename in shard_store.files]
+        self._rows = {}
+        for row, filename in enumerate(self.files):
+            self._rows.setdefault(filename, row)
+
+        if workers is None:
+            workers = min(len(self._paths), os.cpu_count() or 1)
+        self._pool = multiprocessing.Pool(workers) if workers > 0 and len(self._paths) > 1 else None
+
+    def __enter__(self) -> 'ShardedEngine':
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def row(self, image_name: str) -> int:
+        """
+        Returns the row of an image.
+
+        Args:
+            image_name (str): The filename of the image.
+
+        Returns:
+            int: The row of the image in the collection.
+        """
+
+        try:
+            return self._rows[image_name]
+        except KeyError:
+            raise ValueError(f'{image_name} is not in the database') from None
+
+    def vector(self, row: int) -> np.ndarray:
+        """
+        Returns the descriptor of a row of the collection, decoded if its shard is compact.
+
+        Args:
+            row (int): The row.
+
+        Returns:
+            np.ndarray: The descriptor.
+        """
+
+        shard: int = int(np.searchsorted(self._starts, row, side='right')) - 1
+        shard_store: DescriptorStore = self._stores[shard]
+        values: np.ndarray = shard_store.matrix[row - self._starts[shard]]
+
+        return shard_store.quantizer.decode(values) if shard_store.quantizer is not None else np.array(values)
+
+    def search_vector(self, query: np.ndarray, k: int, exclude: int = -1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of a descriptor in every shard, then merges the top-k of the shards.
+
+        Args:
+            query (np.ndarray): The query descriptor.
+            k (int): The number of neighbours to find.
+            exclude (int): A row of the collection to leave out of the results (e.g. the query image), -1 for none.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The rows of the neighbours and their distances, by increasing distance.
+        """
+
+        with INSTRUMENTATION.stage('query'):
+            # Scatter the query to every shard
+            tasks: list[tuple] = [(path, self.metric, start, query, k, exclude) for path, start in zip(self._paths, self._starts)]
+            results: list[tuple[np.ndarray, np.ndarray, int]] = (
+                self._pool.map(_search_shard, tasks) if self._pool is not None else [_search_shard(task) for task in tasks]
+            )
+
+            # Gather the sorted top-k of the shards, by distance then by row
+            merged: list[tuple[float, int]] = list(heapq.merge(
+                *(zip(distances.tolist(), rows.tolist()) for rows, distances, _ in results)
+            ))[:k]
+            self.evaluations = sum(evaluations for _, _, evaluations in results)
+            INSTRUMENTATION.count('distance_evaluations', self.evaluations)
+
+        dtype: np.dtype = results[0][1].dtype if results else np.dtype(np.float64)
+        return (
+            np.array([row for _, row in merged], dtype=np.intp),
+            np.array([distance for distance, _ in merged], dtype=dtype)
+        )
+
+    def search(self, image_name: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of an image of the collection, the image itself excluded.
+
+        Args:
+            image_name (str): The filename of the query image.
+            k (int): The number of neighbours to find.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The rows of the neighbours and their distances, by increasing distance.
+        """
+
+        query_row: int = self.row(image_name)
+
+        return self.search_vector(self.vector(query_row), k, query_row)
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,318 @@
+from .DescriptorStore import DescriptorStore
+from .Instrumentation import INSTRUMENTATION
+import itertools
+import logging
+from .Metrics import get_metric, Metric
+import numpy as np
+from .Quantization import Quantizer
+import queue
+from .SearchEngine import SearchEngine
+import threading
+import time
+
+
+class StreamingEngine:
+    """
+    A class representing an out-of-core nearest neighbours search: the descriptor file (text file or binary store)
+    is scanned in chunks of rows, each chunk being merged into the running top-k of the queries and then dropped,
+    so that memory stays bounded by a few chunks whatever the number of rows. A reader thread reads and parses the
+    next chunks while the current one is searched.
+
+    The results are the ones of SearchEngine, equal distances being ordered by row, up to the rounding differences
+    of the metrics computed with products.
+
+    Attributes:
+        path (str): The path to the descriptor file.
+        files (list[str]): The filename of the image described by each row.
+        metric (Metric): The distance metric.
+        chunk_rows (int): The number of rows of a chunk.
+        prefetch (int): The number of chunks read ahead of the one being searched.
+        dim (int): The dimension of the descriptors.
+        dtype (np.dtype): The type the distances are computed in.
+        evaluations (int): The number of distance evaluations of the last search.
+        rows_per_second (float): The scan throughput of the last search.
+        _store (dict | None): The header and matrix offset of a binary store, None for a text file.
+        _quantizer (Quantizer | None): The quantizer of a compact store.
+        _rows (dict[str, int]): The row of each filename.
+
+    Methods:
+        __init__(self, path: str, files: list[str], metric: str, chunk_rows: int, prefetch: int): Initializes the
+            StreamingEngine object.
+        row(self, image_name: str): Returns the row of an image.
+        _read_chunks(self, start: int): Reads the chunks of rows from a row on, in the current thread.
+        _chunks(self): Reads the chunks of rows ahead in a reader thread.
+        vector(self, row: int): Reads the descriptor of a row.
+        batch_search(self, queries: np.ndarray, k: int, exclude: np.ndarray): Finds the nearest neighbours of
+            descriptors in one scan.
+        search_vector(self, query: np.ndarray, k: int, exclude: int): Finds the nearest neighbours of a descriptor.
+        search(self, image_name: str, k: int): Finds the nearest neighbours of an image of the database.
+    """
+
+    path: str
+    files: list[str]
+    metric: Metric
+    chunk_rows: int
+    prefetch: int
+    dim: int
+    dtype: np.dtype
+    evaluations: int
+    rows_per_second: float
+    _store: dict | None
+    _quantizer: Quantizer | None
+    _rows: dict[str, int]
+
+    def __init__(self, path: str, files: list[str], metric: str = 'chebyshev', chunk_rows: int = 65536, prefetch: int = 2):
+        """
+        Initializes the StreamingEngine object, without reading the descriptors.
+
+        Args:
+            path (str): The path to the descriptor file, a text file (one row of values per line) or a store.
+            files (list[str]): The filename of the image described by each row of a text file (a store has its
+                own list).
+            metric (str): The name of the distance metric (see Metrics.METRICS).
+            chunk_rows (int): The number of rows of a chunk.
+            prefetch (int): The number of chunks read ahead of the one being searched.
+        """
+
+        self.path = path
+        self.metric = get_metric(metric)
+        self.chunk_rows = max(1, chunk_rows)
+        self.prefetch = max(1, prefetch)
+        self.evaluations = 0
+        self.rows_per_second = 0.0
+
+        if path.endswith(DescriptorStore.EXTENSION):
+            # Only the header of a store is read, the matrix being read chunk by chunk
+            header: dict
+            data_offset: int
+            header, data_offset = DescriptorStore._read_header(path)
+            self._store = {'dtype': np.dtype(header['dtype']), 'count': header['count'], 'offset': data_offset}
+            self._quantizer = Quantizer.from_header(header)
+            self.files = header['files']
+            self.dim = header['dim']
+            self.dtype = np.dtype(np.float32) if self._quantizer is not None else self._store['dtype']
+        else:
+            self._store = None
+            self._quantizer = None
+            self.files = files
+            with open(path, 'r') as file:
+                self.dim = len(file.readline().split())
+            self.dtype = np.dtype(np.float64)
+
+        # Map each filename to its row, keeping the first row of a duplicated filename like SearchEngine
+        self._rows = {}
+        for row, filename in enumerate(self.files):
+            self._rows.setdefault(filename, row)
+
+    def row(self, image_name: str) -> int:
+        """
+        Returns the row of an image.
+
+        Args:
+            image_name (str): The filename of the image.
+
+        Returns:
+            int: The row of the image in the descriptor file.
+        """
+
+        try:
+            return self._rows[image_name]
+        except KeyError:
+            raise ValueError(f'{image_name} is not in the database') from None
+
+    def _read_chunks(self, start: int = 0):
+        """
+        Reads the chunks of rows of the descriptor file from a row on, decoded to float values.
+
+        Args:
+            start (int): The first row to read.
+
+        Yields:
+            tuple[int, np.ndarray]: The row of the first descriptor of each chunk and the descriptors.
+        """
+
+        if self._store is not None:
+            itemsize: int = self._store['dtype'].itemsize
+            with open(self.path, 'rb') as file:
+                file.seek(self._store['offset'] + start * self.dim * itemsize)
+                for chunk_start in range(start, self._store['count'], self.chunk_rows):
+                    rows: int = min(self.chunk_rows, self._store['count'] - chunk_start)
+                    chunk: np.ndarray = np.empty((rows, self.dim), dtype=self._store['dtype'])
+                    if file.readinto(chunk) != chunk.nbytes:
+                        raise ValueError(f'{self.path} is truncated')
+                    if self._quantizer is not None:
+                        chunk = self._quantizer.decode(chunk)
+                    yield chunk_start, chunk
+            return
+
+        with open(self.path, 'r') as file:
+            chunk_start: int = start
+            lines: list[str] = list(itertools.islice(file, start, start + self.chunk_rows))
+            while lines:
+                # Parse the whole chunk at once, the values of every line following each other
+                values: np.ndarray = np.fromstring(''.join(lines), sep=' ')
+                if values.size != len(lines) * self.dim:
+                    raise ValueError(f'{self.path}: the rows from {chunk_start} do not all have {self.dim} values')
+                yield chunk_start, values.reshape(len(lines), self.dim)
+
+                chunk_start += len(lines)
+                lines = list(itertools.islice(file, self.chunk_rows))
+
+    def _chunks(self):
+        """
+        Reads the chunks of rows of the descriptor file in a reader thread, up to prefetch chunks ahead of the
+        consumer.
+
+        Yields:
+            tuple[int, np.ndarray]: The row of the first descriptor of each chunk and the descriptors.
+        """
+
+        chunks: queue.Queue = queue.Queue(self.prefetch)
+        stopped: threading.Event = threading.Event()
+
+        def read():
+            try:
+                for chunk in self._read_chunks():
+                    # Give up when the consumer stopped early, instead of blocking on a full queue
+                    while not stopped.is_set():
+                        try:
+                            chunks.put(chunk, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stopped.is_set():
+                        return
+                chunks.put(None)
+            except Exception as error:
+                chunks.put(error)
+
+        reader: threading.Thread = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stopped.set()
+            reader.join()
+
+    def vector(self, row: int) -> np.ndarray:
+        """
+        Reads the descriptor of a row. The lines of a text file before the row are read, but not parsed.
+
+        Args:
+            row (int): The row.
+
+        Returns:
+            np.ndarray: The descriptor.
+        """
+
+        if self._store is not None:
+            if not 0 <= row < self._store['count']:
+                raise ValueError(f'Row {row} is not in {self.path}')
+            vector: np.ndarray = np.fromfile(
+                self.path, dtype=self._store['dtype'], count=self.dim,
+                offset=self._store['offset'] + row * self.dim * self._store['dtype'].itemsize
+            )
+            return vector if self._quantizer is None else self._quantizer.decode(vector)
+
+        with open(self.path, 'r') as file:
+            for line in itertools.islice(file, row, row + 1):
+                return np.fromstring(line, sep=' ')
+
+        raise ValueError(f'Row {row} is not in {self.path}')
+
+    def batch_search(self, queries: np.ndarray, k: int, exclude: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of several descriptors in one scan of the descriptor file.
+
+        Args:
+            queries (np.ndarray): The query descriptors, one per row.
+            k (int): The number of neighbours to find.
+            exclude (np.ndarray | None): The row to leave out of the results of each query, -1 for none. None
+                leaves out nothing.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (queries, k) rows of the neighbours and their distances, by increasing
+                distance. Fewer than k columns are returned if the file has fewer rows.
+        """
+
+        queries = np.asarray(queries, dtype=self.dtype).reshape(-1, self.dim)
+        if exclude is None:
+            exclude = np.full(queries.shape[0], -1)
+
+        # Running top-k of the queries, the empty slots sorting after every real row
+        best_rows: np.ndarray = np.full((queries.shape[0], k), SearchEngine.NO_ROW, dtype=np.intp)
+        best_distances: np.ndarray = np.full((queries.shape[0], k), np.inf, dtype=self.dtype)
+
+        start_time: float = time.perf_counter()
+        count: int = 0
+        for start, chunk in self._chunks():
+            stop: int = start + chunk.shape[0]
+            block: np.ndarray = self.metric.block_distances(queries, chunk, self.metric.prepare(chunk))
+
+            # Leave the excluded rows out of the block
+            excluded: np.ndarray = np.flatnonzero((exclude >= start) & (exclude < stop))
+            block[excluded, exclude[excluded] - start] = np.inf
+            exclude_columns: np.ndarray = np.full(queries.shape[0], -1)
+            exclude_columns[excluded] = exclude[excluded] - start
+
+            # Merge the chunk into the running top-k, then drop it
+            best_rows, best_distances = SearchEngine._merge_top_k(
+                best_rows, best_distances, block, start, k, exclude_columns
+            )
+            count = stop
+
+        elapsed: float = time.perf_counter() - start_time
+        self.evaluations = queries.shape[0] * count
+        self.rows_per_second = count / elapsed if elapsed > 0 else 0.0
+        INSTRUMENTATION.count('distance_evaluations', self.evaluations)
+        INSTRUMENTATION.count('rows_streamed', count)
+        INSTRUMENTATION.observe('stream_query', elapsed)
+
+        # Logging information
+        logging.info(f'{count} rows streamed in {elapsed:.2f}s ({self.rows_per_second:.0f} rows/s)')
+
+        # Drop the slots left empty by a file with fewer than k rows
+        found: int = min(k, count - 1 if np.any(exclude >= 0) else count)
+
+        return best_rows[:, :found], best_distances[:, :found]
+
+    def search_vector(self, query: np.ndarray, k: int, exclude: int = -1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of a descriptor in one scan of the descriptor file.
+
+        Args:
+            query (np.ndarray): The query descriptor.
+            k (int): The number of neighbours to find.
+            exclude (int): A row to leave out of the results (e.g. the query image), -1 for none.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The rows of the neighbours and their distances, by increasing distance.
+        """
+
+        rows: np.ndarray
+        distances: np.ndarray
+        rows, distances = self.batch_search(query, k, np.array([exclude]))
+
+        return rows[0], distances[0]
+
+    def search(self, image_name: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbours of an image of the database, the image itself excluded.
+
+        Args:
+            image_name (str): The filename of the query image.
+            k (int): The number of neighbours to find.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The rows of the neighbours and their distances, by increasing distance.
+        """
+
+        query_row: int = self.row(image_name)
+
+        return self.search_vector(self.vector(query_row), k, query_row)
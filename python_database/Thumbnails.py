@@ -0,0 +1,220 @@
+import argparse
+import inspect
+from .Instrumentation import INSTRUMENTATION
+import logging
+import multiprocessing
+import os
+from PIL import Image
+import time
+
+
+def _make_thumbnail(task: tuple[str, str, int, int]) -> str | None:
+    """
+    Generates the thumbnail of an image in a worker process.
+
+    Args:
+        task (tuple[str, str, int, int]): The path to the image, the path to the thumbnail, the height of the
+            thumbnail and its JPEG quality.
+
+    Returns:
+        str | None: The error message if the image could not be read, None otherwise.
+    """
+
+    image_path: str
+    thumbnail_path: str
+    height: int
+    quality: int
+    image_path, thumbnail_path, height, quality = task
+
+    try:
+        with Image.open(image_path) as image:
+            # Let the JPEG decoder reduce the resolution down to about twice the thumbnail height
+            image.draft('RGB', (max(1, image.width * 2 * height // max(1, image.height)), 2 * height))
+
+            # Fit the height, keeping the aspect ratio
+            image = image.convert('RGB')
+            image.thumbnail((max(1, image.width * height // max(1, image.height)), height), Image.Resampling.LANCZOS)
+
+        # Write the thumbnail atomically, so that a report never links a partial file
+        temporary_path: str = f'{thumbnail_path}.tmp'
+        image.save(temporary_path, 'JPEG', quality=quality, optimize=True)
+        os.replace(temporary_path, thumbnail_path)
+
+    except OSError as error:
+        return f'{image_path}: {error}'
+
+    return None
+
+
+class ThumbnailCache:
+    """
+    A class representing the thumbnails of the images of the database, linked by the HTML reports instead of the
+    full-size images: a results page then loads a few kilobytes per image instead of the whole JPEG scaled down by
+    the browser.
+
+    The thumbnails are JPEG files of the same name as the images, in a thumbnails folder next to the images folder.
+    They are generated once, in parallel on every core, and only generated again for the images modified since.
+
+    Attributes:
+        images_path (str): The folder of the images.
+        thumbnails_path (str): The folder of the thumbnails.
+        height (int): The height of the thumbnails, in pixels.
+        quality (int): The JPEG quality of the thumbnails.
+        _available (set[str] | None): The names of the generated thumbnails, None until listed.
+        _available_mtime (int | None): The modification time of the thumbnails folder when it was listed, in
+            nanoseconds (-1 if it didn't exist), None until listed.
+
+    Methods:
+        __init__(self, images_path: str, thumbnails_path: str, height: int, quality: int): Initializes the
+            ThumbnailCache object.
+        available(self): Returns the names of the generated thumbnails.
+        link(self, image_name: str): Returns the link to the thumbnail of an image, or to the image itself.
+        generate(self, image_names: list[str], workers: int | None, chunk_size: int): Generates the missing and
+            outdated thumbnails.
+    """
+
+    images_path: str
+    thumbnails_path: str
+    height: int
+    quality: int
+    _available: set[str] | None
+    _available_mtime: int | None
+
+    def __init__(self, images_path: str, thumbnails_path: str, height: int = 100, quality: int = 85):
+        """
+        Initializes the ThumbnailCache object, without reading the thumbnails.
+
+        Args:
+            images_path (str): The folder of the images.
+            thumbnails_path (str): The folder of the thumbnails.
+            height (int): The height of the thumbnails, in pixels.
+            quality (int): The JPEG quality of the thumbnails.
+        """
+
+        self.images_path = images_path
+        self.thumbnails_path = thumbnails_path
+        self.height = height
+        self.quality = quality
+        self._available = None
+        self._available_mtime = None
+
+    def available(self) -> set[str]:
+        """
+        Returns the names of the generated thumbnails, listing the thumbnails folder again only when it changed
+        (e.g. thumbnails generated or removed by another process).
+
+        Returns:
+            set[str]: The names of the images that have a thumbnail.
+        """
+
+        # Adding or removing a file changes the modification time of the folder
+        mtime: int
+        try:
+            mtime = os.stat(self.thumbnails_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = -1
+
+        if self._available is None or mtime != self._available_mtime:
+            self._available = set()
+            if mtime >= 0:
+                self._available = {
+                    entry.name for entry in os.scandir(self.thumbnails_path) if not entry.name.endswith('.tmp')
+                }
+            self._available_mtime = mtime
+
+        return self._available
+
+    def link(self, image_name: str) -> str:
+        """
+        Returns the link to the thumbnail of an image from the requests folder, or to the image itself if it has no
+        thumbnail.
+
+        Args:
+            image_name (str): The filename of the image.
+
+        Returns:
+            str: The relative link.
+        """
+
+        if image_name in self.available():
+            return f'../{os.path.basename(self.thumbnails_path)}/{image_name}'
+
+        return f'../{os.path.basename(self.images_path)}/{image_name}'
+
+    def generate(self, image_names: list[str], workers: int | None = None, chunk_size: int = 32) -> int:
+        """
+        Generates the thumbnails of images that have none, or an older one than the image.
+
+        Args:
+            image_names (list[str]): The filenames of the images.
+            workers (int | None): The number of worker processes, None for every core.
+            chunk_size (int): The number of images sent to a worker process at once.
+
+        Returns:
+            int: The number of generated thumbnails.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        os.makedirs(self.thumbnails_path, exist_ok=True)
+        available: set[str] = self.available()
+
+        # Only the missing thumbnails and the ones older than their image are generated
+        names: list[str] = list(dict.fromkeys(image_names))
+        tasks: list[tuple[str, str, int, int]] = []
+        for image_name in names:
+            image_path: str = os.path.join(self.images_path, image_name)
+            thumbnail_path: str = os.path.join(self.thumbnails_path, image_name)
+            try:
+                if image_name in available and os.path.getmtime(thumbnail_path) >= os.path.getmtime(image_path):
+                    continue
+            except OSError:
+                pass
+            tasks.append((image_path, thumbnail_path, self.height, self.quality))
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        start: float = time.perf_counter()
+        errors: list[str | None]
+        if workers <= 1 or len(tasks) <= chunk_size:
+            errors = [_make_thumbnail(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(workers) as pool:
+                errors = list(pool.imap(_make_thumbnail, tasks, chunksize=chunk_size))
+
+        generated: int = 0
+        for task, error in zip(tasks, errors):
+            if error is None:
+                available.add(os.path.basename(task[1]))
+                generated += 1
+            else:
+                logging.warning(f'No thumbnail for {error}')
+
+        elapsed: float = time.perf_counter() - start
+        INSTRUMENTATION.count('thumbnails_generated', generated)
+        INSTRUMENTATION.observe('thumbnails', elapsed)
+
+        # Logging information
+        logging.info(f'{generated} thumbnails generated in {elapsed:.1f} s ({len(names) - len(tasks)} up to date)')
+
+        return generated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates the thumbnails of the images of a database')
+    parser.add_argument('db_path', help='Path to the database, with its images folder and Base10000_files.txt')
+    parser.add_argument('--height', type=int, default=100, help='Height of the thumbnails, in pixels')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes, every core by default')
+    arguments = parser.parse_args()
+
+    # Set the logging level and format
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    with open(os.path.join(arguments.db_path, 'Base10000_files.txt'), 'r') as file:
+        names: list[str] = [line.strip() for line in file if line.strip()]
+
+    ThumbnailCache(
+        os.path.join(arguments.db_path, 'images'), os.path.join(arguments.db_path, 'thumbnails'), arguments.height
+    ).generate(names, arguments.workers)
@@ -0,0 +1,369 @@
+import heapq
+import inspect
+import logging
+from .Metrics import get_metric, Metric
+import numpy as np
+import os
+
+
+class VPTree:
+    """
+    A class representing a vantage-point tree: an exact nearest neighbours index over a descriptor matrix, valid for
+    any true metric (triangle inequality), e.g. Chebyshev, L1, L2, Hellinger or the 1-D EMD.
+
+    Each inner node holds a vantage row and the median distance (radius) from it to the rows of its subtree: the rows
+    within the radius go to the inside child, the others to the outside child. Leaves hold up to leaf_size rows,
+    compared to the query in one vectorized operation. A subtree is skipped when the triangle inequality proves that
+    it cannot hold a row closer than the current k-th neighbour, so the results are the ones of a brute-force search,
+    ties included (equal distances are ordered by row).
+
+    The nodes are stored as flat arrays, saved to and loaded from a .npz file next to the descriptor file, with the
+    generation of the descriptor store (or the checksum of the text file) the tree was built over, so that a tree
+    outdated by an indexing run is not searched.
+
+    Attributes:
+        matrix (np.ndarray): The descriptors, one per row.
+        metric (Metric): The distance metric.
+        leaf_size (int): The maximum number of rows of a leaf.
+        slack (float): The margin added to the pruning test to absorb the rounding errors of the distances.
+        vantage (np.ndarray): The vantage row of each node, -1 for the leaves.
+        radius (np.ndarray): The radius of each inner node.
+        inside (np.ndarray): The inside child of each inner node.
+        outside (np.ndarray): The outside child of each inner node.
+        start (np.ndarray): The first position of each leaf in order.
+        stop (np.ndarray): The end position of each leaf in order.
+        order (np.ndarray): The rows, grouped by leaf.
+        generation (int): The generation of the descriptor store the tree was built over, -1 for a text file.
+        checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+        _state (dict[str, np.ndarray]): The values precomputed by the metric for the rows of the matrix.
+
+    Methods:
+        __init__(self, matrix, metric, arrays, leaf_size, generation, checksum): Initializes the VPTree object from
+            its node arrays.
+        _default_slack(matrix: np.ndarray, metric: Metric): Computes the margin absorbing rounding errors.
+        build(matrix: np.ndarray, metric: str, leaf_size: int, seed: int, generation: int, checksum: str): Builds a
+            tree.
+        save(self, path: str): Saves the tree.
+        load(path: str, matrix: np.ndarray): Loads a tree.
+        _distances(self, query: np.ndarray, rows: np.ndarray): Computes the distances between a query and rows.
+        search(self, query: np.ndarray, k: int, exclude: int): Finds the k nearest rows of a query.
+    """
+
+    EXTENSION: str = '.vptree.npz'
+
+    matrix: np.ndarray
+    metric: Metric
+    leaf_size: int
+    slack: float
+    vantage: np.ndarray
+    radius: np.ndarray
+    inside: np.ndarray
+    outside: np.ndarray
+    start: np.ndarray
+    stop: np.ndarray
+    order: np.ndarray
+    generation: int
+    checksum: str
+    _state: dict[str, np.ndarray]
+
+    def __init__(
+            self,
+            matrix: np.ndarray,
+            metric: str,
+            arrays: dict[str, np.ndarray],
+            leaf_size: int,
+            generation: int = -1,
+            checksum: str = ''
+            ):
+        """
+        Initializes the VPTree object from its node arrays.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one per row.
+            metric (str): The name of the distance metric.
+            arrays (dict[str, np.ndarray]): The node arrays (vantage, radius, inside, outside, start, stop, order).
+            leaf_size (int): The maximum number of rows of a leaf.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+            checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+        """
+
+        self.matrix = matrix
+        self.metric = get_metric(metric)
+        self.leaf_size = leaf_size
+        self.vantage = arrays['vantage']
+        self.radius = arrays['radius']
+        self.inside = arrays['inside']
+        self.outside = arrays['outside']
+        self.start = arrays['start']
+        self.stop = arrays['stop']
+        self.order = arrays['order']
+        self.generation = generation
+        self.checksum = checksum
+        self._state = self.metric.prepare(matrix)
+        self.slack = self._default_slack(matrix, self.metric)
+
+    @staticmethod
+    def _default_slack(matrix: np.ndarray, metric: Metric) -> float:
+        """
+        Computes the margin added to the pruning test, so that rounding errors on the distances never prune a row
+        that a brute-force search would return.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one per row.
+            metric (Metric): The distance metric.
+
+        Returns:
+            float: The margin.
+        """
+
+        # Bound of the rounding error of a sum over the dimensions, relative to the magnitude of the values
+        scale: float = float(np.max(np.abs(matrix))) if matrix.size else 1.0
+        error: float = np.finfo(matrix.dtype).eps * matrix.shape[1] * max(scale, 1.0)
+
+        # A distance computed from dot products loses half of its significant digits on close rows
+        if metric.uses_products:
+            error = np.sqrt(error * max(scale, 1.0))
+
+        # The three distances of a triangle inequality are each rounded
+        return 4 * error
+
+    @staticmethod
+    def build(
+            matrix: np.ndarray,
+            metric: str = 'chebyshev',
+            leaf_size: int = 32,
+            seed: int = 0,
+            generation: int = -1,
+            checksum: str = ''
+            ) -> 'VPTree':
+        """
+        Builds a tree over a descriptor matrix.
+
+        Args:
+            matrix (np.ndarray): The descriptors, one per row.
+            metric (str): The name of the distance metric, which must be a true metric.
+            leaf_size (int): The maximum number of rows of a leaf.
+            seed (int): The seed of the random choice of the vantage rows.
+            generation (int): The generation of the descriptor store, -1 for a text file.
+            checksum (str): The checksum of the text file and of the list of database files, empty for a store.
+
+        Returns:
+            VPTree: The tree.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # The pruning relies on the triangle inequality
+        distance_metric: Metric = get_metric(metric)
+        if not distance_metric.is_metric:
+            raise ValueError(f'{metric} is not a true metric, a vantage-point tree cannot index it')
+
+        rng: np.random.Generator = np.random.default_rng(seed)
+        state: dict[str, np.ndarray] = distance_metric.prepare(matrix)
+        order: np.ndarray = np.arange(matrix.shape[0])
+
+        # Node arrays, grown as the nodes are created
+        vantage: list[int] = []
+        radius: list[float] = []
+        inside: list[int] = []
+        outside: list[int] = []
+        start: list[int] = []
+        stop: list[int] = []
+
+        def new_node(node_start: int, node_stop: int) -> int:
+            for values, value in ((vantage, -1), (radius, 0.0), (inside, -1), (outside, -1),
+                                  (start, node_start), (stop, node_stop)):
+                values.append(value)
+            return len(vantage) - 1
+
+        # Split the nodes one after the other, each node covering order[start:stop]
+        pending: list[int] = [new_node(0, matrix.shape[0])]
+        while pending:
+            node: int = pending.pop()
+            node_start: int = start[node]
+            node_stop: int = stop[node]
+
+            # Small enough: the node is a leaf
+            if node_stop - node_start <= leaf_size:
+                continue
+
+            # Move a random vantage row to the front of the node
+            pick: int = int(rng.integers(node_start, node_stop))
+            order[node_start], order[pick] = order[pick], order[node_start]
+            vantage_row: int = int(order[node_start])
+
+            # Distances between the vantage row and the other rows of the node
+            rows: np.ndarray = order[node_start + 1:node_stop]
+            distances: np.ndarray = distance_metric.distances(
+                matrix[vantage_row],
+                matrix[rows],
+                {name: values[rows] for name, values in state.items()}
+            )
+
+            # Split the other rows around the median distance
+            median: float = float(np.median(distances))
+            is_inside: np.ndarray = distances <= median
+            order[node_start + 1:node_stop] = np.concatenate((rows[is_inside], rows[~is_inside]))
+            middle: int = node_start + 1 + int(is_inside.sum())
+
+            vantage[node] = vantage_row
+            radius[node] = median
+            inside[node] = new_node(node_start + 1, middle)
+            outside[node] = new_node(middle, node_stop)
+            pending.extend((inside[node], outside[node]))
+
+        arrays: dict[str, np.ndarray] = {
+            'vantage': np.array(vantage, dtype=np.int64),
+            'radius': np.array(radius, dtype=np.float64),
+            'inside': np.array(inside, dtype=np.int64),
+            'outside': np.array(outside, dtype=np.int64),
+            'start': np.array(start, dtype=np.int64),
+            'stop': np.array(stop, dtype=np.int64),
+            'order': order
+        }
+
+        # Logging information
+        logging.info(f'Vantage-point tree built over {matrix.shape[0]} rows ({len(vantage)} nodes, {metric})')
+
+        return VPTree(matrix, metric, arrays, leaf_size, generation, checksum)
+
+    def save(self, path: str):
+        """
+        Saves the tree, e.g. next to its descriptor file.
+
+        Args:
+            path (str): The path to the .npz file.
+        """
+
+        # Debugging information
+        logging.debug(f'{inspect.currentframe().f_code.co_name}()')
+
+        # Write next to the destination then move, so that a reader never sees a partially written tree
+        temporary_path: str = f'{path}.tmp.npz'
+        np.savez(
+            temporary_path,
+            vantage=self.vantage, radius=self.radius, inside=self.inside, outside=self.outside,
+            start=self.start, stop=self.stop, order=self.order,
+            metric=np.array(self.metric.name), leaf_size=np.array(self.leaf_size),
+            shape=np.array(self.matrix.shape), generation=np.array(self.generation), checksum=np.array(self.checksum)
+        )
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path: str, matrix: np.ndarray) -> 'VPTree':
+        """
+        Loads a tree saved by save(). The caller checks its generation or checksum against the descriptors (a tree
+        saved without them has none, and is outdated).
+
+        Args:
+            path (str): The path to the .npz file.
+            matrix (np.ndarray): The descriptors the tree was built over.
+
+        Returns:
+            VPTree: The tree.
+        """
+
+        with np.load(path) as data:
+            # The tree is only valid for the matrix it was built over
+            if tuple(data['shape']) != matrix.shape:
+                raise ValueError(f'{path} was built over a {tuple(data["shape"])} matrix, not {matrix.shape}')
+
+            arrays: dict[str, np.ndarray] = {
+                name: data[name] for name in ('vantage', 'radius', 'inside', 'outside', 'start', 'stop', 'order')
+            }
+            return VPTree(
+                matrix, str(data['metric']), arrays, int(data['leaf_size']),
+                int(data['generation']) if 'generation' in data else -1,
+                str(data['checksum']) if 'checksum' in data else ''
+            )
+
+    def _distances(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """
+        Computes the distances between a query and some rows of the matrix.
+
+        Args:
+            query (np.ndarray): The query descriptor.
+            rows (np.ndarray): The rows.
+
+        Returns:
+            np.ndarray: The distance to each row.
+        """
+
+        return self.metric.distances(query, self.matrix[rows], {name: values[rows] for name, values in self._state.items()})
+
+    def search(self, query: np.ndarray, k: int, exclude: int = -1) -> tuple[np.ndarray, np.ndarray, int]:
+        """
+        Finds the k nearest rows of a query.
+
+        Args:
+            query (np.ndarray): The query descriptor.
+            k (int): The number of rows to find.
+            exclude (int): A row to leave out of the results (e.g. the query image), -1 for none.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, int]: The rows and their distances by increasing distance (then by row),
+                and the number of distance evaluations the search needed.
+        """
+
+        query = np.asarray(query, dtype=self.matrix.dtype)
+        k = min(k, self.matrix.shape[0] - (1 if exclude >= 0 else 0))
+        evaluations: int = 0
+
+        # Max-heap of the current best rows, as (-distance, -row): the root is the worst of them
+        best: list[tuple[float, int]] = []
+
+        def consider(distance: float, row: int):
+            if row == exclude:
+                return
+            if len(best) < k:
+                heapq.heappush(best, (-distance, -row))
+            elif (distance, row) < (-best[0][0], -best[0][1]):
+                heapq.heapreplace(best, (-distance, -row))
+
+        def worst() -> float:
+            return -best[0][0] if len(best) == k else np.inf
+
+        # Depth-first traversal, the nearest child first, with the lower bound of the distances in each subtree
+        pending: list[tuple[int, float]] = [(0, 0.0)] if k > 0 else []
+        while pending:
+            node, lower_bound = pending.pop()
+
+            # The subtree cannot hold a row closer than the current k-th one
+            if lower_bound - self.slack > worst():
+                continue
+
+            # Leaf: compare the query to all its rows at once
+            if self.vantage[node] < 0:
+                rows: np.ndarray = self.order[self.start[node]:self.stop[node]]
+                distances: np.ndarray = self._distances(query, rows)
+                evaluations += rows.shape[0]
+                for index in np.flatnonzero(distances <= worst()):
+                    consider(float(distances[index]), int(rows[index]))
+                continue
+
+            # Inner node: compare the query to the vantage row
+            vantage_row: int = int(self.vantage[node])
+            distance: float = float(self._distances(query, np.array([vantage_row]))[0])
+            evaluations += 1
+            consider(distance, vantage_row)
+
+            # Lower bounds of the inside and outside subtrees, from the triangle inequality
+            radius: float = float(self.radius[node])
+            inside_bound: float = max(lower_bound, distance - radius)
+            outside_bound: float = max(lower_bound, radius - distance)
+
+            # Push the farthest child first so that the nearest one is explored first
+            if distance <= radius:
+                pending.append((int(self.outside[node]), outside_bound))
+                pending.append((int(self.inside[node]), inside_bound))
+            else:
+                pending.append((int(self.inside[node]), inside_bound))
+                pending.append((int(self.outside[node]), outside_bound))
+
+        # Sort the best rows by distance, then by row
+        results: list[tuple[float, int]] = sorted((-distance, -row) for distance, row in best)
+        rows_found: np.ndarray = np.array([row for _, row in results], dtype=np.intp)
+        distances_found: np.ndarray = np.array([distance for distance, _ in results], dtype=self.matrix.dtype)
+
+        return rows_found, distances_found, evaluations
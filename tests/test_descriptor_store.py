@@ -0,0 +1,109 @@
+import numpy as np
+import os
+from python_database.DescriptorStore import DescriptorStore
+import tempfile
+import unittest
+
+
+class TestDescriptorStore(unittest.TestCase):
+    """
+    Checks that the rows of a store are read back as written, and kept in order by appends and removals.
+    """
+
+    def setUp(self):
+        self.folder: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
+        self.path: str = os.path.join(self.folder.name, 'Base.HistRGB_2x2x2' + DescriptorStore.EXTENSION)
+        self.matrix: np.ndarray = np.random.default_rng(0).random((50, 8))
+        self.files: list[str] = [f'{row}.jpg' for row in range(50)]
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_round_trip(self):
+        for dtype in ('float32', 'float64'):
+            with self.subTest(dtype=dtype):
+                DescriptorStore.write(self.path, 'HistRGB_2x2x2', self.matrix, self.files, dtype)
+                store: DescriptorStore = DescriptorStore(self.path)
+                self.assertEqual((store.descriptor, store.dtype.name, store.dim, store.count), ('HistRGB_2x2x2', dtype, 8, 50))
+                self.assertEqual(store.files, self.files)
+                self.assertIsNone(store.quantizer)
+                np.testing.assert_array_equal(store.matrix, self.matrix.astype(dtype))
+
+    def test_compact_round_trip(self):
+        for dtype, tolerance in (('float16', 1e-3), ('uint8', 1 / 255)):
+            with self.subTest(dtype=dtype):
+                DescriptorStore.write(self.path, 'HistRGB_2x2x2', self.matrix, self.files, dtype)
+                store: DescriptorStore = DescriptorStore(self.path)
+                self.assertEqual(store.matrix.dtype.name, dtype)
+                self.assertEqual(store.quantizer.dtype.name, dtype)
+                np.testing.assert_allclose(store.quantizer.decode(store.matrix), self.matrix, atol=tolerance)
+
+    def test_generation(self):
+        DescriptorStore.write(self.path, 'HistRGB_2x2x2', self.matrix, self.files)
+        self.assertEqual(DescriptorStore(self.path).generation, 0)
+
+        # Overwriting a store keeps counting its generations
+        DescriptorStore.write(self.path, 'HistRGB_2x2x2', self.matrix, self.files)
+        store: DescriptorStore = DescriptorStore(self.path, 'r+')
+        self.assertEqual(store.generation, 1)
+
+        # Rows updated in place
+        store.set_rows(np.array([3, 7]), np.zeros((2, 8)))
+        store.flush()
+        store = DescriptorStore(self.path)
+        self.assertEqual(store.generation, 2)
+        np.testing.assert_array_equal(store.matrix[[3, 7]], 0)
+        np.testing.assert_array_equal(store.matrix[4], self.matrix[4].astype(np.float32))
+
+    def test_append(self):
+        DescriptorStore.write(self.path, 'HistRGB_2x2x2', self.matrix[:30], self.files[:30])
+        store: DescriptorStore = DescriptorStore(self.path, 'r+')
+        store.append(self.matrix[30:], self.files[30:])
+
+        for opened in (store, DescriptorStore(self.path)):
+            self.assertEqual((opened.count, opened.generation), (50, 1))
+            self.assertEqual(opened.files, self.files)
+            np.testing.assert_array_equal(opened.matrix, self.matrix.astype(np.float32))
+
+    def test_append_large_header(self):
+        # Filenames outgrowing the room of the header make the store rewrite itself
+        DescriptorStore.write(self.path, 'HistRGB_2x2x2', self.matrix[:1], self.files[:1])
+        files: list[str] = [f'{"x" * 200}_{row}.jpg' for row in range(49)]
+        store: DescriptorStore = DescriptorStore(self.path, 'r+')
+        store.append(self.matrix[1:], files)
+
+        store = DescriptorStore(self.path)
+        self.assertEqual(store.files, self.files[:1] + files)
+        np.testing.assert_array_equal(store.matrix, self.matrix.astype(np.float32))
+
+    def test_remove(self):
+        DescriptorStore.write(self.path, 'HistRGB_2x2x2', self.matrix, self.files, 'uint8')
+        store: DescriptorStore = DescriptorStore(self.path, 'r+')
+        codes: np.ndarray = np.array(store.matrix)
+        removed: list[str] = ['0.jpg', '17.jpg', '18.jpg', '49.jpg', 'unknown.jpg']
+        store.remove(removed)
+
+        # The other rows keep their order and codes
+        kept: list[int] = [row for row, filename in enumerate(self.files) if filename not in removed]
+        for opened in (store, DescriptorStore(self.path)):
+            self.assertEqual((opened.count, opened.generation), (46, 1))
+            self.assertEqual(opened.files, [self.files[row] for row in kept])
+            np.testing.assert_array_equal(opened.matrix, codes[kept])
+        self.assertFalse(os.path.exists(f'{self.path}.tmp'))
+
+        # Removing nothing leaves the store untouched
+        store.remove(['unknown.jpg'])
+        self.assertEqual(DescriptorStore(self.path).generation, 1)
+
+    def test_truncate(self):
+        DescriptorStore.write(self.path, 'HistRGB_2x2x2', self.matrix, self.files)
+        store: DescriptorStore = DescriptorStore(self.path, 'r+')
+        store.truncate(20)
+
+        store = DescriptorStore(self.path)
+        self.assertEqual((store.count, store.files), (20, self.files[:20]))
+        np.testing.assert_array_equal(store.matrix, self.matrix[:20].astype(np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import numpy as np
+import os
+from PIL import Image
+from python_database.Descriptors import Features, get_extractor
+from python_database.JPicture import JPicture
+import unittest
+
+
+# Images of the database used as test cases, reduced so that the reference loops stay fast
+IMAGES_PATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Base10000', 'images')
+IMAGE_NAMES: tuple[str, ...] = ('103011.jpg', '103013.jpg', '103033.jpg', '103090.jpg', '104005.jpg')
+IMAGE_SIZE: tuple[int, int] = (96, 72)
+
+
+def load_image(image_name: str) -> Image.Image:
+    """
+    Loads a test image of the database, reduced to IMAGE_SIZE.
+
+    Args:
+        image_name (str): The filename of the image.
+
+    Returns:
+        Image.Image: The decoded RGB image.
+    """
+
+    with Image.open(os.path.join(IMAGES_PATH, image_name)) as image:
+        return image.convert('RGB').resize(IMAGE_SIZE, Image.Resampling.BOX)
+
+
+def baseline_histogram(pixels: np.ndarray, nbins: int) -> np.ndarray:
+    """
+    Computes a histogram like the original JPicture, pixel by pixel on the normalized values: a joint RGB histogram
+    for a 3D array, a gray level histogram for a 2D array.
+
+    Args:
+        pixels (np.ndarray): The normalized pixel values.
+        nbins (int): The number of bins per channel.
+
+    Returns:
+        np.ndarray: The flat histogram, normalized by the number of pixels.
+    """
+
+    step: float = 1 / nbins
+    bins: np.ndarray = np.zeros((nbins,) * 3 if pixels.ndim == 3 else (nbins,), dtype=int)
+
+    # The bin of each channel is the floor division of its value by the step, the maximum value in the last bin
+    for line in pixels:
+        for pixel in line:
+            index: tuple[int, ...] = tuple(min(int(value // step), nbins - 1) for value in np.atleast_1d(pixel))
+            bins[index] += 1
+
+    return (bins / (pixels.shape[0] * pixels.shape[1])).ravel()
+
+
+def baseline_luma(image: Image.Image) -> np.ndarray:
+    """
+    Computes the luma of the normalized pixels of an image like the original JPicture.
+
+    Args:
+        image (Image.Image): The RGB image.
+
+    Returns:
+        np.ndarray: The float luma of each pixel, in [0, 1].
+    """
+
+    pixels: np.ndarray = np.asarray(image) / 255
+
+    return 0.299 * pixels[:, :, 0] + 0.587 * pixels[:, :, 1] + 0.114 * pixels[:, :, 2]
+
+
+class TestBaselineParity(unittest.TestCase):
+    """
+    Checks that the histograms of JPicture are the ones of the original pixel by pixel implementation.
+    """
+
+    def test_gray_histogram(self):
+        for image_name in IMAGE_NAMES:
+            with self.subTest(image=image_name):
+                image: Image.Image = load_image(image_name)
+                found: np.ndarray = JPicture(('HistGRAY_256',)).histograms(image)[0]
+                np.testing.assert_array_equal(found, baseline_histogram(baseline_luma(image), 256))
+
+    def test_rgb_histograms(self):
+        for image_name in IMAGE_NAMES:
+            with self.subTest(image=image_name):
+                image: Image.Image = load_image(image_name)
+                found: tuple[np.ndarray, ...] = JPicture(('HistRGB_2x2x2', 'HistRGB_4x4x4', 'HistRGB_6x6x6')).histograms(image)
+                for histogram, nbins in zip(found, (2, 4, 6)):
+                    np.testing.assert_array_equal(histogram, baseline_histogram(np.asarray(image) / 255, nbins))
+
+    def test_saturated_pixels(self):
+        # White pixels make the largest products of the integer luma
+        image: Image.Image = Image.new('RGB', (8, 8), (255, 255, 255))
+        found: np.ndarray = JPicture(('HistGRAY_256',)).histograms(image)[0]
+        np.testing.assert_array_equal(found, baseline_histogram(baseline_luma(image), 256))
+        self.assertEqual(found[255], 1.0)
+
+
+class TestLuma(unittest.TestCase):
+    """
+    Checks the shared luma of the extractors against the baseline gray histogram and exact integer arithmetic.
+    """
+
+    def test_luma(self):
+        for image_name in IMAGE_NAMES:
+            with self.subTest(image=image_name):
+                pixels: np.ndarray = np.asarray(load_image(image_name))
+                # Python integers cannot wrap around
+                weights: np.ndarray = np.array(Features.LUMA_WEIGHTS, dtype=object)
+                expected: np.ndarray = (pixels.astype(object) * weights).sum(axis=2) // 1000
+                np.testing.assert_array_equal(Features(pixels).luma(), expected.astype(np.uint8))
+
+    def test_gray_histograms(self):
+        for image_name in IMAGE_NAMES:
+            image: Image.Image = load_image(image_name)
+            for name, nbins in (('HistGRAY_256', 256), ('HistGREY_16', 16), ('HistGREY_64', 64)):
+                with self.subTest(image=image_name, descriptor=name):
+                    found: np.ndarray = get_extractor(name).extract(Features(np.asarray(image)))
+                    np.testing.assert_array_equal(found, baseline_histogram(baseline_luma(image), nbins))
+
+    def test_luma_extractors(self):
+        # The luma-based extractors must not depend on how the luma is computed in a Features object
+        pixels: np.ndarray = np.asarray(load_image(IMAGE_NAMES[0]))
+        for name in ('LBP_256', 'EdgeHist_8', 'DHash_8', 'PHash_8'):
+            with self.subTest(descriptor=name):
+                features: Features = Features(pixels)
+                weights: np.ndarray = np.array(Features.LUMA_WEIGHTS, dtype=object)
+                luma: np.ndarray = ((pixels.astype(object) * weights).sum(axis=2) // 1000).astype(np.uint8)
+                features._cache['luma'] = luma
+                np.testing.assert_array_equal(get_extractor(name).extract(Features(pixels)), get_extractor(name).extract(features))
+
+
+if __name__ == '__main__':
+    unittest.main()
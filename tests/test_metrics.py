@@ -0,0 +1,70 @@
+import numpy as np
+from python_database.Metrics import METRICS
+from python_database.SearchEngine import SearchEngine
+import unittest
+
+
+def stable_order(distances: np.ndarray, exclude: int = -1) -> np.ndarray:
+    """
+    Orders every row by increasing distance, equal distances by row, the excluded row left out.
+
+    Args:
+        distances (np.ndarray): The distance to each row.
+        exclude (int): A row to leave out, -1 for none.
+
+    Returns:
+        np.ndarray: The rows, in order.
+    """
+
+    rows: np.ndarray = np.argsort(distances, kind='stable')
+
+    return rows[rows != exclude]
+
+
+class TestTopKTies(unittest.TestCase):
+    """
+    Checks that equal distances are ordered by row by every search, for every metric.
+    """
+
+    def setUp(self):
+        # Histograms with few distinct values, each repeated on several rows, so that most distances are tied
+        rng: np.random.Generator = np.random.default_rng(0)
+        distinct: np.ndarray = rng.integers(0, 4, size=(12, 8)).astype(np.float32)
+        distinct[:, 0] += 1
+        distinct /= distinct.sum(axis=1, keepdims=True)
+        self.matrix: np.ndarray = distinct[rng.integers(0, 12, size=300)]
+        self.files: list[str] = [f'{row}.jpg' for row in range(300)]
+
+    def test_top_k(self):
+        distances: np.ndarray = np.array([2, 1, 0, 1, 2, 0, 1, 1, 2, 0], dtype=np.float32)
+        for k in range(1, 11):
+            with self.subTest(k=k):
+                np.testing.assert_array_equal(SearchEngine.top_k(distances, k), stable_order(distances)[:k])
+                np.testing.assert_array_equal(SearchEngine.top_k(distances, k, 5), stable_order(distances, 5)[:k])
+
+    def test_search(self):
+        for name in METRICS:
+            engine: SearchEngine = SearchEngine(self.matrix, self.files, name)
+            for query_row in (0, 7, 299):
+                with self.subTest(metric=name, query=query_row):
+                    expected: np.ndarray = stable_order(engine.distances(self.matrix[query_row]), query_row)
+                    for k in (1, 10, 45):
+                        rows, distances = engine.search(self.files[query_row], k)
+                        np.testing.assert_array_equal(rows, expected[:k])
+                        self.assertTrue(np.all(np.diff(distances) >= 0))
+
+    def test_batch_search(self):
+        query_rows: np.ndarray = np.array([0, 7, 150, 299])
+        for name in METRICS:
+            engine: SearchEngine = SearchEngine(self.matrix, self.files, name)
+            block: np.ndarray = engine.block_distances(self.matrix[query_rows], 0, len(self.files))
+            for k in (1, 10, 45):
+                with self.subTest(metric=name, k=k):
+                    # Small tiles, so that the ties are split across the blocks merged into the running top-k
+                    rows, _ = engine.batch_search(self.matrix[query_rows], k, query_rows, query_tile=3, tile_bytes=1024)
+                    for found, distances, query_row in zip(rows, block, query_rows):
+                        np.testing.assert_array_equal(found, stable_order(distances, query_row)[:k])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+from PIL import Image
+from python_database.Thumbnails import ThumbnailCache
+import tempfile
+import unittest
+
+
+class TestThumbnailCache(unittest.TestCase):
+    """
+    Checks that the thumbnails generated or removed by another ThumbnailCache (e.g. another process) are seen.
+    """
+
+    def setUp(self):
+        self.folder: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
+        self.images_path: str = os.path.join(self.folder.name, 'images')
+        self.thumbnails_path: str = os.path.join(self.folder.name, 'thumbnails')
+        os.makedirs(self.images_path)
+        for image_name in ('1.jpg', '2.jpg'):
+            Image.new('RGB', (40, 30), (200, 100, 50)).save(os.path.join(self.images_path, image_name))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_link(self):
+        cache: ThumbnailCache = ThumbnailCache(self.images_path, self.thumbnails_path, height=10)
+        other: ThumbnailCache = ThumbnailCache(self.images_path, self.thumbnails_path, height=10)
+
+        # No thumbnails folder yet
+        self.assertEqual(cache.link('1.jpg'), '../images/1.jpg')
+
+        # Generated by the other cache
+        other.generate(['1.jpg'], workers=1)
+        self.assertEqual(cache.link('1.jpg'), '../thumbnails/1.jpg')
+        self.assertEqual(cache.link('2.jpg'), '../images/2.jpg')
+        other.generate(['2.jpg'], workers=1)
+        self.assertEqual(cache.link('2.jpg'), '../thumbnails/2.jpg')
+
+        # Removed
+        os.remove(os.path.join(self.thumbnails_path, '1.jpg'))
+        self.assertEqual(cache.link('1.jpg'), '../images/1.jpg')
+        self.assertEqual(cache.available(), {'2.jpg'})
+
+
+if __name__ == '__main__':
+    unittest.main()